@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+"""
+	Boom Backend Selection
+	======================
+		Which implementations the engine uses for drawing and for sound. The
+		null backends do nothing, so the engine can run the game without a
+		window, a sound card, or even OpenGL and PIL installed, e.g. on a
+		server or to benchmark the simulation.
+		
+		The backends are picked when the Graphics and Sound modules are
+		loaded, so set them with the arguments to Boom.init() rather than
+		changing them afterwards:
+		
+		>>> Boom.init(Boom.Backend.GRAPHICS_NULL, Boom.Backend.SOUND_NULL)
+		>>> interface = Boom.Interface.NullInterface()
+	
+		License
+		-------
+		Copyright (C) 2006 Daniel G. Taylor
+
+		This program is free software; you can redistribute it and/or modify
+		it under the terms of the GNU General Public License as published by
+		the Free Software Foundation; either version 2 of the License, or
+		(at your option) any later version.
+
+		This program is distributed in the hope that it will be useful,
+		but WITHOUT ANY WARRANTY; without even the implied warranty of
+		MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+		GNU General Public License for more details.
+
+		You should have received a copy of the GNU General Public License
+		along with this program; if not, write to the Free Software
+		Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307 USA
+"""
+
+GRAPHICS_OPENGL = "opengl"
+GRAPHICS_NULL = "null"
+
+SOUND_SDL = "sdl"
+SOUND_NULL = "null"
+
+# The backends in use
+graphics = GRAPHICS_OPENGL
+sound = SOUND_SDL
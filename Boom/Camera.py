@@ -25,9 +25,10 @@
 		Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307 USA
 """
 
-from Graphics import Point3d, PolarVector3d, gluLookAt
-from math import sin, cos, pi, fabs
-from copy import deepcopy
+from Graphics import Point3d, PolarVector3d, glLoadMatrixf
+from math import sin, cos, tan, sqrt, radians, pi, fabs
+from array import array
+import ctypes
 import Interface, Event
 
 # Ease of use constants
@@ -43,6 +44,144 @@ pi74 = 7.0 * pi / 4.0
 pi94 = 9.0 * pi / 4.0
 pi114 = 11.0 * pi / 4.0
 
+# How many samples of the animation curves are stored; animations are
+# interpolated between them
+CAMERA_EASING_SAMPLES = 1024
+
+# Which position angles a rotation animates
+ROTATE_BOTH = 0
+ROTATE_THETA = 1
+ROTATE_PHI = 2
+
+#-------------------------------------------------------------------------------
+def ease(percent):
+	"""
+	The curve rotations and zooms follow, from 0 to 1 (overshooting a bit)
+	as percent goes from 0 to 1.
+	"""
+	# Do not ask where I came up with this function; I pulled it out
+	# of my ass one morning, to be honest, and still wonder why it
+	# just "hit me" out of the blue.
+	# This is no attempt to be a physically correct simulation of motion,
+	# as a correct simulation was used before but didn't yield as nice
+	# results.
+	tmpvar = 3.0 * pi * percent
+	if tmpvar == 0.0:
+		return 0.0
+	sintmpvar = sin(tmpvar)
+	# This function oscillates between about [0, 1.1215) (from outputs
+	# I have seen, it could be slightly higher in reality)
+	return 1 - (sintmpvar / tmpvar) + .1 * (sintmpvar)
+
+def shake_curve(percent):
+	"""
+	The curve the shake animation follows.
+	"""
+	# More voodoo, just that this time the function is used with
+	# with an offset to increase, then decrease
+	func = percent * fourpi - pi
+	if func == 0.0:
+		return 1.0
+	return sin(func) / func
+
+def make_table(function, samples = CAMERA_EASING_SAMPLES):
+	"""
+	Sample a curve from 0 to 1 into a table for sample_table.
+	"""
+	return array("d", [function(i / float(samples - 1)) for i in xrange(samples)])
+
+def sample_table(table, percent):
+	"""
+	Return the value of the curve in table at percent (0 to 1).
+	"""
+	index = percent * (len(table) - 1)
+	sample = int(index)
+	if sample >= len(table) - 1:
+		return table[-1]
+	return table[sample] + (table[sample + 1] - table[sample]) * (index - sample)
+
+EASING_TABLE = make_table(ease)
+SHAKE_TABLE = make_table(shake_curve)
+
+def make_position_index(positions):
+	"""
+	Return a dictionary of the first index of each (theta, phi) in positions,
+	rounded like PolarVector3d.equals.
+	"""
+	index = {}
+	for p in range(len(positions)):
+		key = (round(positions[p].theta, 12), round(positions[p].phi, 12))
+		if key not in index:
+			index[key] = p
+	return index
+
+def make_transition(faces, positions, position_index, up0, up1, pos0, pos1):
+	"""
+	Precompute a rotation of the cube camera. Returns a table of the position
+	theta and phi and up theta and phi for each sample of the easing curve,
+	which of the position angles change and the final position theta and phi,
+	up theta and phi and index of the final position in positions.
+	"""
+	start_up = faces[up0]
+	end_up = faces[up1]
+	start = positions[pos0]
+	end = positions[pos1]
+	if end.theta != start.theta and end.phi != start.phi:
+		axes = ROTATE_BOTH
+	elif end.theta != start.theta:
+		axes = ROTATE_THETA
+	else:
+		axes = ROTATE_PHI
+	
+	table = array("d")
+	for percent in EASING_TABLE:
+		# This is the easy part. Set the up angles to the percent they should be at.
+		up_theta = (end_up.theta - start_up.theta) * percent + start_up.theta
+		up_phi = (end_up.phi - start_up.phi) * percent + start_up.phi
+		
+		# Now for the ugly
+		# If both values are changing, the camera is rotating on a non-nice axis
+		theta = start.theta
+		phi = start.phi
+		if axes == ROTATE_BOTH:
+			# In this case, the rotation is in the first and third quadrants (I do not remember)
+			angle = fabs(up_phi - start_up.phi)
+			if start.phi != start_up.phi:
+				theta = sin(angle) * (end.theta - start.theta) + start.theta
+				phi = (1 - cos(angle)) * (end.phi - start.phi) + start.phi
+			# Second and fourth quadrants, I believe
+			else:
+				theta = (1 - cos(angle)) * (end.theta - start.theta) + start.theta
+				phi = sin(angle) * (end.phi - start.phi) + start.phi
+		# Back to the easier work, now the camera is moving on only a single axis
+		elif axes == ROTATE_THETA:
+			theta = percent * (end.theta - start.theta) + start.theta
+		else:
+			phi = percent * (end.phi - start.phi) + start.phi
+		table.extend((theta, phi, up_theta, up_phi))
+	# One more sample so stepping can always look at the next one
+	table.extend(table[-4:])
+	
+	# The final values, "normalized" by limiting theta to [0, 2 * pi) and
+	# phi to [0, pi]
+	up_theta = end_up.theta
+	up_phi = end_up.phi % twopi
+	theta = end.theta
+	phi = end.phi % twopi
+	if up_phi > pi:
+		up_theta += pi
+		up_phi = pi - (up_phi % pi)
+	if phi > pi:
+		theta += pi
+		phi = pi - (phi % pi)
+	theta %= twopi
+	up_theta %= twopi
+	
+	# Reverse lookup, necessary because of the multiple values
+	# for a single position
+	final = position_index.get((round(theta, 12), round(phi, 12)), pos1)
+	return (table, axes, (theta, phi, up_theta, up_phi, final))
+
 #-------------------------------------------------------------------------------
 class Camera3d:
 	"""
@@ -52,19 +191,134 @@ class Camera3d:
 		the camera is looking at, and an up vector.
 		
 		Inherit this for more complex camera systems.
+		
+		The view matrix (what gluLookAt would make) and the planes of the
+		view frustum are cached, and only worked out again after moved is
+		called, so anything that needs them (drawing, culling, sound) can
+		use them as often as it likes.
 	"""
 	def __init__(self, pos = Point3d(0, -25, 25), lookat = Point3d(0, 0, 0), up = Point3d(0, 0, 1)):
 		self.pos = pos
 		self.lookat = lookat
 		self.up = up
+		# Column-major, ready for glLoadMatrixf
+		self.view_matrix = (ctypes.c_float * 16)()
+		# Left, right, bottom, top, near and far planes as [a, b, c, d] with
+		# a * x + b * y + c * z + d >= 0 inside
+		self.frustum = [[0.0, 0.0, 0.0, 0.0] for plane in range(6)]
+		self.aspect = None
+		self.focal = 1.0
+		self.changed = True
 	
 	def update(self):
 		pass
+	
+	def moved(self):
+		"""
+		Call after changing pos, lookat or up so the cached matrices are
+		worked out again.
+		"""
+		self.changed = True
+
+	def get_view_matrix(self):
+		"""
+		Return the view matrix, working it out again if the camera moved.
+		"""
+		if self.changed or self.aspect != Interface.aspect:
+			self.calc_matrices()
+		return self.view_matrix
+
+	def calc_matrices(self):
+		"""
+		Work out the view matrix and frustum planes from the camera's pose
+		and the interface's perspective.
+		"""
+		pos = self.pos
+		fx = self.lookat.x - pos.x
+		fy = self.lookat.y - pos.y
+		fz = self.lookat.z - pos.z
+		length = sqrt(fx * fx + fy * fy + fz * fz) or 1.0
+		fx /= length
+		fy /= length
+		fz /= length
+		# Side = forward x up
+		sx = fy * self.up.z - fz * self.up.y
+		sy = fz * self.up.x - fx * self.up.z
+		sz = fx * self.up.y - fy * self.up.x
+		length = sqrt(sx * sx + sy * sy + sz * sz) or 1.0
+		sx /= length
+		sy /= length
+		sz /= length
+		# Real up = side x forward
+		ux = sy * fz - sz * fy
+		uy = sz * fx - sx * fz
+		uz = sx * fy - sy * fx
+		
+		rows = ((sx, sy, sz, -(sx * pos.x + sy * pos.y + sz * pos.z)),
+				(ux, uy, uz, -(ux * pos.x + uy * pos.y + uz * pos.z)),
+				(-fx, -fy, -fz, fx * pos.x + fy * pos.y + fz * pos.z))
+		matrix = self.view_matrix
+		for row in range(3):
+			for column in range(4):
+				matrix[column * 4 + row] = rows[row][column]
+		matrix[3] = matrix[7] = matrix[11] = 0.0
+		matrix[15] = 1.0
+		
+		# Clip space rows of projection * view, for the frustum planes
+		self.aspect = Interface.aspect
+		f = self.focal = 1.0 / tan(radians(Interface.PERSPECTIVE_FOV) / 2.0)
+		near = Interface.PERSPECTIVE_NEAR
+		far = Interface.PERSPECTIVE_FAR
+		depth_scale = (far + near) / (near - far)
+		depth_offset = 2.0 * far * near / (near - far)
+		x = [value * f / self.aspect for value in rows[0]]
+		y = [value * f for value in rows[1]]
+		z = [value * depth_scale for value in rows[2]]
+		z[3] += depth_offset
+		w = [-value for value in rows[2]]
+		for plane, (row, sign) in zip(self.frustum, ((x, 1), (x, -1), (y, 1), \
+									  (y, -1), (z, 1), (z, -1))):
+			for i in range(4):
+				plane[i] = w[i] + sign * row[i]
+			length = sqrt(plane[0] * plane[0] + plane[1] * plane[1] + plane[2] * plane[2]) or 1.0
+			for i in range(4):
+				plane[i] /= length
+		self.changed = False
+
+	def to_view(self, x, y, z):
+		"""
+		Return the position of the point x, y, z relative to the camera, with
+		x to the right, y up and -z forward.
+		"""
+		m = self.get_view_matrix()
+		return (m[0] * x + m[4] * y + m[8] * z + m[12],
+				m[1] * x + m[5] * y + m[9] * z + m[13],
+				m[2] * x + m[6] * y + m[10] * z + m[14])
+
+	def to_screen(self, x, y, z):
+		"""
+		Return where the point x, y, z is on screen, from -1 to 1 across
+		and up the window, and its distance in front of the camera. Points
+		behind the camera have a distance <= 0 and no meaningful position.
+		"""
+		vx, vy, vz = self.to_view(x, y, z)
+		if vz >= 0:
+			return (0.0, 0.0, -vz)
+		scale = self.focal / -vz
+		return (vx * scale / self.aspect, vy * scale, -vz)
+
+	def in_frustum(self, x, y, z, radius = 0.0):
+		"""
+		Return whether a sphere at x, y, z can be seen by the camera.
+		"""
+		self.get_view_matrix()
+		for a, b, c, d in self.frustum:
+			if a * x + b * y + c * z + d < -radius:
+				return False
+		return True
 
 	def draw(self):
-		gluLookAt(self.pos.x, self.pos.y, self.pos.z, \
-				self.lookat.x, self.lookat.y, self.lookat.z, \
-				self.up.x, self.up.y, self.up.z)
+		glLoadMatrixf(self.get_view_matrix())
 #-------------------------------------------------------------------------------
 class CubeCamera(Camera3d):
 	"""
@@ -173,12 +427,16 @@ class CubeCamera(Camera3d):
 		# Divided in half for calculations for gluLookAt
 		self.cube_size = cube_size / 2.0
 		# Make a copy so we don't change the references
-		self.posp = deepcopy(self.POSITION_ARRAY[pos])
-		self.upp = deepcopy(self.FACE_ARRAY[up])
+		position = self.POSITION_ARRAY[pos]
+		face = self.FACE_ARRAY[up]
+		self.posp = PolarVector3d(position.rho, position.theta, position.phi)
+		self.upp = PolarVector3d(face.rho, face.theta, face.phi)
 		# Set the current distance to the zoom we are passed
 		self.posp.rho = zoom
 		# Initialize Point3d variables to represent position, lookat, and up
 		Camera3d.__init__(self, self.posp.get_xyz(), self.get_lookat(), self.upp.get_xyz())
+		# The rotation being animated, see get_transition
+		self.transition = None
 		# Animation time values, both [current time, total]
 		self.rotate_time = [0.0, 0.0]
 		self.zoom_time = [0.0, 0.0]
@@ -196,16 +454,22 @@ class CubeCamera(Camera3d):
 
 	"""
 	Return a vector, or Point3d class, of the lookat value on the current
-		face of the cube level.
+		face of the cube level. If point is given it is set and returned
+		instead of creating a new one.
 	"""
-	def get_lookat(self):
+	def get_lookat(self, point = None):
+		if point is None:
+			point = Point3d(0.0, 0.0, 0.0)
 		if self.cube_size > 0:
-			self.upp.rho *= self.cube_size
-			retval = self.upp.get_xyz()
-			self.upp.rho /= self.cube_size
+			self.upp.get_xyz(point)
+			point.x *= self.cube_size
+			point.y *= self.cube_size
+			point.z *= self.cube_size
 		else:
-			retval = Point3d(0.0, 0.0, 0.0)
-		return retval
+			point.x = 0.0
+			point.y = 0.0
+			point.z = 0.0
+		return point
 
 	"""
 	Initialize a zoom for the camera. Camera will zoom to new_rho in given time.
@@ -320,6 +584,9 @@ class CubeCamera(Camera3d):
 		self.acceleration[1].theta = self.FACE_ARRAY[self.up_vectors[1]].theta - self.upp.theta
 		self.acceleration[1].phi = self.FACE_ARRAY[self.up_vectors[1]].phi - self.upp.phi
 
+		# The precomputed animation for this rotation
+		self.transition = self.get_transition(curr_up, new_up, curr_pos, new_pos)
+
 	"""
 	Simple blow-back animation that can be used for big explosions, etc
 	"""
@@ -345,11 +612,27 @@ class CubeCamera(Camera3d):
 			self.zoom_step()
 		if self.animated[2]:
 			self.shake_step()
-		if True in self.animated:
-			# Regenerate position, up, and lookat Point3d vectors
-			self.pos = self.posp.get_xyz()
-			self.up = self.upp.get_xyz()
-			self.lookat = self.get_lookat()
+		if self.animated[0] or self.animated[1] or self.animated[2]:
+			# Regenerate position, up, and lookat Point3d vectors in place
+			self.posp.get_xyz(self.pos)
+			self.upp.get_xyz(self.up)
+			self.get_lookat(self.lookat)
+			self.changed = True
+
+	"""
+	Return the precomputed rotation from face up0 and position pos0 to face
+		up1 and position pos1, computing it the first time it is used. A
+		rotation is the camera's pose sampled along the easing curve, which
+		position angles are animated, and the final pose.
+	"""
+	def get_transition(self, up0, up1, pos0, pos1):
+		key = (up0, up1, pos0, pos1)
+		transition = self.TRANSITIONS.get(key)
+		if transition is None:
+			transition = make_transition(self.FACE_ARRAY, self.POSITION_ARRAY,
+										 self.POSITION_INDEX, up0, up1, pos0, pos1)
+			self.TRANSITIONS[key] = transition
+		return transition
 
 	"""
 	Called if rotating animation is set to True. Advances the camera position
@@ -357,73 +640,27 @@ class CubeCamera(Camera3d):
 	"""
 	def rotate_step(self):
 		self.rotate_time[0] += Interface.tdiff
-		if self.rotate_time[0] <= self.rotate_time[1]:
-			# Do not ask where I came up with this function; I pulled it out
-			# of my ass one morning, to be honest, and still wonder why it
-			# just "hit me" out of the blue.
-			# This is no attempt to be a physically correct simulation of motion,
-			# as a correct simulation was used before but didn't yield as nice
-			# results.
-			tmpvar = 3.0 * pi * self.rotate_time[0] / self.rotate_time[1]
-			sintmpvar = sin(tmpvar)
-			# This function oscillates between about [0, 1.1215) (from outputs
-			# I have seen, it could be slightly higher in reality)
-			percent = 1 - (sintmpvar / tmpvar) + .1 * (sintmpvar)
-
-			# This is the easy part. Set the up angles to the percent they should be at.
-			self.upp.theta = (self.FACE_ARRAY[self.up_vectors[1]].theta - self.FACE_ARRAY[self.up_vectors[0]].theta) * percent + self.FACE_ARRAY[self.up_vectors[0]].theta
-			self.upp.phi = (self.FACE_ARRAY[self.up_vectors[1]].phi - self.FACE_ARRAY[self.up_vectors[0]].phi) * percent + self.FACE_ARRAY[self.up_vectors[0]].phi
-
-			# Now for the ugly
-			# If both values are changing, the camera is rotating on a non-nice axis
-			if self.acceleration[0].theta != 0.0 and self.acceleration[0].phi != 0.0:
-				# In this case, the rotation is in the first and third quadrants (I do not remember)
-				# These could probably use updating to make use of the percent we got earlier
-				if self.POSITION_ARRAY[self.pos_vectors[0]].phi != self.FACE_ARRAY[self.up_vectors[0]].phi:
-					self.posp.theta = sin(fabs(self.upp.phi - self.FACE_ARRAY[self.up_vectors[0]].phi)) * (self.POSITION_ARRAY[self.pos_vectors[1]].theta - self.POSITION_ARRAY[self.pos_vectors[0]].theta) + self.POSITION_ARRAY[self.pos_vectors[0]].theta
-					self.posp.phi = (1 - cos(fabs(self.upp.phi - self.FACE_ARRAY[self.up_vectors[0]].phi))) * (self.POSITION_ARRAY[self.pos_vectors[1]].phi - self.POSITION_ARRAY[self.pos_vectors[0]].phi) + self.POSITION_ARRAY[self.pos_vectors[0]].phi
-				# Second and fourth quadrants, I believe
-				else:
-					self.posp.theta = (1 - cos(fabs(self.upp.phi - self.FACE_ARRAY[self.up_vectors[0]].phi))) * (self.POSITION_ARRAY[self.pos_vectors[1]].theta - self.POSITION_ARRAY[self.pos_vectors[0]].theta) + self.POSITION_ARRAY[self.pos_vectors[0]].theta
-					self.posp.phi = sin(fabs(self.upp.phi - self.FACE_ARRAY[self.up_vectors[0]].phi)) * (self.POSITION_ARRAY[self.pos_vectors[1]].phi - self.POSITION_ARRAY[self.pos_vectors[0]].phi) + self.POSITION_ARRAY[self.pos_vectors[0]].phi
-			# Back to the easier work, now the camera is moving on only a single axis
-			elif self.acceleration[0].theta != 0.0:
-				# Set the theta, if it is the one moving, to the percent it should be at
-				self.posp.theta = percent * (self.POSITION_ARRAY[self.pos_vectors[1]].theta - self.POSITION_ARRAY[self.pos_vectors[0]].theta) + self.POSITION_ARRAY[self.pos_vectors[0]].theta
-			else:
-				# Set the phi, if it is the one moving, to the percent it should be at
-				self.posp.phi = percent * (self.POSITION_ARRAY[self.pos_vectors[1]].phi - self.POSITION_ARRAY[self.pos_vectors[0]].phi) + self.POSITION_ARRAY[self.pos_vectors[0]].phi
-
-			# A bit of "normalizing"
-			self.posp.theta %= 2.0 * pi
-			self.posp.phi %= 2.0 * pi
-			self.upp.theta %= 2.0 * pi
-			self.upp.phi %= 2.0 * pi
+		if self.rotate_time[0] < self.rotate_time[1]:
+			table, axes, final = self.transition
+			index = self.rotate_time[0] / self.rotate_time[1] * (CAMERA_EASING_SAMPLES - 1)
+			sample = int(index)
+			fraction = index - sample
+			sample *= 4
+			next = sample + 4
+			self.upp.theta = (table[sample + 2] + (table[next + 2] - table[sample + 2]) * fraction) % twopi
+			self.upp.phi = table[sample + 3] + (table[next + 3] - table[sample + 3]) * fraction
+			if axes != ROTATE_PHI:
+				self.posp.theta = (table[sample] + (table[next] - table[sample]) * fraction) % twopi
+			if axes != ROTATE_THETA:
+				self.posp.phi = (table[sample + 1] + (table[next + 1] - table[sample + 1]) * fraction) % twopi
 		else:
-			# Set the final values
-			self.posp = deepcopy(self.POSITION_ARRAY[self.pos_vectors[1]])
-			self.upp = deepcopy(self.FACE_ARRAY[self.up_vectors[1]])
-			# More "normalizing", including limiting theta to [0, 2 * pi) and
-			# phi to [0, pi]
-			self.upp.phi %= twopi
-			self.posp.phi %= twopi
-			if self.upp.phi > pi:
-				self.upp.theta += pi
-				self.upp.phi = pi - (self.upp.phi % pi)
-			if self.posp.phi > pi:
-				self.posp.theta += pi
-				self.posp.phi = pi - (self.posp.phi % pi)
-			self.posp.theta %= twopi
-			self.upp.theta %= twopi
-
-			# Reverse lookup, necessary because of the multiple values
-			# for a single position
-			for p in range(len(self.POSITION_ARRAY)):
-				if self.posp.equals(self.POSITION_ARRAY[p]):
-					self.pos_vectors[1] = p
-					break
+			# Set the final values, already "normalized" to theta in
+			# [0, 2 * pi) and phi in [0, pi] and looked up in POSITION_ARRAY
+			self.posp.theta, self.posp.phi, self.upp.theta, self.upp.phi, \
+				self.pos_vectors[1] = self.transition[2]
 
-			self.rotate_time = [0.0, 0.0]
+			self.rotate_time[0] = 0.0
+			self.rotate_time[1] = 0.0
 			for i in self.acceleration:
 				i.theta = 0.0
 				i.phi = 0.0
@@ -438,18 +675,15 @@ class CubeCamera(Camera3d):
 	"""
 	def zoom_step(self):
 		self.zoom_time[0] += Interface.tdiff
-		if self.zoom_time[0] <= self.zoom_time[1]:
-			# As above, don't ask where I dreamed this equation up. It works
-			# and it looks nice for relatively quick animations.
-			tmpvar = 3.0 * pi * self.zoom_time[0] / self.zoom_time[1]
-			sintmpvar = sin(tmpvar)
-			percent = 1 - (sintmpvar / tmpvar) + .1 * (sintmpvar)
+		if self.zoom_time[0] < self.zoom_time[1]:
+			percent = sample_table(EASING_TABLE, self.zoom_time[0] / self.zoom_time[1])
 			self.posp.rho = percent * (self.zooms[1] - self.zooms[0]) + self.zooms[0]
 		else:
 			# No longer animating, so set the final values and reset the
 			# animation values
 			self.posp.rho = self.zooms[1]
-			self.zoom_time = [0.0, 0.0]
+			self.zoom_time[0] = 0.0
+			self.zoom_time[1] = 0.0
 			self.acceleration[0].rho = 0.0
 			self.animated[1] = False
 			if len(self.queue[1]) > 0:
@@ -465,19 +699,20 @@ class CubeCamera(Camera3d):
 		if self.animated[1]:
 			# If the camera is zooming, the initial position changes
 			self.shakes[0] = self.posp.rho
-		if self.shake_time[0] <= self.shake_time[1]:
-			# More voodoo, just that this time the function is used with
-			# with an offset to increase, then decrease
-			func = self.shake_time[0] / self.shake_time[1] * fourpi - pi
-			percent = sin(func) / func
-
+		if self.shake_time[0] < self.shake_time[1]:
+			percent = sample_table(SHAKE_TABLE, self.shake_time[0] / self.shake_time[1])
 			self.posp.rho = self.shakes[0] * self.shakes[1] * percent + self.shakes[0]
 			self.cube_size = percent * self.shakes[2] * self.shakes[3] + self.shakes[2]
 		else:
-			self.shake_time = [0.0, 0.0]
+			self.shake_time[0] = 0.0
+			self.shake_time[1] = 0.0
 			self.posp.rho = self.shakes[0]
 			self.cube_size = self.shakes[2]
 			self.animated[2] = False
 			#if len(self.queue[2]) > 0:
 			#	self.shake(self.queue[2][0])
 			#	del self.queue[2][0]
+
+# Rotation and zoom transitions, from the camera's precomputed tables
+CubeCamera.POSITION_INDEX = make_position_index(CubeCamera.POSITION_ARRAY)
+CubeCamera.TRANSITIONS = {}
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""
+	Boom Client
+	===========
+		The client side of a networked match hosted by Boom.Server. The level
+		shown is driven by the snapshots the server sends rather than updated
+		locally. Remote players and bombs are drawn a little in the past,
+		interpolated between the two snapshots around that time, so they move
+		smoothly even though snapshots only arrive at the server's tick rate.
+		The local player is moved straight away from its input (predicted) and
+		corrected whenever a snapshot shows where the server put it.
+	
+		License
+		-------
+		Copyright (C) 2006 Daniel G. Taylor, Jason F. Kotenko, Jens Taylor
+
+		This program is free software; you can redistribute it and/or modify
+		it under the terms of the GNU General Public License as published by
+		the Free Software Foundation; either version 2 of the License, or
+		(at your option) any later version.
+
+		This program is distributed in the hope that it will be useful,
+		but WITHOUT ANY WARRANTY; without even the implied warranty of
+		MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+		GNU General Public License for more details.
+
+		You should have received a copy of the GNU General Public License
+		along with this program; if not, write to the Free Software
+		Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307 USA
+"""
+
+import Log
+import Interface
+import Objects
+import Network
+
+import socket
+
+from time import time
+
+# How far in the past (in seconds) remote objects are drawn; this should
+# cover at least two server ticks
+CLIENT_INTERPOLATION_DELAY = 0.1
+
+# How many snapshots to keep for interpolation
+CLIENT_INTERPOLATION_SNAPSHOTS = 32
+
+# How many inputs to remember for replaying after a correction
+CLIENT_MAX_INPUTS = 128
+
+# How many server ticks the local player can run in one frame before it
+# gives up catching up
+CLIENT_MAX_TICKS = 5
+
+#-------------------------------------------------------------------------------
+class InterpolationBuffer:
+	"""
+	Interpolation Buffer
+	====================
+		Keeps the latest snapshots along with the time each one arrived, and
+		moves objects to where they were delay seconds ago by interpolating
+		between the two snapshots around that time.
+	"""
+	def __init__(self, delay = CLIENT_INTERPOLATION_DELAY, size = CLIENT_INTERPOLATION_SNAPSHOTS):
+		self.delay = delay
+		self.size = size
+		self.snapshots = []
+	
+	def add(self, snapshot, now):
+		"""
+		Add a snapshot that arrived at time now.
+		"""
+		self.snapshots.append((now, snapshot))
+		if len(self.snapshots) > self.size:
+			del self.snapshots[0]
+	
+	def sample(self, now):
+		"""
+		Return the snapshots before and after now - delay and how far between
+		them that time is, or None if there aren't any snapshots yet.
+		"""
+		if not self.snapshots:
+			return None
+		when = now - self.delay
+		snapshots = self.snapshots
+		for pos in range(len(snapshots) - 1, -1, -1):
+			if snapshots[pos][0] <= when:
+				if pos == len(snapshots) - 1:
+					# Never extrapolate, just wait at the latest one
+					return (snapshots[pos][1], snapshots[pos][1], 0.0)
+				old_time, old = snapshots[pos]
+				new_time, new = snapshots[pos + 1]
+				return (old, new, (when - old_time) / (new_time - old_time))
+		return (snapshots[0][1], snapshots[0][1], 0.0)
+	
+	def apply(self, level, now, skip = None):
+		"""
+		Move the players (except the one with id skip) and bombs in level to
+		where they were delay seconds ago.
+		"""
+		sample = self.sample(now)
+		if sample is None:
+			return
+		old, new, fraction = sample
+		for player in level.players:
+			if player.id == skip:
+				continue
+			self.interpolate(player, old, new, old.players, new.players, fraction)
+		for item in level.items:
+			if item.type == "Bomb" and \
+			   self.interpolate(item, old, new, old.bombs, new.bombs, fraction):
+				size = Network.SNAPSHOT_SIZE_RANGE / ((1 << Network.SNAPSHOT_SIZE_BITS) - 1)
+				old_state = old.bombs.get(item.id)
+				new_state = new.bombs[item.id]
+				if old_state is not None and old_state[5] == new_state[5]:
+					item.current_size = (old_state[4] + (new_state[4] - old_state[4]) * fraction) * size
+	
+	def interpolate(self, object, old, new, old_states, new_states, fraction):
+		"""
+		Move an object between its positions in two snapshots. Returns False
+		if the newer snapshot doesn't have it.
+		"""
+		new_state = new_states.get(object.id)
+		if new_state is None:
+			return False
+		x, y = new.position(new_state)
+		old_state = old_states.get(object.id)
+		if old_state is not None:
+			old_x, old_y = old.position(old_state)
+			x = old_x + (x - old_x) * fraction
+			y = old_y + (y - old_y) * fraction
+		object.x = x
+		object.y = y
+		return True
+
+#-------------------------------------------------------------------------------
+class Client:
+	"""
+	Client
+	======
+		Plays in a match on a server. Call update once per frame with the
+		level being shown instead of updating the level. The local player
+		(level.player) is moved by its motion in steps of the server's tick,
+		sending one input per step just as the server applies them; every
+		input is remembered until a snapshot shows the server has applied it,
+		and the ones it hasn't are replayed on top of each snapshot's position
+		for the player. Between steps the player is drawn moved on by the
+		time into the next one.
+	"""
+	def __init__(self, server, match = 0, port = 0):
+		# Messages are matched to the server by address, so resolve its name
+		self.server = (socket.gethostbyname(server[0]), server[1])
+		self.match = match
+		self.network = Network.Network(port, "", False)
+		self.snapshots = Network.SnapshotClient()
+		self.interpolation = InterpolationBuffer()
+		self.player_id = None
+		self.sequence = 0
+		self.inputs = []
+		# Length of a server tick, the time into the next one and where the
+		# last one left the local player
+		self.step = None
+		self.time = 0.0
+		self.position = None
+		self.bomb = False
+		self.view = None
+		self.network.send(self.server, Network.Message(time(), 0,
+						  Network.NETWORK_MESSAGE_JOIN,
+						  Network.NETWORK_FLAG_RELIABLE, [match]))
+	
+	def lay_bomb(self):
+		"""
+		Ask the server to drop a bomb with the next input.
+		"""
+		self.bomb = True
+	
+	def leave(self):
+		"""
+		Leave the match.
+		"""
+		self.network.send(self.server, Network.Message(time(), 0,
+						  Network.NETWORK_MESSAGE_LEAVE,
+						  Network.NETWORK_FLAG_RELIABLE, [self.match]))
+		self.network.update()
+	
+	def update(self, level, camera = None):
+		"""
+		Exchange messages with the server and move everything in level to
+		where it should be drawn this frame. If the camera is given the
+		server is told what it can see, so it only sends what is relevant.
+		"""
+		now = time()
+		self.network.update()
+		latest = None
+		while True:
+			message = self.network.recv(self.server)
+			if message is None:
+				break
+			if message.mtype == Network.NETWORK_MESSAGE_WELCOME:
+				self.welcome(level, message.data[1], message.data[2])
+			elif message.mtype == Network.NETWORK_MESSAGE_SNAPSHOT:
+				if self.player_id is None:
+					continue
+				try:
+					snapshot = self.snapshots.receive(message.data)
+				except ValueError:
+					# The baseline is gone, the server will send a full one
+					continue
+				if snapshot is not None:
+					self.network.send(self.server, Network.Message(now, 0,
+									  Network.NETWORK_MESSAGE_ACK, 0, [snapshot.sequence]))
+					self.interpolation.add(snapshot, now)
+					latest = snapshot
+		if self.player_id is None or level.player is None:
+			return
+		if camera is not None:
+			self.send_view(camera)
+		
+		# Undo the part of a tick the player was moved on by last frame
+		player = level.player
+		if self.position is not None:
+			player.x, player.y = self.position
+		
+		# Send an input for each server tick this frame and remember it for
+		# replaying, as the server will see it
+		self.time = min(self.time + Interface.tdiff, CLIENT_MAX_TICKS * self.step)
+		ticks = 0
+		while self.time >= self.step:
+			self.time -= self.step
+			self.sequence = (self.sequence % Network.NETWORK_SEQUENCE_MASK) + 1
+			message = Network.input_message(self.sequence, player.motion.angle,
+											player.motion.moving, self.bomb)
+			self.network.send(self.server, message)
+			self.bomb = False
+			self.inputs.append(Network.read_input(message)[:3])
+			ticks += 1
+		if len(self.inputs) > CLIENT_MAX_INPUTS:
+			del self.inputs[:-CLIENT_MAX_INPUTS]
+		
+		if latest is not None:
+			self.reconcile(level, latest)
+		elif player.life and ticks:
+			self.replay(level, self.inputs[-ticks:])
+		self.position = (player.x, player.y)
+		if player.life and self.time:
+			self.replay(level, [(None, player.motion.angle, player.motion.moving)],
+						self.time)
+		
+		self.interpolation.apply(level, now, self.player_id)
+		self.network.update()
+	
+	def send_view(self, camera):
+		"""
+		Tell the server about a CubeCamera's view if it has changed.
+		"""
+		view = self.view
+		face = camera.up_vectors[1]
+		zoom = camera.posp.rho
+		if view is not None and view.face == face and view.zoom == zoom and \
+		   view.x == camera.lookat.x and view.y == camera.lookat.y:
+			return
+		self.view = Network.View(face, zoom, camera.lookat.x, camera.lookat.y)
+		self.network.send(self.server, self.view.message())
+	
+	def welcome(self, level, id, tick_rate):
+		"""
+		The server has added our player to the match.
+		"""
+		self.player_id = id
+		self.step = 1.0 / tick_rate
+		Log.info("Joined match %d as player %d", self.match, id)
+		if level.player is None:
+			level.player = Objects.Player()
+		level.player.id = id
+		if level.player not in level.players:
+			level.players.append(level.player)
+	
+	def reconcile(self, level, snapshot):
+		"""
+		Apply a snapshot, then replay the local player's inputs the server
+		hadn't seen yet when it was captured.
+		"""
+		player = level.player
+		angle = player.motion.angle
+		moving = player.motion.moving
+		snapshot.apply(level)
+		player.motion.angle = angle
+		player.motion.moving = moving
+		if player not in level.players:
+			# We're dead
+			return
+		
+		if snapshot.input is not None:
+			while self.inputs and not Network.sequence_newer(self.inputs[0][0], snapshot.input):
+				del self.inputs[0]
+		self.replay(level, self.inputs)
+	
+	def replay(self, level, inputs, tdiff = None):
+		"""
+		Move the local player by each of a list of (sequence, angle, moving)
+		inputs for tdiff seconds, a server tick by default.
+		"""
+		player = level.player
+		angle = player.motion.angle
+		moving = player.motion.moving
+		frame_tdiff = Interface.tdiff
+		if tdiff is None:
+			tdiff = self.step
+		Interface.tdiff = tdiff
+		for sequence, input_angle, input_moving in inputs:
+			player.motion.angle = input_angle
+			player.motion.moving = input_moving
+			Objects.GameObject.update(player, level)
+		Interface.tdiff = frame_tdiff
+		player.motion.angle = angle
+		player.motion.moving = moving
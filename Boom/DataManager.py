@@ -61,10 +61,12 @@ class OnDemandLoader:
 		else:
 			# Try to load the data!
 			if VirtualFS.exists(os.path.join(self.path, key)):
+				Log.trace.begin(Log.TRACE_ASSET, key)
 				self.load(key)
+				Log.trace.end(Log.TRACE_ASSET, key)
 				return self.data[key]
 			else:
-				Log.error("Failed to load " + os.path.join(self.path, key))
+				Log.error("Failed to load %s", os.path.join(self.path, key))
 				return None
 	
 	def __setitem__(self, key, value):
@@ -73,6 +75,17 @@ class OnDemandLoader:
 	
 	def load(self, file):
 		pass
+	
+	def preload(self, keys = None):
+		"""
+		Load a list of keys that are not loaded yet, or everything in our
+		path if no keys are given.
+		"""
+		if keys is None:
+			keys = VirtualFS.listdir(self.path) or []
+		for key in keys:
+			if key not in self.data and VirtualFS.exists(os.path.join(self.path, key)):
+				self.load(key)
 
 #-------------------------------------------------------------------------------
 class MeshLoader(OnDemandLoader):
@@ -91,7 +104,7 @@ class MeshLoader(OnDemandLoader):
 		Load a Mesh object into our data store.
 		"""
 		self.data[key] = Graphics.Mesh(os.path.join(self.path, key))
-		Log.info("Loading " + key)
+		Log.info("Loading %s", key)
 
 #-------------------------------------------------------------------------------
 class SoundLoader(OnDemandLoader):
@@ -107,9 +120,10 @@ class SoundLoader(OnDemandLoader):
 	
 	def load(self, key):
 		"""
-		Load a sound object into our data store.
+		Load a sound object into our data store. Sounds are decoded once, so
+		playing them again does not touch the disk.
 		"""
-		self.data[key] = Sound.manager.load(key)
+		self.data[key] = Sound.manager.load(os.path.join(self.path, key))
 
 #-------------------------------------------------------------------------------
 
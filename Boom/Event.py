@@ -76,6 +76,7 @@ def post(event, args = [], priority = PRIORITY_NORMAL):
 	"""
 	Post a new event to the internal event queue.
 	"""
+	Log.trace.record(Log.TRACE_EVENT, "post", Log.TRACE_INSTANT, event)
 	queue[priority].append([event, args])
 
 #-------------------------------------------------------------------------------
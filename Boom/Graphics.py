@@ -29,37 +29,61 @@
 import os, os.path, sys
 from math import sin, cos, sqrt, atan2, pi
 from copy import deepcopy
+from array import array
+import struct
+import heapq
 
 import Log
 Log.info("Initializing graphics subsystem...")
 
 import VirtualFS
+import Backend
 
-# OpenGL functions
-try:
-	from OpenGL.GL import *
-	from OpenGL.GLU import *
-	from OpenGL.GLUT import *
-except:
-	Log.critical("Can't import OpenGL bindings...")
-	Log.info("Please install them from http://pyopengl.sourceforge.net/")
-	sys.exit(1)
-
-# Python Imaging Library
-try:
-	import Image
-except:
-	Log.critical("Can't import Python Imaging Library...")
-	Log.info("Please install from ...")
-	sys.exit(1)
+if Backend.graphics == Backend.GRAPHICS_NULL:
+	# Draw nothing and load no textures, so neither library is needed
+	Log.info("Using null graphics backend")
+	from NullGL import *
+	Image = None
+else:
+	# OpenGL functions
+	try:
+		from OpenGL.GL import *
+		from OpenGL.GLU import *
+		from OpenGL.GLUT import *
+	except:
+		Log.critical("Can't import OpenGL bindings...")
+		Log.info("Please install them from http://pyopengl.sourceforge.net/")
+		sys.exit(1)
+	
+	# Python Imaging Library
+	try:
+		import Image
+	except:
+		Log.critical("Can't import Python Imaging Library...")
+		Log.info("Please install from ...")
+		sys.exit(1)
+
+# Navigation mesh vertices closer together than this are merged
+NAVIMESH_WELD_DISTANCE = 0.0001
+
+# How far in from the ends of the edge between two triangles paths are
+# costed as crossing it, see NaviMesh.find_corridor
+NAVIMESH_PORTAL_MARGIN = 0.05
+
+# Compiled navigation mesh file header: magic, version, vertex count and
+# triangle count
+NAVIMESH_HEADER = struct.Struct(">4sIII")
+NAVIMESH_MAGIC = "BNAV"
+NAVIMESH_VERSION = 1
 
 #-------------------------------------------------------------------------------
-class Point2d:
+class Point2d(object):
 	"""
 	Two-Dimensional Point
 	=====================
 		Stores a point in two-dimensional space. Coordinates can be accessed
-		through x and y members.
+		through x and y members. Points use slots instead of a per-instance
+		dictionary, so arbitrary attributes cannot be added to them.
 		
 		Usage example:
 		
@@ -69,6 +93,8 @@ class Point2d:
 			>>>> print test.x
 			0.2
 	"""
+	__slots__ = ["x", "y"]
+	
 	def __init__(self, x = 0, y = 0):
 		self.x = x
 		self.y = y
@@ -83,7 +109,7 @@ class Point2d:
 		return "[" + str(self.x) + ", " + str(self.y) + "]"
 
 #-------------------------------------------------------------------------------
-class Point3d:
+class Point3d(object):
 	"""
 	Three-Dimensional Point
 	=======================
@@ -98,6 +124,8 @@ class Point3d:
 			>>>> print test.z
 			7
 	"""
+	__slots__ = ["x", "y", "z"]
+	
 	def __init__(self, x = 0, y = 0, z = 0):
 		self.x = x
 		self.y = y
@@ -113,13 +141,15 @@ class Point3d:
 		return "[" + str(self.x) + ", " + str(self.y) + ", " + str(self.z) + "]"
 
 #-------------------------------------------------------------------------------
-class PolarVector2d:
+class PolarVector2d(object):
 	"""
 	Polar Two-dimensional Vector
 	================================
 		Stores a polar angle and radius in two-dimensional space. Can be accessed
 		through angle and radius members.
 	"""
+	__slots__ = ["angle", "radius"]
+	
 	def __init__(self, angle = 0, radius = 1.0):
 		self.angle = angle
 		self.radius = radius
@@ -131,24 +161,32 @@ class PolarVector2d:
 		return "[" + str(self.angle) + ", " + str(self.radius) + "]"
 
 #-------------------------------------------------------------------------------
-class PolarVector3d:
+class PolarVector3d(object):
 	"""
 	Polar Three-dimensional Vector
 	================================
 		Stores a three-dimensional vector.
 	"""
+	__slots__ = ["rho", "theta", "phi"]
+	
 	def __init__(self, rho = 1.0, theta = pi / 2.0, phi = pi / 2.0):
 		self.rho = rho
 		self.theta = theta
 		self.phi = phi
 
-	def get_xyz(self):
+	def get_xyz(self, point = None):
 		"""
-		Returns the x, y, and z equivilants of rho, theta, and phi
+		Returns the x, y, and z equivilants of rho, theta, and phi. If point
+		is given it is set and returned instead of creating a new one.
 		"""
-		return Point3d(self.rho * sin(self.phi) * cos(self.theta), \
-				self.rho * sin(self.phi) * sin(self.theta), \
-				self.rho * cos(self.phi))
+		if point is None:
+			return Point3d(self.rho * sin(self.phi) * cos(self.theta), \
+					self.rho * sin(self.phi) * sin(self.theta), \
+					self.rho * cos(self.phi))
+		point.x = self.rho * sin(self.phi) * cos(self.theta)
+		point.y = self.rho * sin(self.phi) * sin(self.theta)
+		point.z = self.rho * cos(self.phi)
+		return point
 
 	def equals(self, v):
 		"""
@@ -166,7 +204,7 @@ class PolarVector3d:
 		return "[" + str(self.rho) + ", " + str(self.theta) + ", " + str(self.phi) + "]"
 
 #-------------------------------------------------------------------------------
-class Color:
+class Color(object):
 	"""
 	Color Value
 	===========
@@ -180,6 +218,8 @@ class Color:
 			>>>> print test.red, test.alpha
 			0.5, 1.0
 	"""
+	__slots__ = ["red", "green", "blue", "alpha"]
+	
 	def __init__(self, red = 1.0, green = 1.0, blue = 1.0, alpha = 1.0):
 		self.red = red
 		self.green = green
@@ -192,7 +232,7 @@ class Color:
 		"""
 		return [self.red, self.green, self.blue, self.alpha]
 	
-	def ___repr___(self):
+	def __repr__(self):
 		"""
 		Represent the color as [red, green, blue, alpha]
 		"""
@@ -240,6 +280,8 @@ class Vertex2d(Point2d):
 		Stores information about a two dimensional vertex, such as its position,
 		normal vector, and texture (UV) coordinates.
 	"""
+	__slots__ = ["normal", "texture_coord"]
+	
 	def __init__(self, x = 0, y = 0):
 		Point2d.__init__(self, x, y)
 		self.normal = None
@@ -259,6 +301,8 @@ class Vertex3d(Point3d):
 		Stores information about a three dimensional vertex, such as its position,
 		normal vector, and texture (UV) coordinates.
 	"""
+	__slots__ = ["normal", "texture_coord"]
+	
 	def __init__(self, x = 0, y = 0, z = 0):
 		Point3d.__init__(self, x, y, z)
 		self.normal = None
@@ -270,6 +314,70 @@ class Vertex3d(Point3d):
 		"""
 		return Point3d.__repr__(self) + ", " + str(self.normal) + ", " + str(self.texture_coord)
 
+#-------------------------------------------------------------------------------
+class VertexArray(object):
+	"""
+	Vertex Array
+	============
+		Stores a list of vertices, normals, or texture coordinates in one
+		contiguous array of floats instead of one object per entry. The size
+		is the number of components per entry (e.g. 3 for x, y, z).
+
+		Usage example:
+
+			>>>> test = VertexArray(3)
+			>>>> test.append(1.0, 2.0, 3.0)
+			>>>> print len(test), test.get(0)
+			1 [1.0, 2.0, 3.0]
+			>>>> print test[0].z
+			3.0
+	"""
+	__slots__ = ["size", "data"]
+
+	def __init__(self, size = 3):
+		self.size = size
+		self.data = array("f")
+
+	def append(self, *values):
+		"""
+		Append a single entry made up of size components.
+		"""
+		self.data.extend(values)
+
+	def get(self, index):
+		"""
+		Return the components of an entry as a list, e.g. for glVertex3fv.
+		"""
+		start = index * self.size
+		return self.data[start:start + self.size].tolist()
+
+	def clear(self):
+		"""
+		Remove all entries.
+		"""
+		self.data = array("f")
+
+	def __len__(self):
+		return len(self.data) // self.size
+
+	def __getitem__(self, index):
+		"""
+		Return an entry as a new Point2d or Point3d object. Use get in places
+		where allocating a point is not needed.
+		"""
+		if index < 0:
+			index += len(self)
+		if index < 0 or index >= len(self):
+			raise IndexError, "vertex index out of range"
+		start = index * self.size
+		if self.size == 2:
+			return Point2d(self.data[start], self.data[start + 1])
+		return Point3d(self.data[start], self.data[start + 1], self.data[start + 2])
+
+	def __iter__(self):
+		for index in xrange(len(self)):
+			yield self[index]
+
 #-------------------------------------------------------------------------------
 class Polygon:
 	"""
@@ -288,7 +396,8 @@ class Mesh:
 	Mesh Object
 	===========
 		Stores data about a mesh, such as its vertices, normals, texture coordinates,
-		polygons, materials, etc.
+		polygons, materials, etc. Vertices, normals, and texture coordinates are
+		each kept in a single VertexArray.
 		
 		A display list is created using the mesh data when first rendered and used
 		from that point on to speed rendering.
@@ -303,9 +412,9 @@ class Mesh:
 		Clear all data in the mesh, including vertices, normals, polygons, materials,
 		texture coordinates, etc.
 		"""
-		self.vertices = []
-		self.normals = []
-		self.texture_coords = []
+		self.vertices = VertexArray(3)
+		self.normals = VertexArray(3)
+		self.texture_coords = VertexArray(2)
 		self.polygons = []
 		self.materials = {}
 		self.display_list = None
@@ -322,7 +431,7 @@ class Mesh:
 		# Default material to none until one is set
 		material = None
 		
-		Log.debug("Loading " + filename)
+		Log.debug("Loading %s", filename)
 		data = VirtualFS.open(filename).readlines()
 		dir, file = os.path.split(filename)
 		
@@ -334,16 +443,15 @@ class Mesh:
 			elif line[:2] == "vn":
 				# A vertex normal (x, y, z)
 				normals = line[3:].strip().split(" ")
-				self.normals.append([float(normals[0]), float(normals[1]), float(normals[2])])
+				self.normals.append(float(normals[0]), float(normals[1]), float(normals[2]))
 			elif line[:2] == "vt":
 				# A vertex texture coordinate (x, y)
 				tex = line[3:].strip().split(" ")
-				self.texture_coords.append([float(tex[0]), -float(tex[1])])
+				self.texture_coords.append(float(tex[0]), -float(tex[1]))
 			elif line[0] == "v":
 				# A vertex (x, y, z)
 				verts = line[2:].strip().split(" ")
-				x, y, z = float(verts[0]), float(verts[1]), float(verts[2])
-				self.vertices.append(Vertex3d(x, y, z))
+				self.vertices.append(float(verts[0]), float(verts[1]), float(verts[2]))
 			elif line[:6] == "usemtl":
 				# Set the current material
 				material = line[7:].strip()
@@ -370,26 +478,27 @@ class Mesh:
 							newpoly.vertices.append([int(parts[0]) - 1, int(parts[1]) - 1, int(parts[2]) - 1])
 				self.polygons.append(newpoly)
 		
-		Log.debug("Loaded " + str(len(self.vertices)) + " vertices.")
-		Log.debug("Loaded " + str(len(self.polygons)) + " polygons.")
+		Log.debug("Loaded %d vertices.", len(self.vertices))
+		Log.debug("Loaded %d polygons.", len(self.polygons))
 		
 		self.generate_convex_hull()
 	
 	def generate_convex_hull(self):
 		self.hull = convex_hull2d(self.vertices)
-		Log.debug("Hull generated with " + str(len(self.hull)) + " points")
+		Log.debug("Hull generated with %d points", len(self.hull))
 		
 		self.hull = optimize_hull2d(self.hull, 6)
-		Log.debug("Hull optimized to " + str(len(self.hull)) + " points")
+		Log.debug("Hull optimized to %d points", len(self.hull))
 		
 		self.hull.calc_center()
 		self.hull.calc_radius()
+		self.hull.calc_normals()
 
 	def load_materials(self, filename):
 		"""
 		Load a material library from an OBJ compatible MTL file.
 		"""
-		Log.debug("Loading " + filename)
+		Log.debug("Loading %s", filename)
 		data = VirtualFS.open(filename).readlines()
 		current = None
 		for line in data:
@@ -423,7 +532,7 @@ class Mesh:
 			elif line[:2] == "Ns":
 				# Set the material shininess
 				current.shininess = int(float(line[3:].strip()))
-			elif line[:6] == "map_Kd":
+			elif line[:6] == "map_Kd" and Image is not None:
 				# Create a new texture
 				data = Image.open(VirtualFS.open("Images/" + line[7:].strip()))
 				datastring = data.tostring()
@@ -441,7 +550,7 @@ class Mesh:
 		if current:
 			# Save the last material
 			self.materials[current.name] = current
-		Log.debug("Loaded " + str(len(self.materials)) + " materials.")
+		Log.debug("Loaded %d materials.", len(self.materials))
 	
 	def render(self):
 		"""
@@ -464,10 +573,10 @@ class Mesh:
 				glBegin(GL_POLYGON)
 				for vertex, texture, normal in poly.vertices:
 					if texture != None:
-						glTexCoord2fv(self.texture_coords[texture])
+						glTexCoord2fv(self.texture_coords.get(texture))
 					if normal != None:
-						glNormal3fv(self.normals[normal])
-					glVertex3fv(self.vertices[vertex].array())
+						glNormal3fv(self.normals.get(normal))
+					glVertex3fv(self.vertices.get(vertex))
 				glEnd()
 				glDisable(GL_TEXTURE_2D)
 				# Draw convex hull
@@ -483,41 +592,573 @@ class Mesh:
 			glEndList()
 			self.display_list = dlist
 
-#------------------------------------------------------------------------------
-class NaviMeshTriangle:
-	def __init__(self):
-		self.vertices = []
-		self.neighbors = []
-
 #-------------------------------------------------------------------------------
 class NaviMesh:
-	def __init__(self):
-		self.triangles = []
+	"""
+	Navigation Mesh
+	===============
+		The walkable area of a level, compiled from a mesh's polygons into
+		triangles that know their neighbors. A uniform grid over the mesh's
+		bounds lists the triangles overlapping each cell, so finding the
+		triangle under a point only tests the few triangles in one cell, and
+		segments are followed across the mesh from neighbor to neighbor.
+		
+		The compiled mesh is stored in flat arrays: vertices holds [x, y]
+		pairs, indices holds three vertex indexes per triangle, and neighbors
+		holds, for each triangle edge (v0-v1, v1-v2, v2-v0), the index of the
+		triangle on the other side of it or -1 if the edge is on the walkable
+		area's border. These can be written out with save and read back with
+		load to skip compiling the mesh when a level is loaded.
+		
+		Usage example:
+		
+			>>>> nav = NaviMesh(DataManager.meshes["level_navimesh.obj"])
+			>>>> print nav.walkable(1.0, 2.0)
+			True
+			>>>> print nav.raycast(0.0, 0.0, 50.0, 0.0)
+			0.25
+	"""
+	def __init__(self, mesh = None):
+		self.vertices = VertexArray(2)
+		self.indices = array("i")
+		self.neighbors = array("i")
+		self.centers = array("d")
+		self.grid = []
+		self.grid_x = 0.0
+		self.grid_y = 0.0
+		self.grid_size = 1.0
+		self.columns = 0
+		self.rows = 0
+		if mesh is not None:
+			self.generate(mesh)
+
+	def __len__(self):
+		"""
+		Return the number of triangles.
+		"""
+		return len(self.indices) // 3
 
 	def generate(self, mesh):
-		for polygon in mesh.polys:
-			tri = NaviMeshTriangle()
-			for vertex in polygon.vertices:
-				tri.vertices.append(mesh.vertices[vertex])
-			self.triangles.append(tri)
+		"""
+		Build the navigation mesh from the polygons of a Mesh. Polygons with
+		more than three vertices are split into triangle fans. Vertices closer
+		together than NAVIMESH_WELD_DISTANCE are merged first, since OBJ
+		exporters often duplicate them, and triangles left with no area are
+		dropped.
+		"""
+		self.vertices = VertexArray(2)
+		self.indices = array("i")
 		
-		for triangle in self.triangles:
-			for v1, v2 in [[triangle.vertices[0], triangle.vertices[1]], \
-						   [triangle.vertices[1], triangle.vertices[2]], \
-						   [triangle.vertices[2], triangle.vertices[0]]]:
-				for triangle2 in self.triangles:
-					if triangle is not triangle2:
-						if v1 in triangle2.vertices and v2 in triangle2.vertices:
-							triangle.neighbors.append(triangle2)
-	
-	
+		# Weld vertices that share a position
+		welded = {}
+		remap = array("i")
+		for vertex in mesh.vertices:
+			key = (int(round(vertex.x / NAVIMESH_WELD_DISTANCE)), \
+				   int(round(vertex.y / NAVIMESH_WELD_DISTANCE)))
+			if key not in welded:
+				welded[key] = len(self.vertices)
+				self.vertices.append(vertex.x, vertex.y)
+			remap.append(welded[key])
+		
+		for polygon in mesh.polygons:
+			indexes = [remap[vertex[0]] for vertex in polygon.vertices]
+			for pos in range(1, len(indexes) - 1):
+				v1, v2, v3 = indexes[0], indexes[pos], indexes[pos + 1]
+				if v1 != v2 and v2 != v3 and v3 != v1:
+					self.indices.extend((v1, v2, v3))
+		
+		self.build_neighbors()
+		self.build_centers()
+		self.build_grid()
+		Log.debug("Navigation mesh generated with %d triangles", len(self))
+
+	def build_neighbors(self):
+		"""
+		Link triangles that share an edge. Every edge is hashed by its two
+		vertex indexes, smallest first, so the two triangles on either side of
+		it end up under the same key. Edges shared by more than two triangles
+		only link the first two.
+		"""
+		indices = self.indices
+		self.neighbors = array("i", [-1]) * len(indices)
+		count = len(self.vertices)
+		edges = {}
+		for pos in xrange(len(indices)):
+			v1 = indices[pos]
+			v2 = indices[pos - pos % 3 + (pos + 1) % 3]
+			if v1 < v2:
+				key = v1 * count + v2
+			else:
+				key = v2 * count + v1
+			other = edges.get(key)
+			if other is None:
+				edges[key] = pos
+			elif other >= 0:
+				self.neighbors[pos] = other // 3
+				self.neighbors[other] = pos // 3
+				edges[key] = -1
+
+	def build_centers(self):
+		"""
+		Calculate the center of every triangle, stored as [x0, y0, x1, y1, ...]
+		in centers. These are the nodes find_corridor searches between.
+		"""
+		data = self.vertices.data
+		indices = self.indices
+		self.centers = array("d", [0.0]) * (len(self) * 2)
+		for index in xrange(len(self)):
+			v1 = indices[index * 3] * 2
+			v2 = indices[index * 3 + 1] * 2
+			v3 = indices[index * 3 + 2] * 2
+			self.centers[index * 2] = (data[v1] + data[v2] + data[v3]) / 3.0
+			self.centers[index * 2 + 1] = (data[v1 + 1] + data[v2 + 1] + data[v3 + 1]) / 3.0
+
+	def build_grid(self):
+		"""
+		Sort the triangles into grid cells by their bounding boxes. The cell
+		size is picked so there are about as many cells as triangles.
+		"""
+		self.grid = []
+		if len(self) == 0:
+			return
+		data = self.vertices.data
+		indices = self.indices
+		minx = maxx = data[0]
+		miny = maxy = data[1]
+		for pos in xrange(0, len(data), 2):
+			minx = min(minx, data[pos])
+			maxx = max(maxx, data[pos])
+			miny = min(miny, data[pos + 1])
+			maxy = max(maxy, data[pos + 1])
+		width = max(maxx - minx, 0.001)
+		height = max(maxy - miny, 0.001)
+		self.grid_size = sqrt(width * height / len(self))
+		self.grid_x = minx
+		self.grid_y = miny
+		self.columns = int(width / self.grid_size) + 1
+		self.rows = int(height / self.grid_size) + 1
+		self.grid = [[] for cell in xrange(self.columns * self.rows)]
+		
+		for index in xrange(len(self)):
+			xs = [data[v * 2] for v in indices[index * 3:index * 3 + 3]]
+			ys = [data[v * 2 + 1] for v in indices[index * 3:index * 3 + 3]]
+			left, bottom = self.cell(min(xs), min(ys))
+			right, top = self.cell(max(xs), max(ys))
+			for row in xrange(bottom, top + 1):
+				for column in xrange(left, right + 1):
+					self.grid[row * self.columns + column].append(index)
+
+	def save(self, file):
+		"""
+		Write the compiled navigation mesh to an open binary file. The grid is
+		not saved since it is quick to rebuild.
+		"""
+		file.write(NAVIMESH_HEADER.pack(NAVIMESH_MAGIC, NAVIMESH_VERSION, \
+										len(self.vertices), len(self)))
+		for data in (self.vertices.data, self.indices, self.neighbors):
+			if sys.byteorder == "little":
+				data = array(data.typecode, data)
+				data.byteswap()
+			file.write(data.tostring())
+
+	def load(self, file):
+		"""
+		Read a navigation mesh written by save from an open binary file.
+		"""
+		magic, version, vertices, triangles = \
+			NAVIMESH_HEADER.unpack(file.read(NAVIMESH_HEADER.size))
+		if magic != NAVIMESH_MAGIC or version != NAVIMESH_VERSION:
+			raise ValueError, "not a compiled navigation mesh"
+		self.vertices = VertexArray(2)
+		self.indices = array("i")
+		self.neighbors = array("i")
+		for data, count in ((self.vertices.data, vertices * 2), \
+							(self.indices, triangles * 3), \
+							(self.neighbors, triangles * 3)):
+			data.fromstring(file.read(count * data.itemsize))
+			if sys.byteorder == "little":
+				data.byteswap()
+		self.build_centers()
+		self.build_grid()
+		Log.debug("Navigation mesh loaded with %d triangles", len(self))
+
+	def cell(self, x, y):
+		"""
+		Return the column and row of the grid cell containing x, y, clamped
+		to the grid.
+		"""
+		column = int((x - self.grid_x) / self.grid_size)
+		row = int((y - self.grid_y) / self.grid_size)
+		return min(max(column, 0), self.columns - 1), min(max(row, 0), self.rows - 1)
+
+	def contains(self, index, x, y):
+		"""
+		Returns whether the point x, y lies inside (or on the edge of) the
+		triangle at index.
+		"""
+		data = self.vertices.data
+		indices = self.indices
+		v1 = indices[index * 3] * 2
+		v2 = indices[index * 3 + 1] * 2
+		v3 = indices[index * 3 + 2] * 2
+		x1 = data[v1]
+		y1 = data[v1 + 1]
+		x2 = data[v2]
+		y2 = data[v2 + 1]
+		x3 = data[v3]
+		y3 = data[v3 + 1]
+		c1 = (x2 - x1) * (y - y1) - (x - x1) * (y2 - y1)
+		c2 = (x3 - x2) * (y - y2) - (x - x2) * (y3 - y2)
+		c3 = (x1 - x3) * (y - y3) - (x - x3) * (y1 - y3)
+		return (c1 >= 0 and c2 >= 0 and c3 >= 0) or (c1 <= 0 and c2 <= 0 and c3 <= 0)
+
+	def find(self, x, y):
+		"""
+		Return the index of the triangle under the point x, y, or -1 if the
+		point is not on the navigation mesh.
+		"""
+		if not self.grid:
+			return -1
+		if x < self.grid_x or y < self.grid_y or \
+		   x > self.grid_x + self.columns * self.grid_size or \
+		   y > self.grid_y + self.rows * self.grid_size:
+			return -1
+		column, row = self.cell(x, y)
+		for index in self.grid[row * self.columns + column]:
+			if self.contains(index, x, y):
+				return index
+		return -1
+
+	def walkable(self, x, y):
+		"""
+		Returns whether the point x, y is on the navigation mesh.
+		"""
+		return self.find(x, y) != -1
+
+	def overlapping(self, minx, miny, maxx, maxy):
+		"""
+		Return the indexes of the triangles overlapping the box from minx,
+		miny to maxx, maxy. Only the triangles in the grid cells under the
+		box are tested, each against the box's sides and its own edges;
+		triangles that only touch the box's edges don't count.
+		"""
+		found = []
+		if not self.grid:
+			return found
+		data = self.vertices.data
+		indices = self.indices
+		corners = ((minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy))
+		left, bottom = self.cell(minx, miny)
+		right, top = self.cell(maxx, maxy)
+		tested = set()
+		for row in xrange(bottom, top + 1):
+			for column in xrange(left, right + 1):
+				for index in self.grid[row * self.columns + column]:
+					if index in tested:
+						continue
+					tested.add(index)
+					points = [(data[v * 2], data[v * 2 + 1]) \
+							  for v in indices[index * 3:index * 3 + 3]]
+					xs = [point[0] for point in points]
+					ys = [point[1] for point in points]
+					if min(xs) >= maxx or max(xs) <= minx or \
+					   min(ys) >= maxy or max(ys) <= miny:
+						continue
+					for edge in xrange(3):
+						x1, y1 = points[edge]
+						x2, y2 = points[(edge + 1) % 3]
+						x3, y3 = points[(edge + 2) % 3]
+						nx = y1 - y2
+						ny = x2 - x1
+						low = min(nx * x1 + ny * y1, nx * x3 + ny * y3)
+						high = max(nx * x1 + ny * y1, nx * x3 + ny * y3)
+						projections = [nx * x + ny * y for x, y in corners]
+						if min(projections) >= high or max(projections) <= low:
+							break
+					else:
+						found.append(index)
+		return found
+
+	def raycast(self, x1, y1, x2, y2, normal = None):
+		"""
+		Follow the segment from x1, y1 to x2, y2 across the navigation mesh.
+		Returns the fraction of the segment, from 0 to 1, at which it leaves
+		the walkable area, or 1 if it never does. If normal (a Point2d) is
+		given and the segment leaves the mesh, it is set to the normal of the
+		border edge that was crossed, facing back onto the mesh. Segments
+		that start off the mesh are never stopped, so anything outside of it
+		can get back on.
+		"""
+		current = self.find(x1, y1)
+		if current == -1:
+			return 1.0
+		data = self.vertices.data
+		indices = self.indices
+		neighbors = self.neighbors
+		dx = x2 - x1
+		dy = y2 - y1
+		previous = -1
+		for step in xrange(len(self)):
+			if self.contains(current, x2, y2):
+				return 1.0
+			# Find the edge the segment leaves this triangle through
+			base = current * 3
+			exit_edge = -1
+			exit_time = -1.0
+			for edge in range(3):
+				if previous != -1 and neighbors[base + edge] == previous:
+					continue
+				a = indices[base + edge] * 2
+				b = indices[base + (edge + 1) % 3] * 2
+				ax = data[a]
+				ay = data[a + 1]
+				ex = data[b] - ax
+				ey = data[b + 1] - ay
+				denom = dx * ey - dy * ex
+				if denom == 0:
+					continue
+				t = ((ax - x1) * ey - (ay - y1) * ex) / denom
+				u = ((ax - x1) * dy - (ay - y1) * dx) / denom
+				if u >= 0 and u <= 1 and t >= 0 and t > exit_time:
+					exit_edge = edge
+					exit_time = t
+			if exit_edge == -1:
+				return 1.0
+			neighbor = neighbors[base + exit_edge]
+			if neighbor == -1:
+				if normal is not None:
+					self.edge_normal(current, exit_edge, normal)
+				return min(exit_time, 1.0)
+			previous = current
+			current = neighbor
+		return 1.0
+
+	def find_corridor(self, start, goal, blocked = None, source = None, target = None):
+		"""
+		Find a short chain of neighboring triangles from the triangle at index
+		start to the one at index goal using A*. Source and target are the x,
+		y points the chain is walked between, the triangles' centers if not
+		given. Each triangle is entered where the line from the point the
+		last one was entered at towards target crosses the edge between
+		them, or the nearest end of that edge, and costs the distance between
+		those points. This is not always the shortest path, but it is close
+		enough for funnel to straighten. Triangles in blocked (a dictionary
+		or set of indexes) are avoided, except for start and goal themselves.
+		Returns the list of triangle indexes from start to goal, or None if
+		goal can't be reached.
+		"""
+		if start == -1 or goal == -1:
+			return None
+		if start == goal:
+			return [start]
+		centers = self.centers
+		neighbors = self.neighbors
+		if source is None:
+			source = (centers[start * 2], centers[start * 2 + 1])
+		if target is None:
+			target = (centers[goal * 2], centers[goal * 2 + 1])
+		goalx, goaly = target
+		costs = {start: 0.0}
+		entries = {start: source}
+		parents = {start: -1}
+		frontier = [(0.0, start)]
+		while frontier:
+			estimate, current = heapq.heappop(frontier)
+			if current == goal:
+				corridor = []
+				while current != -1:
+					corridor.append(current)
+					current = parents[current]
+				corridor.reverse()
+				return corridor
+			cost = costs[current]
+			x, y = entries[current]
+			if estimate > cost + sqrt((goalx - x) ** 2 + (goaly - y) ** 2) + 0.000001:
+				# A shorter way to this triangle was already handled
+				continue
+			for pos in xrange(current * 3, current * 3 + 3):
+				neighbor = neighbors[pos]
+				if neighbor == -1:
+					continue
+				if blocked and neighbor in blocked and neighbor != goal:
+					continue
+				entryx, entryy = self.entry(current, pos - current * 3, x, y, goalx, goaly)
+				new_cost = cost + sqrt((entryx - x) ** 2 + (entryy - y) ** 2)
+				if neighbor not in costs or new_cost < costs[neighbor]:
+					costs[neighbor] = new_cost
+					entries[neighbor] = (entryx, entryy)
+					parents[neighbor] = current
+					heapq.heappush(frontier, (new_cost + \
+						sqrt((goalx - entryx) ** 2 + (goaly - entryy) ** 2), neighbor))
+		return None
+
+	def entry(self, index, edge, x1, y1, x2, y2):
+		"""
+		Return the point where the line from x1, y1 towards x2, y2 crosses an
+		edge of the triangle at index, kept NAVIMESH_PORTAL_MARGIN in from
+		the edge's ends.
+		"""
+		data = self.vertices.data
+		base = index * 3
+		a = self.indices[base + edge] * 2
+		b = self.indices[base + (edge + 1) % 3] * 2
+		ax = data[a]
+		ay = data[a + 1]
+		ex = data[b] - ax
+		ey = data[b + 1] - ay
+		length = sqrt(ex * ex + ey * ey)
+		if length == 0:
+			return ax, ay
+		dx = x2 - x1
+		dy = y2 - y1
+		denominator = ex * dy - ey * dx
+		if denominator == 0:
+			# Parallel, so take the end closest to x1, y1
+			if (ax - x1) ** 2 + (ay - y1) ** 2 <= (data[b] - x1) ** 2 + (data[b + 1] - y1) ** 2:
+				t = 0.0
+			else:
+				t = 1.0
+		else:
+			t = ((x1 - ax) * dy - (y1 - ay) * dx) / denominator
+		# Stay a little way in from the ends, or walking around a vertex
+		# through the triangles that share it would cost nothing
+		margin = min(NAVIMESH_PORTAL_MARGIN / length, 0.5)
+		t = min(max(t, margin), 1.0 - margin)
+		return ax + ex * t, ay + ey * t
+
+	def portal(self, index, neighbor):
+		"""
+		Return the shared edge between the triangle at index and its neighbor
+		as ((leftx, lefty), (rightx, righty)), as seen when walking from the
+		triangle into its neighbor.
+		"""
+		data = self.vertices.data
+		indices = self.indices
+		base = index * 3
+		for edge in range(3):
+			if self.neighbors[base + edge] == neighbor:
+				break
+		a = indices[base + edge] * 2
+		b = indices[base + (edge + 1) % 3] * 2
+		c = indices[base + (edge + 2) % 3] * 2
+		left = (data[b], data[b + 1])
+		right = (data[a], data[a + 1])
+		# Walking out of a counterclockwise triangle the edge's end point is
+		# on the left, so swap them for clockwise triangles
+		if (data[b] - data[a]) * (data[c + 1] - data[a + 1]) - \
+		   (data[c] - data[a]) * (data[b + 1] - data[a + 1]) < 0:
+			left, right = right, left
+		return left, right
+
+	def funnel(self, corridor, x1, y1, x2, y2):
+		"""
+		Straighten a corridor from find_corridor into the shortest path from
+		x1, y1 to x2, y2 through it using the funnel algorithm. Returns the
+		list of Point2d waypoints to walk to, ending with x2, y2.
+		"""
+		start = (x1, y1)
+		goal = (x2, y2)
+		portals = [(start, start)]
+		for pos in range(len(corridor) - 1):
+			portals.append(self.portal(corridor[pos], corridor[pos + 1]))
+		portals.append((goal, goal))
+		
+		def cross(a, b, c):
+			return (b[0] - a[0]) * (c[1] - a[1]) - (c[0] - a[0]) * (b[1] - a[1])
+		
+		corners = [start]
+		apex = left = right = start
+		apex_index = left_index = right_index = 0
+		pos = 1
+		while pos < len(portals):
+			new_left, new_right = portals[pos]
+			
+			# Try to narrow the funnel from the right. Points that are already
+			# a side of the funnel are skipped, since the start can lie right
+			# on a portal and make the funnel a straight line.
+			if apex == right or (new_right != right and cross(apex, right, new_right) >= 0):
+				if apex == right or cross(apex, left, new_right) < 0:
+					right = new_right
+					right_index = pos
+				else:
+					# The right side crossed over the left, so the left point
+					# is a corner of the path
+					if left != corners[-1]:
+						corners.append(left)
+					apex = left
+					apex_index = left_index
+					right = apex
+					right_index = apex_index
+					pos = apex_index + 1
+					continue
+			
+			# Try to narrow the funnel from the left
+			if apex == left or (new_left != left and cross(apex, left, new_left) <= 0):
+				if apex == left or cross(apex, right, new_left) > 0:
+					left = new_left
+					left_index = pos
+				else:
+					if right != corners[-1]:
+						corners.append(right)
+					apex = right
+					apex_index = right_index
+					left = apex
+					left_index = apex_index
+					pos = apex_index + 1
+					continue
+			pos += 1
+		
+		if goal != corners[-1]:
+			corners.append(goal)
+		return [Point2d(x, y) for x, y in corners[1:]]
+
+	def find_path(self, x1, y1, x2, y2, blocked = None):
+		"""
+		Find a short walkable path from x1, y1 to x2, y2, see find_corridor.
+		Returns a list of Point2d waypoints ending with x2, y2, or None if
+		either point is off the navigation mesh or there is no way between
+		them.
+		"""
+		corridor = self.find_corridor(self.find(x1, y1), self.find(x2, y2),
+									  blocked, (x1, y1), (x2, y2))
+		if corridor is None:
+			return None
+		return self.funnel(corridor, x1, y1, x2, y2)
+
+	def edge_normal(self, index, edge, normal):
+		"""
+		Set normal (a Point2d) to the unit normal of an edge of the triangle
+		at index, facing into the triangle.
+		"""
+		data = self.vertices.data
+		base = index * 3
+		a = self.indices[base + edge] * 2
+		b = self.indices[base + (edge + 1) % 3] * 2
+		c = self.indices[base + (edge + 2) % 3] * 2
+		ax = data[a]
+		ay = data[a + 1]
+		ex = data[b] - ax
+		ey = data[b + 1] - ay
+		length = sqrt(ex * ex + ey * ey)
+		nx = -ey / length
+		ny = ex / length
+		# The third vertex is always on the inside
+		if (data[c] - ax) * nx + (data[c + 1] - ay) * ny < 0:
+			nx = -nx
+			ny = -ny
+		normal.x = nx
+		normal.y = ny
 
 #-------------------------------------------------------------------------------
 class Hull2d(list):
+	__slots__ = ["center", "radius", "normals", "extents"]
+	
 	def __init__(self):
 		list.__init__(self)
 		self.center = None
 		self.radius = None
+		self.normals = None
+		self.extents = None
 	
 	def calc_center(self):
 		self.center = Point2d(0, 0)
@@ -538,6 +1179,36 @@ class Hull2d(list):
 			if dist > max_dist:
 				max_dist = dist
 		self.radius = sqrt(max_dist)
+	
+	def calc_normals(self):
+		"""
+		Calculate the unit normal of every edge, stored as [x0, y0, x1, y1, ...]
+		in normals, and the hull's own [min, max] projection onto each of them
+		in extents. These are the axes used by sat_collision2d. Edges of zero
+		length, which optimize_hull2d can leave behind, are skipped.
+		"""
+		self.normals = array("d")
+		self.extents = array("d")
+		count = len(self)
+		for pos in range(count):
+			v1 = self[pos]
+			v2 = self[(pos + 1) % count]
+			dx = v2.x - v1.x
+			dy = v2.y - v1.y
+			length = sqrt(dx * dx + dy * dy)
+			if length == 0:
+				continue
+			nx = dy / length
+			ny = -dx / length
+			low = high = v1.x * nx + v1.y * ny
+			for vertex in self:
+				d = vertex.x * nx + vertex.y * ny
+				if d < low:
+					low = d
+				elif d > high:
+					high = d
+			self.normals.extend((nx, ny))
+			self.extents.extend((low, high))
 
 #-------------------------------------------------------------------------------
 """
@@ -583,128 +1254,323 @@ def line_intersection2d(p1, p2, offset1, p3, p4, offset2):
 """
 
 #-------------------------------------------------------------------------------
-def line_intersection2d(p1, p2, offset1, p3, p4, offset2):
-	# Calculate offset points
-	x1 = p1.x + offset1.x
-	y1 = p1.y + offset1.y
-	x2 = p2.x + offset1.x
-	y2 = p2.y + offset1.y
-	x3 = p3.x + offset2.x
-	y3 = p3.y + offset2.y
-	x4 = p4.x + offset2.x
-	y4 = p4.y + offset2.y
-	
-	# Calculate Ax + By = C for the first line
-	A1 = y2 - y1
-	B1 = x1 - x2
-	C1 = A1 * x1 + B1 * y1
-	
-	# Calculate Ax + By = C for the second line
-	A2 = y4 - y3
-	B2 = x3 - x4
-	C2 = A2 * x3 + B2 * y3
-	
-	# Calculate the determinant
-	det = A1 * B2 - A2 * B1
-	
-	if det == 0:
-		# The lines are parallel
-		if A1 == A2 and B1 == B2 and C1 == C2:
-			# The line segments lie on the same line, so now check if one point on the
-			# second line lies within the two points on the first line
-			if x1 < x2:
-				return (x3 >= x1 and x3 <= x2) or (x4 >= x1 and x4 <= x2)
-			else:
-				return (x3 >= x2 and x3 <= x1) or (x4 >= x2 and x4 <= x1)
-		else:
+class WorldHull2d(object):
+	"""
+	World-Space Hull
+	================
+		A Hull2d translated to an object's position. The translated vertices
+		are kept in a preallocated array of [x0, y0, x1, y1, ...] and are only
+		rewritten when the object moves, so collision tests can use them
+		directly without adding offsets for every pair of points.
+	"""
+	__slots__ = ["hull", "points", "x", "y", "center_x", "center_y", "radius"]
+	
+	def __init__(self, hull, x = 0.0, y = 0.0):
+		if hull.normals is None:
+			hull.calc_normals()
+		self.hull = hull
+		self.points = array("d", [0.0]) * (len(hull) * 2)
+		self.radius = hull.radius
+		self.x = None
+		self.y = None
+		self.move(x, y)
+	
+	def move(self, x, y):
+		"""
+		Translate the hull to the position x, y.
+		"""
+		if x == self.x and y == self.y:
+			return
+		self.x = x
+		self.y = y
+		self.center_x = self.hull.center.x + x
+		self.center_y = self.hull.center.y + y
+		points = self.points
+		pos = 0
+		for vertex in self.hull:
+			points[pos] = vertex.x + x
+			points[pos + 1] = vertex.y + y
+			pos += 2
+	
+	def __len__(self):
+		return len(self.hull)
+
+#-------------------------------------------------------------------------------
+def segment_intersection2d(x1, y1, x2, y2, x3, y3, x4, y4):
+	"""
+	Returns whether the line segment (x1, y1)-(x2, y2) intersects the line
+	segment (x3, y3)-(x4, y4). No divisions are needed.
+	"""
+	dx1 = x2 - x1
+	dy1 = y2 - y1
+	dx2 = x4 - x3
+	dy2 = y4 - y3
+	ox = x3 - x1
+	oy = y3 - y1
+	
+	# Both parameters along the segments are num / denom, which must lie in
+	# [0, 1] for the segments to touch
+	denom = dx1 * dy2 - dy1 * dx2
+	num1 = ox * dy2 - oy * dx2
+	num2 = ox * dy1 - oy * dx1
+	
+	if denom == 0:
+		# The lines are parallel, so they only touch if they are the same line
+		# and the segments overlap
+		if num1 != 0 or num2 != 0:
 			return False
-	else:
-		# Get the point of intersection
-		x = (B2 * C1 - B1 * C2) / det
-		y = (A1 * C2 - A2 * C1) / det
-		# Check to see if the point of intersection lies on both lines
-		if x1 < x2:
-			if x3 < x4:
-				return x >= x1 and x <= x2 and x >= x3 and x <= x4
-			else:
-				return x >= x1 and x <= x2 and x >= x4 and x <= x3
-		else:
-			if x3 < x4:
-				return x >= x2 and x <= x1 and x >= x3 and x <= x4
-			else:
-				return x >= x2 and x <= x1 and x >= x4 and x <= x3
+		if dx1 != 0:
+			return not (max(x3, x4) < min(x1, x2) or min(x3, x4) > max(x1, x2))
+		return not (max(y3, y4) < min(y1, y2) or min(y3, y4) > max(y1, y2))
+	
+	if denom < 0:
+		denom = -denom
+		num1 = -num1
+		num2 = -num2
+	return num1 >= 0 and num1 <= denom and num2 >= 0 and num2 <= denom
 
 #-------------------------------------------------------------------------------
-def hull_collision2d(hull1, offset1, hull2, offset2):
-	# Setup point lists
-	dist1 = []
-	dist2 = []
-	
-	# Store center and radius for convenience and to keep from calling the
-	# Hull2d's property functions repeatedly
-	center1 = hull1.center
-	center2 = hull2.center
-	radius1 = hull1.radius * hull1.radius
-	radius2 = hull2.radius * hull2.radius
-	
-	# Find all points in hull1 that lie within the radius of hull2
-	for pos in range(len(hull1)):
-		vertex = hull1[pos]
-		dx = (vertex.x + offset1.x) - (center2.x + offset2.x)
-		dy = (vertex.y + offset1.y) - (center2.y + offset2.y)
-		d = dx * dx + dy * dy
-		if d <= radius2:
-			dist1.append(pos)
-	# Add the point before the first and after the last so we use them when
-	# making lines to test
-	if len(dist1) == 0:
+def line_intersection2d(p1, p2, offset1, p3, p4, offset2):
+	return segment_intersection2d(p1.x + offset1.x, p1.y + offset1.y, \
+								  p2.x + offset1.x, p2.y + offset1.y, \
+								  p3.x + offset2.x, p3.y + offset2.y, \
+								  p4.x + offset2.x, p4.y + offset2.y)
+
+#-------------------------------------------------------------------------------
+# Scratch buffers for world_hull_collision2d, reused between calls so that
+# testing a pair of hulls does not create any lists. They grow if a hull
+# with more points than they can hold is ever tested.
+_near1 = array("b", [0]) * 16
+_near2 = array("b", [0]) * 16
+
+def _mark_near(world, center_x, center_y, radius, near):
+	"""
+	Flag every point of a world-space hull that lies within radius of a
+	center point. Returns the number of points flagged.
+	"""
+	points = world.points
+	radius = radius * radius
+	count = 0
+	for pos in xrange(len(world)):
+		dx = points[pos * 2] - center_x
+		dy = points[pos * 2 + 1] - center_y
+		if dx * dx + dy * dy <= radius:
+			near[pos] = 1
+			count += 1
+		else:
+			near[pos] = 0
+	return count
+
+def world_hull_collision2d(world1, world2):
+	"""
+	Returns whether two world-space hulls collide. Only the edges with at
+	least one point inside the other hull's bounding radius are tested
+	against each other.
+	"""
+	global _near1, _near2
+	
+	len1 = len(world1)
+	len2 = len(world2)
+	if len1 > len(_near1):
+		_near1 = array("b", [0]) * len1
+	if len2 > len(_near2):
+		_near2 = array("b", [0]) * len2
+	near1 = _near1
+	near2 = _near2
+	
+	# Find all points in each hull that lie within the radius of the other
+	if not _mark_near(world1, world2.center_x, world2.center_y, world2.radius, near1):
 		return False
-	elif len(dist1) < len(hull1):
-		dist1 = [dist1[0] - 1] + dist1 + [(dist1[-1] + 1) % len(dist1)]
-	
-	# Find all points in hull2 that lie within the radius of hull1
-	for pos in range(len(hull2)):
-		vertex = hull2[pos]
-		dx = (vertex.x + offset2.x) - (center1.x + offset1.x)
-		dy = (vertex.y + offset2.y) - (center1.y + offset1.y)
-		d = dx * dx + dy * dy
-		if d <= radius1:
-			dist2.append(pos)
-	# Add the point before the first and after the last so we use them when
-	# making lines to test
-	if len(dist2) == 0:
+	if not _mark_near(world2, world1.center_x, world1.center_y, world1.radius, near2):
 		return False
-	elif len(dist2) < len(hull2):
-		dist2 = [dist2[0] - 1] + dist2 + [(dist2[-1] + 1) % len(dist2)]
-	
-	# Iterate through points and test lines
-	for pos in range(len(dist1) - 1):
-		v1 = hull1[dist1[pos]]
-		v2 = hull1[dist1[pos + 1]]
-		for pos2 in range(len(dist2) - 1):
-			v3 = hull2[dist2[pos2]]
-			v4 = hull2[dist2[pos2 + 1]]
-			if line_intersection2d(v1, v2, offset1, v3, v4, offset2):
+	
+	# Test each edge touching a nearby point against the edges of the other
+	# hull that touch a nearby point
+	points1 = world1.points
+	points2 = world2.points
+	for pos in xrange(len1):
+		after = (pos + 1) % len1
+		if not (near1[pos] or near1[after]):
+			continue
+		x1 = points1[pos * 2]
+		y1 = points1[pos * 2 + 1]
+		x2 = points1[after * 2]
+		y2 = points1[after * 2 + 1]
+		for pos2 in xrange(len2):
+			after2 = (pos2 + 1) % len2
+			if not (near2[pos2] or near2[after2]):
+				continue
+			if segment_intersection2d(x1, y1, x2, y2, \
+									  points2[pos2 * 2], points2[pos2 * 2 + 1], \
+									  points2[after2 * 2], points2[after2 * 2 + 1]):
 				return True
 	return False
-	
+
+#-------------------------------------------------------------------------------
+def _sat_axes2d(world1, world2, axes, best, normal, flip):
+	"""
+	Run the separating axis test for the edge normals of axes' hull, which
+	must be either world1 or world2. Returns the smallest overlap found that
+	is below best, -1 if the hulls are separated, or best if nothing smaller
+	was found. When a smaller overlap is found normal is set to the
+	direction world1 has to move to get out of world2.
 	"""
-	for pos in range(len(hull1)):
-		v1 = hull1[pos]
-		if pos == len(hull1) - 1:
-			v2 = hull1[0]
+	normals = axes.hull.normals
+	extents = axes.hull.extents
+	if flip:
+		other = world1
+	else:
+		other = world2
+	points = other.points
+	count = len(other) * 2
+	for pos in xrange(0, len(normals), 2):
+		nx = normals[pos]
+		ny = normals[pos + 1]
+		
+		# The hull's own projection is precalculated, so just offset it
+		offset = axes.x * nx + axes.y * ny
+		min1 = extents[pos] + offset
+		max1 = extents[pos + 1] + offset
+		
+		# Project the other hull's points onto the axis
+		min2 = max2 = points[0] * nx + points[1] * ny
+		for index in xrange(2, count, 2):
+			d = points[index] * nx + points[index + 1] * ny
+			if d < min2:
+				min2 = d
+			elif d > max2:
+				max2 = d
+		
+		# Moving in the negative direction by push or positive by back would
+		# separate the two intervals
+		push = max1 - min2
+		back = max2 - min1
+		if push <= 0 or back <= 0:
+			return -1
+		if push < back:
+			overlap = push
+			sign = -1.0
 		else:
-			v2 = hull1[pos + 1]
-		for pos2 in range(len(hull2)):
-			v3 = hull2[pos]
-			if pos2 == len(hull2) - 1:
-				v4 = hull2[0]
-			else:
-				v4 = hull2[pos2 + 1]
-			if line_intersection2d(v1, v2, offset1, v3, v4, offset2):
-				return True
-	return False
+			overlap = back
+			sign = 1.0
+		if best < 0 or overlap < best:
+			best = overlap
+			if flip:
+				sign = -sign
+			if normal is not None:
+				normal.x = nx * sign
+				normal.y = ny * sign
+	return best
+
+def sat_collision2d(world1, world2, normal = None):
+	"""
+	Separating axis test for two convex world-space hulls. Returns how far
+	the hulls overlap, or 0 if they do not. If normal (a Point2d) is given,
+	it is set to the unit direction world1 has to move by that distance to
+	no longer overlap world2, which can be used to slide it along world2.
+	Unlike world_hull_collision2d this also catches one hull completely
+	containing the other.
+	"""
+	best = _sat_axes2d(world1, world2, world1, -1, normal, False)
+	if best < 0:
+		return 0.0
+	best = _sat_axes2d(world1, world2, world2, best, normal, True)
+	if best < 0:
+		return 0.0
+	return best
+
+#-------------------------------------------------------------------------------
+def _sweep_axes2d(world1, dx, dy, world2, axes, times, normal):
+	"""
+	Narrow the [enter, exit] time interval in times using the edge normals of
+	axes' hull, which must be either world1 or world2. Returns False as soon
+	as an axis shows the hulls can never touch during the sweep. When the
+	enter time grows, normal is set to that axis, facing against the motion.
+	"""
+	normals = axes.hull.normals
+	extents = axes.hull.extents
+	if axes is world1:
+		points = world2.points
+		count = len(world2) * 2
+	else:
+		points = world1.points
+		count = len(world1) * 2
+	for pos in xrange(0, len(normals), 2):
+		nx = normals[pos]
+		ny = normals[pos + 1]
+		offset = axes.x * nx + axes.y * ny
+		min1 = extents[pos] + offset
+		max1 = extents[pos + 1] + offset
+		min2 = max2 = points[0] * nx + points[1] * ny
+		for index in xrange(2, count, 2):
+			d = points[index] * nx + points[index + 1] * ny
+			if d < min2:
+				min2 = d
+			elif d > max2:
+				max2 = d
+		if axes is not world1:
+			min1, max1, min2, max2 = min2, max2, min1, max1
+		
+		# min1 and max1 now belong to the moving hull
+		speed = dx * nx + dy * ny
+		if speed == 0:
+			if max1 <= min2 or min1 >= max2:
+				return False
+			continue
+		enter = (min2 - max1) / speed
+		exit = (max2 - min1) / speed
+		if enter > exit:
+			enter, exit = exit, enter
+		if enter > times[0]:
+			times[0] = enter
+			if normal is not None:
+				if speed > 0:
+					normal.x = -nx
+					normal.y = -ny
+				else:
+					normal.x = nx
+					normal.y = ny
+		if exit < times[1]:
+			times[1] = exit
+		if times[0] > times[1]:
+			return False
+	return True
+
+# Scratch [enter, exit] interval for sweep_collision2d
+_sweep_times = array("d", [0.0, 0.0])
+
+def sweep_collision2d(world1, dx, dy, world2, normal = None):
+	"""
+	Swept separating axis test. Moves world1 by dx, dy against the static
+	world2 and returns the fraction of the move, from 0 to 1, at which they
+	first touch, or -1 if they never do. A hull that starts out overlapping
+	returns 0. If normal (a Point2d) is given it is set to the surface
+	normal that was hit, which can be used to slide along world2 for the
+	rest of the move. Fast movers can't pass through thin hulls this way.
+	"""
+	times = _sweep_times
+	times[0] = -1e30
+	times[1] = 1e30
+	if not _sweep_axes2d(world1, dx, dy, world2, world1, times, normal):
+		return -1
+	if not _sweep_axes2d(world1, dx, dy, world2, world2, times, normal):
+		return -1
+	enter = times[0]
+	if enter > 1 or times[1] < 0:
+		return -1
+	if enter < 0:
+		return 0.0
+	return enter
+
+#-------------------------------------------------------------------------------
+def hull_collision2d(hull1, offset1, hull2, offset2):
 	"""
+	Returns whether two hulls at the given offsets collide. Objects that are
+	tested often should keep a WorldHull2d and use world_hull_collision2d
+	instead.
+	"""
+	return world_hull_collision2d(WorldHull2d(hull1, offset1.x, offset1.y), \
+								  WorldHull2d(hull2, offset2.x, offset2.y))
 
 #-------------------------------------------------------------------------------
 def polar_angle2d(pole, point):
@@ -773,24 +1639,12 @@ def convex_hull2d(vertices):
 		elif vertex.y == pivot.y and vertex.x < pivot.x:
 			pivot = vertex
 	
-	# Save the angles from the pivot
-	for vertex in v:
-		vertex.angle = polar_angle2d(pivot, vertex)
-	
-	def compare(v1, v2):
-		if v1.angle < v2.angle:
-			return -1
-		elif v1.angle > v2.angle:
-			return 1
-		elif v1.x == v2.x and v1.y == v2.y:
-			return 1
-		elif distance2d(pivot, v1) < distance2d(pivot, v2):
-			return -1
-		else:
-			return 1
-	
-	# Sort the list by angle, then distance if angles tie
-	v.sort(compare)
+	# Sort the list by angle from the pivot, then distance if angles tie. The
+	# index keeps the points themselves from ever being compared.
+	order = [(polar_angle2d(pivot, v[pos]), distance2d(pivot, v[pos]), pos) \
+			 for pos in range(len(v))]
+	order.sort()
+	v = [v[pos] for angle, dist, pos in order]
 	
 	# Setup the stack
 	stack = Hull2d()
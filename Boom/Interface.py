@@ -43,6 +43,13 @@ from time import time, sleep
 tdiff = 0
 last_time = 0
 
+# The perspective set up by BaseInterface.resize, used by cameras to work out
+# what can be seen
+PERSPECTIVE_FOV = 25.0
+PERSPECTIVE_NEAR = 10.0
+PERSPECTIVE_FAR = 100.0
+aspect = 640.0 / 480.0
+
 MENU_SUBMENU = 0
 MENU_ITEM = 1
 
@@ -127,10 +134,12 @@ class BaseInterface:
 			height = 1
 		
 		# Reset the camer/view to the new width/height
+		global aspect
+		aspect = float(width) / float(height)
 		glViewport(0, 0, width, height)
 		glMatrixMode(GL_PROJECTION)
 		glLoadIdentity()
-		gluPerspective(25.0, float(width)/float(height), 10.0, 100.0)
+		gluPerspective(PERSPECTIVE_FOV, aspect, PERSPECTIVE_NEAR, PERSPECTIVE_FAR)
 		glMatrixMode(GL_MODELVIEW)
 	
 	def shutdown(self):
@@ -168,8 +177,8 @@ class SDLInterface(BaseInterface):
 		self.screen = SDL.display.set_mode([width, height], flags)
 		self.resize(width, height)
 		
-		# Setup the sound manager to use SDL
-		Sound.manager = Sound.SDLSoundManager()
+		# Setup the sound manager, SDL unless sound is turned off
+		Sound.manager = Sound.create_manager()
 	
 	def start(self):
 		"""
@@ -180,6 +189,8 @@ class SDLInterface(BaseInterface):
 		frames = 0
 		# Start the main event loop
 		while 1:
+			Log.trace.begin(Log.TRACE_FRAME, "frame", frames)
+			
 			# Process the internal event queue
 			Event.handle_events()
 			
@@ -198,11 +209,12 @@ class SDLInterface(BaseInterface):
 			# Update and draw the current state
 			StateManager.update()
 			self.draw()
+			Log.trace.end(Log.TRACE_FRAME, "frame", frames)
 			
 			frames += 1
 			curtime = time()
 			if curtime - lasttime >= 1:
-				Log.info("FPS: " + str(frames / (curtime - lasttime)))
+				Log.info("FPS: %s", frames / (curtime - lasttime))
 				frames = 0
 				lasttime = curtime
 	
@@ -212,6 +224,38 @@ class SDLInterface(BaseInterface):
 		"""
 		SDL.display.flip()
 
+#-------------------------------------------------------------------------------
+class NullInterface(BaseInterface):
+	"""
+	Null Interface
+	==============
+		An interface without a window, for running the engine headless with
+		the null graphics backend (see Backend). It runs the same loop as
+		SDLInterface, minus user input, so it can also be used to benchmark
+		the game logic.
+	"""
+	def __init__(self, width = 640, height = 480):
+		BaseInterface.__init__(self)
+		self.resize(width, height)
+		Sound.manager = Sound.create_manager()
+		Event.register(Event.EVENT_QUIT, self.shutdown)
+	
+	def start(self, frames = None):
+		"""
+		Start the game engine, for a number of frames or until quit.
+		"""
+		# Don't count the time before starting as the first frame's
+		global last_time
+		last_time = time()
+		frame = 0
+		while frames is None or frame < frames:
+			Log.trace.begin(Log.TRACE_FRAME, "frame", frame)
+			Event.handle_events()
+			StateManager.update()
+			self.draw()
+			Log.trace.end(Log.TRACE_FRAME, "frame", frame)
+			frame += 1
+
 #-------------------------------------------------------------------------------
 class Menu:
 	"""
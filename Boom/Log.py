@@ -21,6 +21,48 @@
 	
 		module [line number]: type message
 	
+		Cheap Logging
+		-------------
+		Pass message arguments separately instead of building the string
+		yourself; they are only formatted if the message is actually logged:
+	
+		>>> info("Loading %s", "level.mesh")
+	
+		For arguments that are expensive to compute, wrap them in Lazy so they
+		are only computed when the message is formatted, or test one of the
+		cached level flags (debug_enabled, info_enabled, ...) first:
+	
+		>>> debug("Path: %s", Lazy(", ".join, names))
+		>>> if info_enabled:
+		...     info("Score: %d", compute_score())
+	
+		The flags are updated by set_level, so always look them up through
+		the module (Log.info_enabled) rather than importing them.
+		
+		Finding the module and line number of every message means walking the
+		stack. Call set_source_info(False) to skip that and log without them.
+	
+		Tracing
+		-------
+		Besides text messages, the engine records a trace of what it is doing
+		(event posts, state changes, asset loads, frames and explosions) into
+		a fixed-size ring buffer. Recording is a single struct pack, so it is
+		left on all the time. The last TRACE_SIZE records can be written to a
+		compact binary file with trace.dump(filename), and are written to
+		TRACE_CRASH_FILE automatically if the program dies with an uncaught
+		exception. Convert a dump for chrome://tracing with:
+	
+		python Log.py boom.trace boom.json
+	
+		Asynchronous Output
+		-------------------
+		Messages are not written to the console by the thread that logs them.
+		They are put on a bounded queue and a background thread writes them
+		out, so the game loop never waits on a slow or piped stderr. When the
+		queue is full, messages are dropped according to ASYNC_OVERFLOW and a
+		count of the dropped messages is written once there is room again.
+		Call flush() if you need everything written before continuing.
+	
 		License
 		-------
 		Copyright (C) 2006 Daniel G. Taylor
@@ -42,27 +84,216 @@
 
 # Imports
 import logging
+import os
+import threading
+import Queue
+import struct
+import sys
+from time import time
 
 # change this to change the format of log messages
 LOG_FORMAT = "%(module)s [%(lineno)d]: %(levelname)s %(message)s"
 
+# format used when caller information is turned off with set_source_info
+LOG_FORMAT_NO_SOURCE = "%(levelname)s %(message)s"
+
+# set to False to skip looking up the module and line number of messages
+LOG_SOURCE_INFO = True
+
 # This will print error and critical messages by default
 DEFAULT_LOG_LEVEL = logging.INFO
 
+# Maximum number of messages waiting to be written
+ASYNC_QUEUE_SIZE = 1024
+
+# What to do when the queue is full: "drop" throws away the new message,
+# "oldest" throws away the oldest waiting message to make room for it
+ASYNC_OVERFLOW = "drop"
+
+class AsyncHandler(logging.Handler):
+	"""
+	Asynchronous Handler
+	====================
+		Passes log records to another handler from a background thread.
+		Records are prepared in the logging thread (message arguments are
+		merged and tracebacks formatted) so nothing they reference can change
+		before they are written. Emitting never blocks; when the queue is full
+		records are dropped according to the overflow policy.
+		
+		The background thread does not survive a fork, so a forked process
+		(e.g. a multiprocessing worker) starts its own the first time it logs,
+		and flushes it when a multiprocessing child finishes.
+		Once the handler is closed, records are written straight away.
+	"""
+	def __init__(self, target, size = ASYNC_QUEUE_SIZE, overflow = ASYNC_OVERFLOW):
+		logging.Handler.__init__(self)
+		if overflow not in ("drop", "oldest"):
+			raise ValueError, overflow + " is not a valid overflow policy! Please pass drop or oldest!"
+		self.target = target
+		self.size = size
+		self.overflow = overflow
+		self.dropped = 0
+		self.closed = False
+		self.start()
+	
+	def start(self):
+		"""
+		Start the background thread with an empty queue.
+		"""
+		self.pid = os.getpid()
+		self.queue = Queue.Queue(self.size)
+		self.thread = threading.Thread(target = self.write, args = (self.queue,))
+		self.thread.setDaemon(True)
+		self.thread.start()
+	
+	def prepare(self, record):
+		"""
+		Merge the message arguments and format any exception now, while the
+		objects they refer to are still in the state being logged.
+		"""
+		record.msg = record.getMessage()
+		record.args = None
+		if record.exc_info:
+			record.exc_text = logging._defaultFormatter.formatException(record.exc_info)
+			record.exc_info = None
+		return record
+	
+	def emit(self, record):
+		try:
+			record = self.prepare(record)
+		except Exception:
+			self.handleError(record)
+			return
+		if self.closed:
+			self.target.handle(record)
+			return
+		if self.pid != os.getpid():
+			# Forked: the parent's thread is gone, and the target's lock may
+			# have been copied while that thread held it
+			self.target.createLock()
+			self.start()
+			# multiprocessing children leave with os._exit, skipping the
+			# logging module's shutdown, so flush when they finish instead
+			if "multiprocessing" in sys.modules:
+				import multiprocessing.util
+				multiprocessing.util.Finalize(None, self.flush, exitpriority = 0)
+		elif not self.thread.isAlive():
+			self.start()
+		try:
+			self.queue.put_nowait(record)
+		except Queue.Full:
+			if self.overflow == "oldest":
+				try:
+					self.queue.get_nowait()
+					self.queue.task_done()
+				except Queue.Empty:
+					pass
+				try:
+					self.queue.put_nowait(record)
+				except Queue.Full:
+					pass
+			self.dropped += 1
+	
+	def write(self, queue):
+		"""
+		Background thread: pass queued records on to the target handler until
+		the handler is closed.
+		"""
+		while True:
+			record = queue.get()
+			try:
+				if record is None:
+					break
+				if self.dropped:
+					dropped, self.dropped = self.dropped, 0
+					self.target.handle(logging.makeLogRecord({
+						"name": "Log",
+						"module": "Log",
+						"lineno": 0,
+						"levelno": logging.WARNING,
+						"levelname": "WARNING",
+						"msg": "Dropped %d log messages" % dropped}))
+				self.target.handle(record)
+			except Exception:
+				self.handleError(record)
+			finally:
+				queue.task_done()
+	
+	def flush(self):
+		"""
+		Wait until every queued record has been written.
+		"""
+		if self.thread.isAlive() and self.pid == os.getpid():
+			self.queue.join()
+		self.target.flush()
+	
+	def close(self):
+		"""
+		Write out the remaining records and stop the background thread.
+		"""
+		self.closed = True
+		if self.thread.isAlive() and self.pid == os.getpid():
+			self.queue.put(None)
+			self.thread.join()
+		self.target.flush()
+		logging.Handler.close(self)
+
 # get the root logger
 logger = logging.getLogger('')
 
 # setup a default handler if none exists
 # if there are handlers, just use the first one we find
+# the default handler writes to the console from a background thread
 if logger.handlers == []:
 	handler = logging.StreamHandler()
 	handler.setFormatter(logging.Formatter(LOG_FORMAT))
-	logger.addHandler(handler)
+	writer = AsyncHandler(handler)
+	logger.addHandler(writer)
 else:
 	handler = logger.handlers[0]
+	writer = None
+
+# cached results of logger.isEnabledFor, updated by set_level
+critical_enabled = True
+error_enabled = True
+warning_enabled = True
+info_enabled = True
+debug_enabled = True
+
+def update_enabled():
+	"""
+	Refresh the cached level flags. set_level does this for you; call it if
+	you change the level of the root logger directly.
+	"""
+	global critical_enabled, error_enabled, warning_enabled, info_enabled, debug_enabled
+	critical_enabled = logger.isEnabledFor(logging.CRITICAL)
+	error_enabled = logger.isEnabledFor(logging.ERROR)
+	warning_enabled = logger.isEnabledFor(logging.WARNING)
+	info_enabled = logger.isEnabledFor(logging.INFO)
+	debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
+class Lazy(object):
+	"""
+	Lazy Argument
+	=============
+		A log message argument that is only computed if the message is
+		formatted, e.g. Log.debug("Hull: %s", Lazy(repr, hull)).
+	"""
+	__slots__ = ["func", "args"]
+	
+	def __init__(self, func, *args):
+		self.func = func
+		self.args = args
+	
+	def __str__(self):
+		return str(self.func(*self.args))
+	
+	def __repr__(self):
+		return repr(self.func(*self.args))
 
 # set the default log level
 logger.setLevel(DEFAULT_LOG_LEVEL)
+update_enabled()
 logger.info("Logging system started.")
 
 # convenience functions
@@ -72,6 +303,211 @@ warning = logger.warning
 info = logger.info
 debug = logger.debug
 
+# remember how the logging module finds callers so it can be restored
+_srcfile = logging._srcfile
+
+# number of records kept by the trace ring buffer
+TRACE_SIZE = 16384
+
+# where the trace is written when the program crashes, None to disable
+TRACE_CRASH_FILE = "boom.trace"
+
+# trace record categories
+TRACE_EVENT = 0
+TRACE_STATE = 1
+TRACE_ASSET = 2
+TRACE_FRAME = 3
+TRACE_EXPLOSION = 4
+TRACE_MARK = 5
+TRACE_CATEGORIES = ["event", "state", "asset", "frame", "explosion", "mark"]
+
+# trace record phases
+TRACE_INSTANT = 0
+TRACE_BEGIN = 1
+TRACE_END = 2
+
+# time, category, phase, name, value
+TRACE_RECORD = struct.Struct("<dBBHi")
+# magic, version, records, names
+TRACE_HEADER = struct.Struct("<4sHII")
+TRACE_NAME = struct.Struct("<H")
+TRACE_MAGIC = "BTRC"
+TRACE_VERSION = 1
+
+class TraceRecorder(object):
+	"""
+	Trace Recorder
+	==============
+		A ring buffer of timestamped binary trace records. Names are stored
+		once in a table and records refer to them by index, so a record is
+		always TRACE_RECORD.size bytes. Once the buffer is full the oldest
+		records are overwritten.
+	"""
+	def __init__(self, size = TRACE_SIZE):
+		self.size = size
+		self.buffer = bytearray(size * TRACE_RECORD.size)
+		self.position = 0
+		self.count = 0
+		self.names = []
+		self.ids = {}
+		self.enabled = True
+	
+	def name(self, name):
+		"""
+		Return the index of name in the name table, adding it if needed.
+		"""
+		id = self.ids.get(name)
+		if id is None:
+			if len(self.names) > 0xFFFF:
+				return 0
+			id = len(self.names)
+			self.names.append(name)
+			self.ids[name] = id
+		return id
+	
+	def record(self, category, name, phase = TRACE_INSTANT, value = 0):
+		"""
+		Add a record to the trace.
+		
+		@type category: int
+		@param category: One of the TRACE_* categories.
+		@type name: string
+		@param name: What happened, e.g. an asset or state name.
+		@type phase: int
+		@param phase: TRACE_INSTANT, or TRACE_BEGIN/TRACE_END for spans.
+		@type value: int
+		@param value: Extra information, e.g. an event type or object id.
+		"""
+		if not self.enabled:
+			return
+		id = self.ids.get(name)
+		if id is None:
+			id = self.name(name)
+		TRACE_RECORD.pack_into(self.buffer, self.position, time(), category, phase, id, value)
+		self.position += TRACE_RECORD.size
+		if self.position == len(self.buffer):
+			self.position = 0
+		self.count += 1
+	
+	def begin(self, category, name, value = 0):
+		self.record(category, name, TRACE_BEGIN, value)
+	
+	def end(self, category, name, value = 0):
+		self.record(category, name, TRACE_END, value)
+	
+	def clear(self):
+		self.position = 0
+		self.count = 0
+	
+	def data(self):
+		"""
+		Return the recorded records, oldest first, as one string.
+		"""
+		if self.count < self.size:
+			return str(self.buffer[:self.position])
+		return str(self.buffer[self.position:] + self.buffer[:self.position])
+	
+	def records(self):
+		"""
+		Return the recorded records, oldest first, as tuples of
+		(time, category, phase, name, value).
+		"""
+		return decode_trace(self.data(), self.names)
+	
+	def dump(self, filename):
+		"""
+		Write the trace to a binary file that can be read with load_trace.
+		"""
+		data = self.data()
+		out = open(filename, "wb")
+		try:
+			out.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, len(data) / TRACE_RECORD.size, len(self.names)))
+			for name in self.names:
+				name = str(name)
+				out.write(TRACE_NAME.pack(len(name)))
+				out.write(name)
+			out.write(data)
+		finally:
+			out.close()
+
+def decode_trace(data, names):
+	"""
+	Turn packed trace records into tuples of
+	(time, category, phase, name, value).
+	"""
+	records = []
+	for offset in xrange(0, len(data), TRACE_RECORD.size):
+		stamp, category, phase, id, value = TRACE_RECORD.unpack_from(data, offset)
+		records.append((stamp, category, phase, names[id], value))
+	return records
+
+def load_trace(filename):
+	"""
+	Read a trace written by TraceRecorder.dump.
+	
+	@rtype: list
+	@return: The records, oldest first, as tuples of
+	         (time, category, phase, name, value).
+	"""
+	data = open(filename, "rb").read()
+	magic, version, count, name_count = TRACE_HEADER.unpack_from(data)
+	if magic != TRACE_MAGIC or version != TRACE_VERSION:
+		raise ValueError, filename + " is not a Boom trace file!"
+	offset = TRACE_HEADER.size
+	names = []
+	for i in xrange(name_count):
+		length, = TRACE_NAME.unpack_from(data, offset)
+		offset += TRACE_NAME.size
+		names.append(data[offset:offset + length])
+		offset += length
+	return decode_trace(data[offset:offset + count * TRACE_RECORD.size], names)
+
+def trace_to_chrome(source, destination):
+	"""
+	Convert a binary trace file to the Chrome trace event JSON format, which
+	can be opened in chrome://tracing.
+	"""
+	import json
+	records = load_trace(source)
+	start = records and records[0][0] or 0
+	events = []
+	for stamp, category, phase, name, value in records:
+		event = {"name": name,
+				 "cat": TRACE_CATEGORIES[category],
+				 "ph": "iBE"[phase],
+				 "ts": (stamp - start) * 1000000.0,
+				 "pid": 0,
+				 "tid": 0,
+				 "args": {"value": value}}
+		if phase == TRACE_INSTANT:
+			event["s"] = "g"
+		events.append(event)
+	out = open(destination, "w")
+	try:
+		json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, out)
+	finally:
+		out.close()
+
+def dump_on_crash(filename = TRACE_CRASH_FILE):
+	"""
+	Write the trace to filename if the program dies with an uncaught
+	exception.
+	"""
+	previous = sys.excepthook
+	def excepthook(type, value, traceback):
+		try:
+			trace.dump(filename)
+			logger.critical("Trace written to %s", filename)
+		except Exception:
+			pass
+		previous(type, value, traceback)
+	sys.excepthook = excepthook
+
+# the engine wide trace recorder
+trace = TraceRecorder()
+if TRACE_CRASH_FILE is not None:
+	dump_on_crash()
+
 add_handler = logger.addHandler			# could be used to save to files
 remove_handler = logger.removeHandler	# and to stop saving to them :-D
 
@@ -95,10 +531,41 @@ def set_level(level):
 	# make sure we have a valid level!
 	if level in levels.keys():
 		logger.setLevel(levels[level])
-		logger.info("Log level set to " + level + ".")
+		update_enabled()
+		logger.info("Log level set to %s.", level)
 	else:
 		raise ValueError, level + " is not a valid logging level! Please pass critical, error, warning, info, or debug!"
 
+def flush():
+	"""
+	Block until all queued log messages have been written.
+	"""
+	if writer is not None:
+		writer.flush()
+	else:
+		handler.flush()
+
+def set_source_info(enabled):
+	"""
+	Turn looking up the module and line number of each message on or off.
+	When off, the stack is not walked for every message and the format
+	switches to LOG_FORMAT_NO_SOURCE (if LOG_FORMAT was in use). Call
+	set_format afterwards to use your own format.
+	
+	@type enabled: bool
+	@param enabled: Whether to record caller information.
+	"""
+	global LOG_SOURCE_INFO
+	LOG_SOURCE_INFO = enabled
+	if enabled:
+		logging._srcfile = _srcfile
+		if handler.formatter is None or handler.formatter._fmt == LOG_FORMAT_NO_SOURCE:
+			set_format(LOG_FORMAT)
+	else:
+		logging._srcfile = None
+		if handler.formatter is None or handler.formatter._fmt == LOG_FORMAT:
+			set_format(LOG_FORMAT_NO_SOURCE)
+
 def set_format(format):
 	"""
 	Set the log output format.
@@ -120,3 +587,13 @@ def get_logger(name):
 	@return: The new logger object.
 	"""
 	return logging.getLogger(name)
+
+# apply the default caller information setting
+if not LOG_SOURCE_INFO:
+	set_source_info(False)
+
+if __name__ == "__main__":
+	if len(sys.argv) != 3:
+		print "Usage: " + sys.argv[0] + " trace.bin trace.json"
+		sys.exit(1)
+	trace_to_chrome(sys.argv[1], sys.argv[2])
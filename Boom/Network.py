@@ -35,13 +35,121 @@ import Interface
 import socket
 import select
 import struct
+import errno
+
+from math import pi, tan, radians
+from time import time
+from collections import deque, OrderedDict
 
 """
 	This variable controls how the data is packed depending on which pre-defined
-	message is created. Index 0 is reserved for the message header.
+	message is created. Index 0 is reserved for the message header. Messages
+	of a type with no format (such as NETWORK_MESSAGE_RAW) carry a string.
+
+	The game messages exchanged between a client and Boom.Server are:
+		join		match number to join
+		welcome		match number, the id of the client's player and the
+					server's tick rate
+		input		input sequence number (from 1, wrapping back to 1),
+					quantised angle, and flags (NETWORK_INPUT_MOVING,
+					NETWORK_INPUT_BOMB)
+		snapshot	a piece of an encoded Snapshot, see snapshot_messages
+		ack			sequence number of the last snapshot received
+		leave		match number being left
+		input ack	no longer sent, the sequence number of the last input
+					applied before a snapshot was captured is in its
+					snapshot messages
+		view		the client's camera face, zoom and the x, y it looks at,
+					see View
+"""
+NETWORK_MESSAGE_RAW = 1
+NETWORK_MESSAGE_JOIN = 2
+NETWORK_MESSAGE_WELCOME = 3
+NETWORK_MESSAGE_INPUT = 4
+NETWORK_MESSAGE_SNAPSHOT = 5
+NETWORK_MESSAGE_ACK = 6
+NETWORK_MESSAGE_LEAVE = 7
+NETWORK_MESSAGE_INPUT_ACK = 8
+NETWORK_MESSAGE_VIEW = 9
+NETWORK_MESSAGE_TYPES = [">IHHHH", None, ">H", ">HHf", ">HBB", None, ">H", ">H", ">HH",
+						 ">Bfff"]
+
+NETWORK_INPUT_MOVING = 1
+NETWORK_INPUT_BOMB = 2
+
+"""
+	Precompiled codecs for each of NETWORK_MESSAGE_TYPES, see
+	register_message_type.
+"""
+NETWORK_CODECS = [format and struct.Struct(format) for format in NETWORK_MESSAGE_TYPES]
+NETWORK_HEADER = NETWORK_CODECS[0]
+NETWORK_HEADER_LENGTH = NETWORK_HEADER.size
+
+"""
+	Message flags. Reliable messages are resent until they are acknowledged
+	and are received in the order they were sent, after a reliable message id
+	that follows the message header.
 """
-NETWORK_MESSAGE_TYPES = [">HHHHH"]
-NETWORK_HEADER_LENGTH = struct.calcsize(NETWORK_MESSAGE_TYPES[0])
+NETWORK_FLAG_RELIABLE = 1
+NETWORK_RELIABLE_HEADER = struct.Struct(">H")
+NETWORK_RELIABLE_HEADER_LENGTH = NETWORK_RELIABLE_HEADER.size
+
+"""
+	Each packet starts with its sequence number, the latest sequence number
+	received from the other end and a bit for each of the 32 before that,
+	followed by as many messages as fit in NETWORK_MAX_PACKET bytes.
+	Sequence numbers run from 1 to NETWORK_SEQUENCE_MASK and then wrap back
+	to 1, so an ack of NETWORK_NO_ACK means nothing has been received yet.
+"""
+NETWORK_PACKET_HEADER = struct.Struct(">HHI")
+NETWORK_PACKET_HEADER_LENGTH = NETWORK_PACKET_HEADER.size
+NETWORK_MAX_PACKET = 1200
+NETWORK_SEQUENCE_MASK = 0xFFFF
+NETWORK_ACK_BITS = 32
+NETWORK_NO_ACK = 0
+
+"""
+	How long (in seconds) to wait for a reliable message to be acknowledged
+	before sending it again.
+"""
+NETWORK_RESEND_TIME = 0.2
+
+"""
+	The default size in bytes of a MessageBuffer.
+"""
+NETWORK_BUFFER_SIZE = 65536
+
+def register_message_type(format):
+	"""
+		Add a message type packed with struct format format (or None for a
+		string) and return its type number.
+	"""
+	NETWORK_MESSAGE_TYPES.append(format)
+	NETWORK_CODECS.append(format and struct.Struct(format))
+	return len(NETWORK_MESSAGE_TYPES) - 1
+
+def pack_messages(messages, buffer, offset = 0):
+	"""
+		Pack messages one after the other into buffer starting at offset and
+		return the offset after the last one.
+	"""
+	for message in messages:
+		offset = message.pack_into(buffer, offset)
+	return offset
+
+def unpack_messages(buffer, offset = 0, length = None):
+	"""
+		Return the list of messages packed into buffer from offset up to
+		length (or the end of the buffer).
+	"""
+	if length is None:
+		length = len(buffer)
+	messages = []
+	while offset + NETWORK_HEADER_LENGTH <= length:
+		message = Message()
+		offset = message.unpack_from(buffer, offset, length)
+		messages.append(message)
+	return messages
 
 class Message:
 	"""
@@ -52,6 +160,8 @@ class Message:
 			what the data will be interpreted as.
 		The flags contain pertinent information, such as whether the data
 			should be sent reliably.
+		The id is the reliable message id of reliable messages.
+		The address is where a received message came from.
 	"""
 	def __init__(self, time_float = 0.0, message_length = 0, 
 					message_type = 0, flags = 0, data = []):
@@ -61,72 +171,186 @@ class Message:
 		self.mtype = message_type
 		self.flags = flags
 		self.data = data
+		self.id = 0
+		self.address = None
+
+	def size(self):
+		"""
+			Return how many bytes the packed message takes up.
+		"""
+		codec = NETWORK_CODECS[self.mtype]
+		if codec is None:
+			size = len(self.data)
+		else:
+			size = codec.size
+		if self.flags & NETWORK_FLAG_RELIABLE:
+			size += NETWORK_RELIABLE_HEADER_LENGTH
+		return NETWORK_HEADER_LENGTH + size
 
 	def pack(self):
-		return self.pack_header() + self.pack_data()
+		buffer = bytearray(self.size())
+		self.pack_into(buffer)
+		return str(buffer)
 
 	def unpack(self, payload):
-		head = self.unpack_header(payload[:NETWORK_HEADER_LENGTH])
-		self.time_s, self.time_ms, self.length, self.mtype, self.flags = head
-		self.data = list(self.unpack_data(payload[NETWORK_HEADER_LENGTH:])
+		self.unpack_from(payload)
+
+	def pack_into(self, buffer, offset = 0):
+		"""
+			Pack the message into buffer at offset and return the offset after
+			it.
+		"""
+		codec = NETWORK_CODECS[self.mtype]
+		if codec is None:
+			self.length = len(self.data)
+		else:
+			self.length = codec.size
+		NETWORK_HEADER.pack_into(buffer, offset, self.time_s, self.time_ms,
+								 self.length, self.mtype, self.flags)
+		offset += NETWORK_HEADER_LENGTH
+		if self.flags & NETWORK_FLAG_RELIABLE:
+			NETWORK_RELIABLE_HEADER.pack_into(buffer, offset, self.id)
+			offset += NETWORK_RELIABLE_HEADER_LENGTH
+		if codec is None:
+			buffer[offset:offset + self.length] = self.data
+		else:
+			codec.pack_into(buffer, offset, *self.data)
+		return offset + self.length
+
+	def unpack_from(self, buffer, offset = 0, length = None):
+		"""
+			Unpack the message in buffer at offset and return the offset after
+			it. Length is where the data in buffer ends.
+		"""
+		if length is None:
+			length = len(buffer)
+		if offset + NETWORK_HEADER_LENGTH > length:
+			raise ValueError, "message header is truncated"
+		self.time_s, self.time_ms, self.length, self.mtype, self.flags = \
+			NETWORK_HEADER.unpack_from(buffer, offset)
+		offset += NETWORK_HEADER_LENGTH
+		if self.flags & NETWORK_FLAG_RELIABLE:
+			if offset + NETWORK_RELIABLE_HEADER_LENGTH > length:
+				raise ValueError, "message header is truncated"
+			self.id, = NETWORK_RELIABLE_HEADER.unpack_from(buffer, offset)
+			offset += NETWORK_RELIABLE_HEADER_LENGTH
+		if self.mtype >= len(NETWORK_CODECS) or offset + self.length > length:
+			raise ValueError, "malformed message"
+		codec = NETWORK_CODECS[self.mtype]
+		if codec is None:
+			self.data = str(buffer[offset:offset + self.length])
+		else:
+			if codec.size != self.length:
+				raise ValueError, "malformed message"
+			self.data = list(codec.unpack_from(buffer, offset))
+		return offset + self.length
 
 	def pack_header(self):
-		return struct.pack(NETWORK_MESSAGE_TYPES[0], self.time_s, self.time_ms,
-							self.length, self.mtype, self.flags)
+		return NETWORK_HEADER.pack(self.time_s, self.time_ms,
+								   self.length, self.mtype, self.flags)
 
 	def unpack_header(self, header):
-		return struct.unpack(NETWORK_MESSAGE_TYPES[0], header)
+		return NETWORK_HEADER.unpack(header)
 
 	def pack_data(self):
-		return struct.pack(NETWORK_MESSAGE_TYPES[self.mtype], *data)
+		if NETWORK_CODECS[self.mtype] is None:
+			return str(self.data)
+		return NETWORK_CODECS[self.mtype].pack(*self.data)
 
 	def unpack_data(self, d):
-		return struct.unpack(NETWORK_MESSAGE_TYPES[self.mtype], d)
+		if NETWORK_CODECS[self.mtype] is None:
+			return str(d)
+		return list(NETWORK_CODECS[self.mtype].unpack(d))
 
 	def time_float(self, ts = None, tms = 0):
 		if not ts:
 			ts = self.time_s
 			tms = self.time_ms
-		return ts + (tms / 1000)
+		return ts + (tms / 1000.0)
 
 	def time_int(self, tf = None):
 		if not tf:
 			ret_ints = [self.time_s, self.time_ms]
 		else:
 			ts = int(tf)
-			ret_ints = [ts, int((tf - ts) / 1000)]
+			ret_ints = [ts, int((tf - ts) * 1000)]
+		return ret_ints
 
 class MessageBuffer:
-	def __init__(self):
-		self.pos = 0
-		self.data = []
+	"""
+		A ring buffer of packed messages. Messages are packed straight into
+		the buffer when written and unpacked straight out of it when read, a
+		message never wraps around the end of the buffer.
+	"""
+	def __init__(self, size = NETWORK_BUFFER_SIZE):
+		self.buffer = bytearray(size)
+		self.clear()
+
+	def __len__(self):
+		return self.count
 
 	def write(self, data):
 		"""
 			data is of Message type
 		"""
-		self.data.append(data.pack())
-		return true
+		size = data.size()
+		if self.count and self.end <= self.start:
+			# Already wrapped around, fill the gap up to the oldest message
+			if self.end + size > self.start:
+				raise ValueError, "message buffer is full"
+		elif self.end + size > len(self.buffer):
+			if size > self.start:
+				raise ValueError, "message buffer is full"
+			self.wrap = self.end
+			self.end = 0
+		self.end = data.pack_into(self.buffer, self.end)
+		self.count += 1
+		return True
+
+	def write_batch(self, messages):
+		"""
+			Write a list of messages.
+		"""
+		for message in messages:
+			self.write(message)
+		return True
 
 	def read(self):
 		"""
-			Read the next chunk of data and return a Message
+			Read the next chunk of data and return a Message, or None if the
+			buffer is empty
 		"""
-		#unpacked = struct.unpack(NETWORK_MESSAGE_TYPES[0], 
-		#							self.data[self.pos][:NETWORK_HEADER_LENGTH])
-		#message = Message(unpacked*)
+		if not self.count:
+			return None
+		if self.start == self.wrap:
+			self.start = 0
+			self.wrap = None
 		message = Message()
-		message.unpack(self.data[self.pos])
-		del self.data[self.pos]
+		self.start = message.unpack_from(self.buffer, self.start)
+		self.count -= 1
+		if not self.count:
+			self.clear()
 		return message
 
+	def read_batch(self):
+		"""
+			Read every message in the buffer and return them as a list.
+		"""
+		messages = []
+		while self.count:
+			messages.append(self.read())
+		return messages
+
 	def flush(self):
 		"""
 			Clears the entire buffer returning all the raw network data
 		"""
-		total = ""
-		for mess in self.data:
-			total += mess
+		if not self.count:
+			total = ""
+		elif self.wrap is None:
+			total = str(self.buffer[self.start:self.end])
+		else:
+			total = str(self.buffer[self.start:self.wrap] + self.buffer[:self.end])
 		self.clear()
 		return total
 
@@ -134,17 +358,984 @@ class MessageBuffer:
 		"""
 			Simply clears all the buffer data
 		"""
-		self.data = []
-		return true
+		self.start = 0
+		self.end = 0
+		self.wrap = None
+		self.count = 0
+		return True
+
+class Connection:
+	"""
+		The state kept for each address a Network talks to: packet sequence
+		numbers and acknowledgements, messages waiting to be sent, reliable
+		messages waiting to be acknowledged and reliable messages received out
+		of order.
+	"""
+	def __init__(self, address):
+		self.address = address
+		self.sequence = 1
+		self.remote = None
+		self.received = 0
+		self.ack_needed = False
+		self.pending = deque()
+		self.reliable = OrderedDict()
+		self.reliable_next = 0
+		self.sent = {}
+		self.ordered = {}
+		self.ordered_next = 0
+
+	def acks(self):
+		"""
+			Return the latest sequence number received and the bits of the
+			ones received before it, to put in a packet header.
+		"""
+		if self.remote is None:
+			return (NETWORK_NO_ACK, 0)
+		return (self.remote, self.received)
+
+	def receive_sequence(self, sequence):
+		"""
+			Record that packet sequence arrived. Returns False if it is a
+			duplicate or too old to tell.
+		"""
+		if sequence == NETWORK_NO_ACK:
+			return False
+		if self.remote is None:
+			self.remote = sequence
+			return True
+		if sequence_newer(sequence, self.remote):
+			shift = (sequence - self.remote) & NETWORK_SEQUENCE_MASK
+			if shift > NETWORK_ACK_BITS:
+				self.received = 0
+			else:
+				self.received = ((self.received << shift) | (1 << (shift - 1))) & \
+								((1 << NETWORK_ACK_BITS) - 1)
+			self.remote = sequence
+			return True
+		age = (self.remote - sequence) & NETWORK_SEQUENCE_MASK
+		if age == 0 or age > NETWORK_ACK_BITS or self.received & (1 << (age - 1)):
+			return False
+		self.received |= 1 << (age - 1)
+		return True
+
+	def receive_acks(self, ack, bits):
+		"""
+			Forget the reliable messages in the packets the other end says it
+			has received.
+		"""
+		if ack == NETWORK_NO_ACK:
+			return
+		for age in xrange(NETWORK_ACK_BITS + 1):
+			if age and not bits & (1 << (age - 1)):
+				continue
+			ids = self.sent.pop((ack - age) & NETWORK_SEQUENCE_MASK, None)
+			if ids:
+				for id in ids:
+					self.reliable.pop(id, None)
+		# Packets older than the acknowledgement window will never be
+		# acknowledged, their reliable messages are resent by time instead
+		for sequence in self.sent.keys():
+			if ((ack - sequence) & NETWORK_SEQUENCE_MASK) > NETWORK_ACK_BITS and \
+			   not sequence_newer(sequence, ack):
+				del self.sent[sequence]
+
+	def receive_ordered(self, id, message):
+		"""
+			Return the reliable messages that can be delivered now that
+			message id arrived, in order.
+		"""
+		if id != self.ordered_next:
+			if sequence_newer(id, self.ordered_next):
+				self.ordered[id] = message
+			return []
+		messages = [message]
+		self.ordered_next = (self.ordered_next + 1) & NETWORK_SEQUENCE_MASK
+		while self.ordered_next in self.ordered:
+			messages.append(self.ordered.pop(self.ordered_next))
+			self.ordered_next = (self.ordered_next + 1) & NETWORK_SEQUENCE_MASK
+		return messages
 
 class Network:
-	def __init__(self):
+	"""
+		A non-blocking UDP transport. Messages are queued with send and are
+		packed together into as few packets as possible per address when
+		update is called, which also reads every packet waiting on the socket
+		so the received messages can be read with recv. Call update once per
+		frame from the main loop; fileno allows waiting on the socket with
+		select as well.
+
+		Each packet acknowledges the packets received from the other end.
+		Messages with the NETWORK_FLAG_RELIABLE flag are sent again until a
+		packet carrying them is acknowledged, and are received in order.
+	"""
+	def __init__(self, port = 0, address = "", broadcast = True):
 		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 		# Option to allow broadcast messages to be sent.
-		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+		if broadcast:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+		self.socket.bind((address, port))
+		self.socket.setblocking(0)
+		self.connections = {}
+		self.received = deque()
+		self.buffer = bytearray(NETWORK_MAX_PACKET)
+		self.packet = bytearray(NETWORK_MAX_PACKET)
+		self.packet_view = memoryview(self.packet)
+
+	def fileno(self):
+		return self.socket.fileno()
+
+	def getsockname(self):
+		return self.socket.getsockname()
+
+	def close(self):
+		self.socket.close()
+
+	def connection(self, address):
+		"""
+			Return the connection for address, creating it if needed.
+		"""
+		connection = self.connections.get(address)
+		if connection is None:
+			connection = Connection(address)
+			self.connections[address] = connection
+		return connection
+
+	def disconnect(self, address):
+		"""
+			Forget about address and anything waiting to be sent to it.
+		"""
+		self.connections.pop(address, None)
+
+	def send(self, to, message):
+		"""
+			Queue message to be sent to address to on the next update.
+			Unreliable messages are packed straight into the packet when it
+			is sent, so they shouldn't be changed until then.
+		"""
+		connection = self.connection(to)
+		if message.size() > NETWORK_MAX_PACKET - NETWORK_PACKET_HEADER_LENGTH:
+			raise ValueError, "message too large"
+		if message.flags & NETWORK_FLAG_RELIABLE:
+			message.id = connection.reliable_next
+			connection.reliable_next = (message.id + 1) & NETWORK_SEQUENCE_MASK
+			# Packed now since it may have to be sent several times
+			connection.reliable[message.id] = [message.pack(), None]
+		else:
+			connection.pending.append(message)
+
+	def send_batch(self, to, messages):
+		"""
+			Queue a list of messages to be sent to address to, see send.
+		"""
+		for message in messages:
+			self.send(to, message)
+
+	def recv(self, source = None):
+		"""
+			Return the next message received (from address source if given),
+			or None if there aren't any. The address a message came from is
+			stored in its address.
+		"""
+		if source is None:
+			if self.received:
+				return self.received.popleft()
+			return None
+		for message in self.received:
+			if message.address == source:
+				self.received.remove(message)
+				return message
+		return None
+
+	def update(self, timeout = 0.0):
+		"""
+			Read everything waiting on the socket, waiting up to timeout
+			seconds for something to arrive, then send everything queued.
+		"""
+		readable, writable, errors = select.select([self.socket], [], [], timeout)
+		if readable:
+			self.read_packets()
+		self.write_packets()
+
+	def read_packets(self):
+		"""
+			Read every packet waiting on the socket.
+		"""
+		while True:
+			try:
+				length, address = self.socket.recvfrom_into(self.buffer)
+			except socket.error, e:
+				if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+					break
+				if e.args[0] == errno.ECONNREFUSED:
+					continue
+				raise
+			if length >= NETWORK_PACKET_HEADER_LENGTH:
+				self.read_packet(address, length)
+
+	def read_packet(self, address, length):
+		"""
+			Read the messages in the packet in the receive buffer.
+		"""
+		buffer = self.buffer
+		sequence, ack, bits = NETWORK_PACKET_HEADER.unpack_from(buffer)
+		connection = self.connection(address)
+		if not connection.receive_sequence(sequence):
+			return
+		connection.receive_acks(ack, bits)
+		# Packets that are just acknowledgements don't need acknowledging
+		if length > NETWORK_PACKET_HEADER_LENGTH:
+			connection.ack_needed = True
+		pos = NETWORK_PACKET_HEADER_LENGTH
+		while pos + NETWORK_HEADER_LENGTH <= length:
+			message = Message()
+			try:
+				pos = message.unpack_from(buffer, pos, length)
+			except ValueError:
+				Log.warning("Dropping malformed packet from %s", address)
+				return
+			message.address = address
+			if message.flags & NETWORK_FLAG_RELIABLE:
+				self.received.extend(connection.receive_ordered(message.id, message))
+			else:
+				self.received.append(message)
+
+	def write_packets(self):
+		"""
+			Send everything queued, packing as many messages into each packet
+			as will fit.
+		"""
+		now = time()
+		for connection in self.connections.values():
+			messages = []
+			for id, entry in connection.reliable.items():
+				if entry[1] is None or now - entry[1] >= NETWORK_RESEND_TIME:
+					entry[1] = now
+					messages.append((id, entry[0]))
+			pending = connection.pending
+			if not messages and not pending and not connection.ack_needed:
+				continue
+			
+			pos = NETWORK_PACKET_HEADER_LENGTH
+			ids = []
+			for id, data in messages:
+				if pos + len(data) > NETWORK_MAX_PACKET:
+					self.write_packet(connection, pos, ids)
+					pos = NETWORK_PACKET_HEADER_LENGTH
+					ids = []
+				self.packet[pos:pos + len(data)] = data
+				pos += len(data)
+				ids.append(id)
+			while pending:
+				message = pending.popleft()
+				if pos + message.size() > NETWORK_MAX_PACKET:
+					self.write_packet(connection, pos, ids)
+					pos = NETWORK_PACKET_HEADER_LENGTH
+					ids = []
+				pos = message.pack_into(self.packet, pos)
+			self.write_packet(connection, pos, ids)
+
+	def write_packet(self, connection, length, ids):
+		"""
+			Fill in the header of the packet in the send buffer and send it.
+		"""
+		sequence = connection.sequence
+		connection.sequence = (sequence % NETWORK_SEQUENCE_MASK) + 1
+		ack, bits = connection.acks()
+		NETWORK_PACKET_HEADER.pack_into(self.packet, 0, sequence, ack, bits)
+		if ids:
+			connection.sent[sequence] = ids
+		connection.ack_needed = False
+		self.send_packet(connection.address, self.packet_view[:length])
+
+	def send_packet(self, address, data):
+		"""
+			Send a packet, ignoring errors since UDP is unreliable anyway.
+		"""
+		try:
+			self.socket.sendto(data, address)
+		except socket.error, e:
+			Log.warning("Couldn't send packet to %s: %s", address, e)
+
+"""
+	Snapshots of a level's state are quantised to fit in these many bits per
+	value. Positions cover -SNAPSHOT_POSITION_RANGE to SNAPSHOT_POSITION_RANGE.
+"""
+SNAPSHOT_POSITION_RANGE = 512.0
+SNAPSHOT_POSITION_BITS = 16
+SNAPSHOT_ANGLE_BITS = 8
+SNAPSHOT_TIME_RANGE = 16.0
+SNAPSHOT_SIZE_RANGE = 16.0
+SNAPSHOT_SIZE_BITS = 8
+SNAPSHOT_LIFE_BITS = 4
+SNAPSHOT_SEQUENCE_BITS = 16
+SNAPSHOT_ID_BITS = 16
+SNAPSHOT_COUNT_BITS = 12
+SNAPSHOT_BLOCK_COUNT_BITS = 10
+
+"""
+	The bits used by each value of a player (x, y, angle, moving, life) and a
+	bomb (x, y, timer, radius, explosion size, exploding).
+"""
+SNAPSHOT_PLAYER_FIELDS = (SNAPSHOT_POSITION_BITS, SNAPSHOT_POSITION_BITS,
+						  SNAPSHOT_ANGLE_BITS, 1, SNAPSHOT_LIFE_BITS)
+SNAPSHOT_BOMB_FIELDS = (SNAPSHOT_POSITION_BITS, SNAPSHOT_POSITION_BITS,
+						SNAPSHOT_SIZE_BITS, SNAPSHOT_SIZE_BITS,
+						SNAPSHOT_SIZE_BITS, 1)
+
+"""
+	How many snapshots are kept to compute deltas against. Clients that haven't
+	acknowledged any of them get a full snapshot.
+"""
+SNAPSHOT_HISTORY = 32
+
+"""
+	Snapshots are split into pieces small enough to fit in a packet, each
+	sent in its own snapshot message after a header with the snapshot's
+	sequence number, the sequence number of the last input from the client
+	applied before it was captured (NETWORK_NO_ACK if none has been), the
+	piece's index and how many pieces there are.
+"""
+SNAPSHOT_PIECE_HEADER = struct.Struct(">HHBB")
+SNAPSHOT_PIECE_SIZE = NETWORK_MAX_PACKET - NETWORK_PACKET_HEADER_LENGTH - \
+					  NETWORK_HEADER_LENGTH - SNAPSHOT_PIECE_HEADER.size
+SNAPSHOT_MAX_PIECES = 255
+
+"""
+	Clients that send their view only get the objects near what they can see.
+	Objects within the view radius (the camera's zoom times the tangent of
+	half its field of view, times a margin for the tilted camera) are sent in
+	every snapshot, objects up to NETWORK_FAR_SCALE times further away in every
+	NETWORK_FAR_RATE'th snapshot, and anything further away not at all.
+"""
+NETWORK_VIEW_FOV = 25.0
+NETWORK_VIEW_MARGIN = 1.5
+NETWORK_FAR_SCALE = 2.0
+NETWORK_FAR_RATE = 4
+NETWORK_INDEX_CELL_SIZE = 4.0
+
+def quantise(value, low, high, bits):
+	"""
+		Map value in the range low to high onto an integer that fits in bits,
+		clamping it to the range.
+	"""
+	top = (1 << bits) - 1
+	value = int(round((value - low) * top / (high - low)))
+	if value < 0:
+		return 0
+	if value > top:
+		return top
+	return value
+
+def dequantise(value, low, high, bits):
+	"""
+		The reverse of quantise.
+	"""
+	return low + value * (high - low) / ((1 << bits) - 1)
+
+def sequence_newer(sequence, other):
+	"""
+		Return whether sequence number sequence comes after other, allowing for
+		the numbers wrapping around.
+	"""
+	half = 1 << (SNAPSHOT_SEQUENCE_BITS - 1)
+	return sequence != other and \
+		((sequence - other) & ((1 << SNAPSHOT_SEQUENCE_BITS) - 1)) < half
+
+class BitWriter:
+	"""
+		Packs values using only as many bits as each one needs.
+	"""
+	def __init__(self):
+		self.data = bytearray()
+		self.value = 0
+		self.bits = 0
+
+	def write(self, value, bits):
+		"""
+			Write the lowest bits of value.
+		"""
+		self.value = (self.value << bits) | (value & ((1 << bits) - 1))
+		self.bits += bits
+		while self.bits >= 8:
+			self.bits -= 8
+			self.data.append((self.value >> self.bits) & 0xFF)
+		self.value &= (1 << self.bits) - 1
+
+	def getvalue(self):
+		"""
+			Return everything written so far as a string, padded with zero bits
+			to a whole number of bytes.
+		"""
+		data = self.data[:]
+		if self.bits:
+			data.append((self.value << (8 - self.bits)) & 0xFF)
+		return str(data)
+
+class BitReader:
+	"""
+		Reads values written by a BitWriter.
+	"""
+	def __init__(self, data):
+		self.data = bytearray(data)
+		self.pos = 0
+		self.value = 0
+		self.bits = 0
+
+	def read(self, bits):
+		"""
+			Read a value of bits bits.
+		"""
+		while self.bits < bits:
+			if self.pos >= len(self.data):
+				raise ValueError, "snapshot data is truncated"
+			self.value = (self.value << 8) | self.data[self.pos]
+			self.pos += 1
+			self.bits += 8
+		self.bits -= bits
+		value = self.value >> self.bits
+		self.value &= (1 << self.bits) - 1
+		return value
+
+def player_state(player):
+	"""
+		Return the quantised state of a player stored in a Snapshot.
+	"""
+	angle = player.motion.angle
+	if angle is None:
+		angle = 0.0
+	return (quantise(player.x, -SNAPSHOT_POSITION_RANGE, SNAPSHOT_POSITION_RANGE, SNAPSHOT_POSITION_BITS),
+			quantise(player.y, -SNAPSHOT_POSITION_RANGE, SNAPSHOT_POSITION_RANGE, SNAPSHOT_POSITION_BITS),
+			quantise(angle % (2 * pi), 0.0, 2 * pi, SNAPSHOT_ANGLE_BITS),
+			int(bool(player.motion.moving)),
+			min(player.life, (1 << SNAPSHOT_LIFE_BITS) - 1))
+
+def bomb_state(bomb):
+	"""
+		Return the quantised state of a bomb stored in a Snapshot.
+	"""
+	return (quantise(bomb.x, -SNAPSHOT_POSITION_RANGE, SNAPSHOT_POSITION_RANGE, SNAPSHOT_POSITION_BITS),
+			quantise(bomb.y, -SNAPSHOT_POSITION_RANGE, SNAPSHOT_POSITION_RANGE, SNAPSHOT_POSITION_BITS),
+			quantise(bomb.timer, 0.0, SNAPSHOT_TIME_RANGE, SNAPSHOT_SIZE_BITS),
+			quantise(bomb.radius, 0.0, SNAPSHOT_SIZE_RANGE, SNAPSHOT_SIZE_BITS),
+			quantise(bomb.current_size, 0.0, SNAPSHOT_SIZE_RANGE, SNAPSHOT_SIZE_BITS),
+			int(bool(bomb.exploding)))
+
+class View:
+	"""
+		What a client can see: the face of the level its camera is on, the
+		camera's zoom and the x, y position it is looking at.
+	"""
+	def __init__(self, face = 0, zoom = 30.0, x = 0.0, y = 0.0):
+		self.face = face
+		self.zoom = zoom
+		self.x = x
+		self.y = y
+
+	def radius(self):
+		"""
+			Return how far from x, y objects can be seen.
+		"""
+		return self.zoom * tan(radians(NETWORK_VIEW_FOV / 2.0)) * NETWORK_VIEW_MARGIN
+
+	def message(self):
+		"""
+			Return a message telling the server about this view.
+		"""
+		return Message(time(), 0, NETWORK_MESSAGE_VIEW, NETWORK_FLAG_RELIABLE,
+					   [self.face, self.zoom, self.x, self.y])
+
+	def read(self, message):
+		"""
+			Set this view from a view message.
+		"""
+		self.face, self.zoom, self.x, self.y = message.data
+
+class SpatialIndex:
+	"""
+		A grid of objects by position so the ones near a point can be found
+		without looking at all of them.
+	"""
+	def __init__(self, size = NETWORK_INDEX_CELL_SIZE):
+		self.size = size
+		self.cells = {}
+
+	def build(self, objects):
+		"""
+			Index a list of objects, replacing the ones indexed before.
+		"""
+		cells = {}
+		size = self.size
+		for object in objects:
+			key = (int(object.x // size), int(object.y // size))
+			cell = cells.get(key)
+			if cell is None:
+				cells[key] = [object]
+			else:
+				cell.append(object)
+		self.cells = cells
+
+	def query(self, x, y, radius):
+		"""
+			Return the objects within radius of x, y.
+		"""
+		size = self.size
+		found = []
+		radius2 = radius * radius
+		cells = self.cells
+		if not cells:
+			return found
+		left = int((x - radius) // size)
+		right = int((x + radius) // size)
+		bottom = int((y - radius) // size)
+		top = int((y + radius) // size)
+		if (right - left + 1) * (top - bottom + 1) > len(cells):
+			# Cheaper to look at every cell than every key in range
+			keys = [key for key in cells if left <= key[0] <= right and \
+					bottom <= key[1] <= top]
+		else:
+			keys = [(cx, cy) for cx in xrange(left, right + 1) \
+					for cy in xrange(bottom, top + 1)]
+		for key in keys:
+			cell = cells.get(key)
+			if cell is None:
+				continue
+			for object in cell:
+				dx = object.x - x
+				dy = object.y - y
+				if dx * dx + dy * dy <= radius2:
+					found.append(object)
+		return found
+
+class Snapshot:
+	"""
+		The state of a level at one point in time as seen by the server.
+		Players and bombs are stored in dictionaries by object id as tuples of
+		quantised values (see SNAPSHOT_PLAYER_FIELDS and SNAPSHOT_BOMB_FIELDS),
+		and blocks as a tuple of whether each block spawn has a block.
+
+		Snapshots are encoded as deltas against a baseline snapshot the other
+		end already has: only the values that changed are sent, along with
+		the ids of objects that are gone.
+	"""
+	def __init__(self, sequence = 0):
+		self.sequence = sequence
+		self.baseline = None
+		self.players = {}
+		self.bombs = {}
+		self.blocks = ()
+		# The last input applied before it was captured, see SnapshotClient
+		self.input = None
+
+	def capture(self, level):
+		"""
+			Store the current state of level.
+		"""
+		self.players = {}
+		for player in level.players:
+			self.players[player.id] = player_state(player)
+		self.bombs = {}
+		for item in level.items:
+			if item.type == "Bomb":
+				self.bombs[item.id] = bomb_state(item)
+		self.blocks = tuple([int(bool(spawn.block)) for spawn in level.blockspawns])
+
+	def position(self, state):
+		"""
+			Return the x, y position stored in a player or bomb state.
+		"""
+		low = -SNAPSHOT_POSITION_RANGE
+		high = SNAPSHOT_POSITION_RANGE
+		return (dequantise(state[0], low, high, SNAPSHOT_POSITION_BITS),
+				dequantise(state[1], low, high, SNAPSHOT_POSITION_BITS))
+
+	def apply(self, level):
+		"""
+			Make level match this snapshot, adding and removing players and
+			bombs as needed.
+		"""
+		import Objects
+		low = -SNAPSHOT_POSITION_RANGE
+		high = SNAPSHOT_POSITION_RANGE
+
+		players = {}
+		for pos in range(len(level.players) - 1, -1, -1):
+			player = level.players[pos]
+			if player.id in self.players:
+				players[player.id] = player
+			else:
+				del level.players[pos]
+		for id, state in self.players.items():
+			player = players.get(id)
+			if player is None:
+				player = Objects.Player()
+				player.id = id
+				player.name = "Player %d" % id
+				level.players.append(player)
+			x, y, angle, moving, life = state
+			player.x = dequantise(x, low, high, SNAPSHOT_POSITION_BITS)
+			player.y = dequantise(y, low, high, SNAPSHOT_POSITION_BITS)
+			player.motion.angle = dequantise(angle, 0.0, 2 * pi, SNAPSHOT_ANGLE_BITS)
+			player.motion.moving = bool(moving)
+			player.life = life
+
+		bombs = {}
+		for pos in range(len(level.items) - 1, -1, -1):
+			item = level.items[pos]
+			if item.type != "Bomb":
+				continue
+			if item.id in self.bombs:
+				bombs[item.id] = item
+			else:
+				level.danger.remove(item)
+				del level.items[pos]
+		for id, state in self.bombs.items():
+			bomb = bombs.get(id)
+			if bomb is None:
+				bomb = Objects.Bomb()
+				bomb.id = id
+				level.items.append(bomb)
+			x, y, timer, radius, size, exploding = state
+			bomb.x = dequantise(x, low, high, SNAPSHOT_POSITION_BITS)
+			bomb.y = dequantise(y, low, high, SNAPSHOT_POSITION_BITS)
+			bomb.timer = dequantise(timer, 0.0, SNAPSHOT_TIME_RANGE, SNAPSHOT_SIZE_BITS)
+			bomb.current_size = dequantise(size, 0.0, SNAPSHOT_SIZE_RANGE, SNAPSHOT_SIZE_BITS)
+			bomb.exploding = exploding
+			new_radius = dequantise(radius, 0.0, SNAPSHOT_SIZE_RANGE, SNAPSHOT_SIZE_BITS)
+			if bomb.id not in bombs or new_radius != bomb.radius:
+				bomb.radius = new_radius
+				level.danger.add(bomb)
+
+		for spawn, block in zip(level.blockspawns, self.blocks):
+			if bool(spawn.block) != bool(block):
+				spawn.block = bool(block)
+				level.block_changed(spawn)
 
-	def send(to, message):
-		pass
+	def encode(self, baseline = None):
+		"""
+			Return this snapshot as a string of bits, encoded as a delta
+			against baseline if given.
+		"""
+		writer = BitWriter()
+		writer.write(self.sequence, SNAPSHOT_SEQUENCE_BITS)
+		if baseline is None:
+			writer.write(0, 1)
+			baseline = Snapshot()
+		else:
+			writer.write(1, 1)
+			writer.write(baseline.sequence, SNAPSHOT_SEQUENCE_BITS)
+		self.encode_objects(writer, self.players, baseline.players, SNAPSHOT_PLAYER_FIELDS)
+		self.encode_objects(writer, self.bombs, baseline.bombs, SNAPSHOT_BOMB_FIELDS)
+		if self.blocks == baseline.blocks:
+			writer.write(0, 1)
+		else:
+			writer.write(1, 1)
+			writer.write(len(self.blocks), SNAPSHOT_BLOCK_COUNT_BITS)
+			for block in self.blocks:
+				writer.write(block, 1)
+		return writer.getvalue()
+
+	def encode_objects(self, writer, objects, baseline, fields):
+		"""
+			Write the ids of the objects in baseline that are gone, followed by
+			the id, a mask of which values changed and the changed values of
+			every object that is new or has changed.
+		"""
+		removed = [id for id in baseline if id not in objects]
+		removed.sort()
+		writer.write(len(removed), SNAPSHOT_COUNT_BITS)
+		for id in removed:
+			writer.write(id, SNAPSHOT_ID_BITS)
+
+		empty = (0,) * len(fields)
+		changed = [id for id, state in objects.items() if baseline.get(id) != state]
+		changed.sort()
+		writer.write(len(changed), SNAPSHOT_COUNT_BITS)
+		for id in changed:
+			state = objects[id]
+			old = baseline.get(id, empty)
+			writer.write(id, SNAPSHOT_ID_BITS)
+			for value, old_value in zip(state, old):
+				writer.write(value != old_value, 1)
+			for value, old_value, bits in zip(state, old, fields):
+				if value != old_value:
+					writer.write(value, bits)
+
+	def decode(self, data, baselines = None):
+		"""
+			Read a snapshot written by encode. Baselines is a dictionary of
+			snapshots by sequence number to find the one it was encoded
+			against; ValueError is raised if it isn't there.
+		"""
+		reader = BitReader(data)
+		self.sequence = reader.read(SNAPSHOT_SEQUENCE_BITS)
+		if reader.read(1):
+			self.baseline = reader.read(SNAPSHOT_SEQUENCE_BITS)
+			if baselines is None or self.baseline not in baselines:
+				raise ValueError, "missing baseline snapshot %d" % self.baseline
+			baseline = baselines[self.baseline]
+		else:
+			self.baseline = None
+			baseline = Snapshot()
+		self.players = self.decode_objects(reader, baseline.players, SNAPSHOT_PLAYER_FIELDS)
+		self.bombs = self.decode_objects(reader, baseline.bombs, SNAPSHOT_BOMB_FIELDS)
+		if reader.read(1):
+			count = reader.read(SNAPSHOT_BLOCK_COUNT_BITS)
+			self.blocks = tuple([reader.read(1) for pos in xrange(count)])
+		else:
+			self.blocks = baseline.blocks
+
+	def decode_objects(self, reader, baseline, fields):
+		"""
+			Read objects written by encode_objects and return them.
+		"""
+		objects = baseline.copy()
+		for pos in xrange(reader.read(SNAPSHOT_COUNT_BITS)):
+			objects.pop(reader.read(SNAPSHOT_ID_BITS), None)
+		empty = (0,) * len(fields)
+		for pos in xrange(reader.read(SNAPSHOT_COUNT_BITS)):
+			id = reader.read(SNAPSHOT_ID_BITS)
+			state = list(objects.get(id, empty))
+			mask = [reader.read(1) for bits in fields]
+			for index, bits in enumerate(fields):
+				if mask[index]:
+					state[index] = reader.read(bits)
+			objects[id] = tuple(state)
+		return objects
+
+class SnapshotServer:
+	"""
+		Captures snapshots of a level on the server and encodes them for each
+		client against the last snapshot that client acknowledged.
+
+		Clients that have set a view get their own snapshots with only the
+		objects relevant to that view (see NETWORK_VIEW_MARGIN), found with a
+		spatial index, so building them costs as much as what the client can
+		see. Everyone else shares one snapshot of the whole level, which is
+		only built if someone needs it.
+	"""
+	def __init__(self, history = SNAPSHOT_HISTORY):
+		self.history = history
+		self.sequence = 0
+		self.snapshots = {}
+		self.order = []
+		self.acked = {}
+		self.views = {}
+		self.sent = {}
+		self.level = None
+		self.shared = None
+		self.players = SpatialIndex()
+		self.bombs = SpatialIndex()
+
+	def capture(self, level):
+		"""
+			Start a new snapshot of level and return its sequence number. The
+			snapshots themselves are built by encode.
+		"""
+		self.sequence = (self.sequence + 1) & ((1 << SNAPSHOT_SEQUENCE_BITS) - 1)
+		self.level = level
+		self.shared = None
+		if self.views:
+			self.players.build(level.players)
+			self.bombs.build([item for item in level.items if item.type == "Bomb"])
+		return self.sequence
+
+	def set_view(self, client, view, focus = None):
+		"""
+			Only send client the objects relevant to view from now on. Focus is
+			an object that is always relevant, such as the client's player.
+		"""
+		self.views[client] = (view, focus)
+
+	def history_for(self, client):
+		"""
+			Return the snapshots sent to client by sequence number and the
+			order they were sent in.
+		"""
+		if client in self.views:
+			history = self.sent.get(client)
+			if history is None:
+				history = ({}, [])
+				self.sent[client] = history
+			return history
+		return (self.snapshots, self.order)
+
+	def snapshot_for(self, client):
+		"""
+			Return the latest snapshot for client, building it if needed.
+		"""
+		snapshots, order = self.history_for(client)
+		if order and order[-1] == self.sequence:
+			return snapshots[self.sequence]
+		if client in self.views:
+			snapshot = self.relevant(client, order and snapshots[order[-1]])
+		else:
+			snapshot = Snapshot(self.sequence)
+			snapshot.capture(self.level)
+		snapshots[snapshot.sequence] = snapshot
+		order.append(snapshot.sequence)
+		if len(order) > self.history:
+			del snapshots[order.pop(0)]
+		return snapshot
 
-	def recv(from = None):
-		pass
+	def relevant(self, client, last = None):
+		"""
+			Build a snapshot of the objects relevant to client's view. Far
+			objects that aren't due an update keep their state from last.
+		"""
+		view, focus = self.views[client]
+		snapshot = Snapshot(self.sequence)
+		near = view.radius()
+		far = near * NETWORK_FAR_SCALE
+		self.gather(snapshot.players, self.players.query(view.x, view.y, far),
+					player_state, last and last.players, view, near)
+		self.gather(snapshot.bombs, self.bombs.query(view.x, view.y, far),
+					bomb_state, last and last.bombs, view, near)
+		if focus is not None and focus in self.level.players:
+			snapshot.players[focus.id] = player_state(focus)
+		snapshot.blocks = tuple([int(bool(spawn.block)) for spawn in self.level.blockspawns])
+		return snapshot
+
+	def gather(self, states, objects, state, last, view, near):
+		"""
+			Store the states of objects, using the ones in last for far objects
+			that aren't due an update.
+		"""
+		near2 = near * near
+		for object in objects:
+			if last and object.id in last and \
+			   (self.sequence + object.id) % NETWORK_FAR_RATE:
+				dx = object.x - view.x
+				dy = object.y - view.y
+				if dx * dx + dy * dy > near2:
+					states[object.id] = last[object.id]
+					continue
+			states[object.id] = state(object)
+
+	def encode(self, client):
+		"""
+			Return the latest snapshot encoded for client.
+		"""
+		snapshot = self.snapshot_for(client)
+		snapshots, order = self.history_for(client)
+		baseline = snapshots.get(self.acked.get(client))
+		if baseline is snapshot:
+			baseline = None
+		return snapshot.encode(baseline)
+
+	def ack(self, client, sequence):
+		"""
+			Record that client has received snapshot sequence.
+		"""
+		if sequence not in self.history_for(client)[0]:
+			return
+		acked = self.acked.get(client)
+		if acked is None or sequence_newer(sequence, acked):
+			self.acked[client] = sequence
+
+	def remove(self, client):
+		"""
+			Forget about a client.
+		"""
+		self.acked.pop(client, None)
+		self.views.pop(client, None)
+		self.sent.pop(client, None)
+
+class SnapshotClient:
+	"""
+		Decodes the snapshots sent by a SnapshotServer on the client. Each
+		snapshot received should be acknowledged to the server so it can be
+		used as the baseline for the next ones.
+	"""
+	def __init__(self, history = SNAPSHOT_HISTORY):
+		self.history = history
+		self.snapshots = {}
+		self.order = []
+		self.latest = None
+		self.pieces = {}
+
+	def receive(self, data):
+		"""
+			Collect a piece of a snapshot from a snapshot message. Returns the
+			decoded snapshot once all of its pieces have arrived, or None if
+			some are still missing or it is older than the latest one
+			received. The snapshot's input is the sequence number of the last
+			input the server applied before capturing it, or None.
+		"""
+		sequence, input, index, count = SNAPSHOT_PIECE_HEADER.unpack_from(data)
+		if self.latest is not None and \
+		   not sequence_newer(sequence, self.latest.sequence):
+			return None
+		if sequence not in self.pieces and len(self.pieces) >= self.history:
+			# Too many snapshots are missing pieces to wait for them all
+			self.pieces.clear()
+		pieces = self.pieces.setdefault(sequence, {})
+		pieces[index] = data[SNAPSHOT_PIECE_HEADER.size:]
+		if len(pieces) < count:
+			return None
+		for other in self.pieces.keys():
+			if not sequence_newer(other, sequence):
+				del self.pieces[other]
+		snapshot = self.decode("".join([pieces[pos] for pos in xrange(count)]))
+		if snapshot is not None and input != NETWORK_NO_ACK:
+			snapshot.input = input
+		return snapshot
+
+	def decode(self, data):
+		"""
+			Decode a whole snapshot and return it, or None if it is older than
+			the latest one received.
+		"""
+		snapshot = Snapshot()
+		snapshot.decode(data, self.snapshots)
+		if self.latest is not None and \
+		   not sequence_newer(snapshot.sequence, self.latest.sequence):
+			return None
+		self.snapshots[snapshot.sequence] = snapshot
+		self.order.append(snapshot.sequence)
+		if len(self.order) > self.history:
+			del self.snapshots[self.order.pop(0)]
+		self.latest = snapshot
+		return snapshot
+
+def input_message(sequence, angle, moving, bomb = False):
+	"""
+		Return a message with a player's input for the server.
+	"""
+	if angle is None:
+		angle = 0.0
+	flags = 0
+	if moving:
+		flags |= NETWORK_INPUT_MOVING
+	if bomb:
+		flags |= NETWORK_INPUT_BOMB
+	return Message(time(), 0, NETWORK_MESSAGE_INPUT, 0,
+				   [sequence, quantise(angle % (2 * pi), 0.0, 2 * pi, 8), flags])
+
+def snapshot_messages(sequence, data, input = None):
+	"""
+		Return the snapshot messages carrying the encoded snapshot data with
+		sequence number sequence, split into pieces that each fit in a
+		packet. Input is the sequence number of the last input from the
+		client applied before the snapshot was captured, if any. ValueError
+		is raised if it takes more than SNAPSHOT_MAX_PIECES.
+	"""
+	if input is None:
+		input = NETWORK_NO_ACK
+	count = max((len(data) + SNAPSHOT_PIECE_SIZE - 1) // SNAPSHOT_PIECE_SIZE, 1)
+	if count > SNAPSHOT_MAX_PIECES:
+		raise ValueError, "snapshot too large"
+	messages = []
+	for index in xrange(count):
+		piece = data[index * SNAPSHOT_PIECE_SIZE:(index + 1) * SNAPSHOT_PIECE_SIZE]
+		messages.append(Message(time(), 0, NETWORK_MESSAGE_SNAPSHOT, 0,
+								SNAPSHOT_PIECE_HEADER.pack(sequence, input, index, count) + piece))
+	return messages
+
+def read_input(message):
+	"""
+		Return the sequence number, angle, moving and bomb of an input
+		message.
+	"""
+	sequence, angle, flags = message.data
+	return (sequence, dequantise(angle, 0.0, 2 * pi, 8),
+			bool(flags & NETWORK_INPUT_MOVING), bool(flags & NETWORK_INPUT_BOMB))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+	Boom Null OpenGL
+	================
+		Stand-ins for the OpenGL, GLU and GLUT functions and constants the
+		engine uses, used by Graphics in place of the real bindings when the
+		null graphics backend is selected (see Backend). Every function does
+		nothing, and the constants have their usual values.
+	
+		License
+		-------
+		Copyright (C) 2006 Daniel G. Taylor
+
+		This program is free software; you can redistribute it and/or modify
+		it under the terms of the GNU General Public License as published by
+		the Free Software Foundation; either version 2 of the License, or
+		(at your option) any later version.
+
+		This program is distributed in the hope that it will be useful,
+		but WITHOUT ANY WARRANTY; without even the implied warranty of
+		MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+		GNU General Public License for more details.
+
+		You should have received a copy of the GNU General Public License
+		along with this program; if not, write to the Free Software
+		Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307 USA
+"""
+
+GL_ONE = 0x0001
+GL_LINE_LOOP = 0x0002
+GL_POLYGON = 0x0009
+GL_DEPTH_BUFFER_BIT = 0x0100
+GL_LEQUAL = 0x0203
+GL_SRC_ALPHA = 0x0302
+GL_ONE_MINUS_SRC_ALPHA = 0x0303
+GL_FRONT = 0x0404
+GL_BACK = 0x0405
+GL_CULL_FACE = 0x0B44
+GL_LIGHTING = 0x0B50
+GL_DEPTH_TEST = 0x0B71
+GL_NORMALIZE = 0x0BA1
+GL_BLEND = 0x0BE2
+GL_PERSPECTIVE_CORRECTION_HINT = 0x0C50
+GL_TEXTURE_2D = 0x0DE1
+GL_NICEST = 0x1102
+GL_AMBIENT = 0x1200
+GL_DIFFUSE = 0x1201
+GL_SPECULAR = 0x1202
+GL_POSITION = 0x1203
+GL_COMPILE_AND_EXECUTE = 0x1301
+GL_UNSIGNED_BYTE = 0x1401
+GL_SHININESS = 0x1601
+GL_MODELVIEW = 0x1700
+GL_PROJECTION = 0x1701
+GL_RGB = 0x1907
+GL_SMOOTH = 0x1D01
+GL_LINEAR = 0x2601
+GL_TEXTURE_MAG_FILTER = 0x2800
+GL_TEXTURE_MIN_FILTER = 0x2801
+GL_TRANSFORM_BIT = 0x1000
+GL_COLOR_BUFFER_BIT = 0x4000
+GL_LIGHT1 = 0x4001
+
+GLUT_BITMAP_HELVETICA_12 = 0x0007
+GLUT_BITMAP_HELVETICA_18 = 0x0008
+
+def _nothing(*args):
+	pass
+
+glBegin = glBindTexture = glBlendFunc = glCallList = glClear = _nothing
+glClearColor = glClearDepth = glColor3f = glColor3fv = glColor4f = _nothing
+glCullFace = glDepthFunc = glDisable = glEnable = glEnd = glEndList = _nothing
+glHint = glLightfv = glLoadIdentity = glLoadMatrixf = glMaterialfv = _nothing
+glMateriali = glMatrixMode = glNewList = glNormal3fv = glPopAttrib = _nothing
+glPopMatrix = glPushAttrib = glPushMatrix = glRasterPos2f = glRotatef = _nothing
+glScalef = glShadeModel = glTexCoord2fv = glTexImage2D = _nothing
+glTexParameteri = glTranslatef = glVertex3f = glVertex3fv = glViewport = _nothing
+
+gluBuild2DMipmaps = gluLookAt = gluPerspective = _nothing
+
+glutBitmapCharacter = glutInit = glutSolidCube = glutSolidSphere = _nothing
+
+def glGenLists(range):
+	return 1
+
+def glGenTextures(count):
+	return 1
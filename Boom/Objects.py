@@ -29,11 +29,16 @@ import DataManager
 import Interface
 import Log
 import Event
+import Sound
 
 from Graphics import *
 
 from math import sin, asin, sqrt, degrees, radians, pi, atan2
 from time import time
+from collections import OrderedDict
+from array import array
+from cStringIO import StringIO
+import multiprocessing
 
 ITEM_ANIM_NONE = 0
 ITEM_ANIM_THROB = 1
@@ -46,13 +51,451 @@ PICKUP_BIG_BOMBS = 2
 PICKUP_MINI_BOMBS = 3
 PICKUP_TYPE_COUNT = 4
 
+# Extra distance objects are pushed out of each other when they collide, so
+# rounding errors do not leave them touching
+COLLISION_SKIN = 0.001
+
+# Sound effect (from the Sounds directory) played where a bomb explodes, or
+# None for silent explosions
+BOMB_EXPLOSION_SOUND = None
+
+# How objects are moved and checked for collisions. Discrete collisions move
+# the object and then check whether it overlaps anything, while swept
+# collisions find the first thing the object would hit along the way so it
+# can't skip through anything thin at high speeds or large time steps. Auto
+# only sweeps when an object moves more than COLLISION_SWEEP_DISTANCE times
+# its hull radius in a single update.
+COLLISION_DISCRETE = 0
+COLLISION_SWEPT = 1
+COLLISION_AUTO = 2
+COLLISION_SWEEP_DISTANCE = 0.5
+DEFAULT_COLLISION_MODE = COLLISION_AUTO
+
+# How many times a swept move can slide along what it hits per update
+COLLISION_SLIDES = 2
+
+# How many navigation mesh corridors each level keeps cached, and how close
+# computer players have to get to a waypoint before heading for the next one
+PATH_CACHE_SIZE = 128
+PATH_WAYPOINT_RADIUS = 0.1
+
+# Size of the cells in each level's danger map
+DANGER_CELL_SIZE = 0.5
+
+# How often (in seconds) each computer player rethinks what it is doing, and
+# how many of them may do so in a single update. Running away from bombs is
+# still checked every update.
+AI_THINK_INTERVAL = 0.25
+AI_THINK_BUDGET = 4
+
+# How many processes each level uses to think for its computer players (0 to
+# think in this process), and the fewest players worth sending to them in an
+# update; fewer than that think in this process
+AI_THINK_PROCESSES = 0
+AI_THINK_POOL_MIN = 8
+
+# How many values are stored per player in a LevelSnapshot
+SNAPSHOT_PLAYER_SIZE = 3
+
+#-------------------------------------------------------------------------------
+class PathCache:
+	"""
+	Path Cache
+	==========
+		Finds and caches paths across a level's navigation mesh. Corridors
+		(the triangles a path passes through) are cached by start and goal
+		triangle, so computer players chasing the same target from the same
+		area share one A* search, and the least recently used ones are dropped
+		when there are more than size of them.
+		
+		Triangles under blocks are avoided, counting how many blocks cover
+		each one since neighboring blocks can share a triangle. When a block
+		appears only the cached corridors that go through it are dropped;
+		when one disappears every corridor is dropped since there may now be
+		shorter ones. Either way generation goes up so anything holding on to
+		a path knows to ask for a new one.
+	"""
+	def __init__(self, navigation, size = PATH_CACHE_SIZE):
+		self.navigation = navigation
+		self.size = size
+		self.corridors = OrderedDict()
+		self.blocked = {}
+		self.generation = 0
+	
+	def corridor(self, start, goal):
+		"""
+		Return the list of triangle indexes from start to goal, or None if
+		there is no way between them.
+		"""
+		key = (start, goal)
+		corridor = self.corridors.pop(key, False)
+		if corridor is False:
+			corridor = self.navigation.find_corridor(start, goal, self.blocked)
+			if len(self.corridors) >= self.size:
+				self.corridors.popitem(False)
+		self.corridors[key] = corridor
+		return corridor
+	
+	def covered(self, x, y, hull = None):
+		"""
+		Return the triangles under the bounding box of a Hull2d moved to x,
+		y, or the one under x, y if there is no hull.
+		"""
+		if not hull:
+			triangle = self.navigation.find(x, y)
+			if triangle == -1:
+				return []
+			return [triangle]
+		xs = [vertex.x for vertex in hull]
+		ys = [vertex.y for vertex in hull]
+		return self.navigation.overlapping(x + min(xs), y + min(ys),
+										   x + max(xs), y + max(ys))
+	
+	def block(self, x, y, hull = None):
+		"""
+		Avoid the triangles under a block at x, y from now on, see covered.
+		"""
+		added = set()
+		for triangle in self.covered(x, y, hull):
+			count = self.blocked.get(triangle, 0)
+			if not count:
+				added.add(triangle)
+			self.blocked[triangle] = count + 1
+		if not added:
+			return
+		for key, corridor in self.corridors.items():
+			if corridor is not None and added.intersection(corridor):
+				del self.corridors[key]
+		self.generation += 1
+	
+	def unblock(self, x, y, hull = None):
+		"""
+		Stop avoiding the triangles under a block at x, y that no other block
+		covers.
+		"""
+		removed = False
+		for triangle in self.covered(x, y, hull):
+			count = self.blocked.get(triangle, 0)
+			if count > 1:
+				self.blocked[triangle] = count - 1
+			elif count:
+				del self.blocked[triangle]
+				removed = True
+		if not removed:
+			return
+		self.corridors.clear()
+		self.generation += 1
+
+#-------------------------------------------------------------------------------
+class DangerMap:
+	"""
+	Danger Map
+	==========
+		A grid over the level recording how dangerous each cell is because of
+		bombs. Bombs stamp the cells within their blast radius when they are
+		added and remove their stamp when they are done exploding, so asking
+		how dangerous a spot is costs the same no matter how many bombs there
+		are.
+		
+		A cell's danger is the sum over the bombs covering it of how far
+		inside the blast radius the cell is (in squared distance), so it
+		falls off towards the edge of a blast and moving to the neighboring
+		cell with the least danger leads out of it.
+	"""
+	def __init__(self, size = DANGER_CELL_SIZE):
+		self.size = size
+		self.danger = {}
+		self.counts = {}
+		self.stamps = {}
+	
+	def cell(self, x, y):
+		"""
+		Return the key of the cell containing x, y.
+		"""
+		return (int(x // self.size), int(y // self.size))
+	
+	def add(self, bomb):
+		"""
+		Stamp a bomb's blast radius onto the map.
+		"""
+		if bomb in self.stamps:
+			self.remove(bomb)
+		cells = []
+		size = self.size
+		radius = bomb.radius * bomb.radius + 0.1
+		reach = int(sqrt(radius) // size) + 1
+		column, row = self.cell(bomb.x, bomb.y)
+		for cx in xrange(column - reach, column + reach + 1):
+			for cy in xrange(row - reach, row + reach + 1):
+				dx = (cx + 0.5) * size - bomb.x
+				dy = (cy + 0.5) * size - bomb.y
+				amount = radius - (dx * dx + dy * dy)
+				if amount > 0:
+					key = (cx, cy)
+					self.danger[key] = self.danger.get(key, 0.0) + amount
+					self.counts[key] = self.counts.get(key, 0) + 1
+					cells.append((key, amount))
+		self.stamps[bomb] = cells
+	
+	def remove(self, bomb):
+		"""
+		Remove a bomb's stamp from the map.
+		"""
+		cells = self.stamps.pop(bomb, None)
+		if cells is None:
+			return
+		for key, amount in cells:
+			count = self.counts[key] - 1
+			if count:
+				self.counts[key] = count
+				self.danger[key] -= amount
+			else:
+				del self.counts[key]
+				del self.danger[key]
+	
+	def at(self, x, y):
+		"""
+		Return how dangerous the point x, y is, 0 if it is safe.
+		"""
+		return self.danger.get(self.cell(x, y), 0)
+	
+	def escape(self, x, y, navigation = None):
+		"""
+		Return the angle towards the least dangerous neighboring cell of x, y,
+		or None if none of them are any safer. Cells off the navigation mesh
+		are skipped if one is given.
+		"""
+		column, row = self.cell(x, y)
+		best = self.danger.get((column, row), 0)
+		best_x = None
+		best_y = None
+		for cx in (column - 1, column, column + 1):
+			for cy in (row - 1, row, row + 1):
+				danger = self.danger.get((cx, cy), 0)
+				if danger >= best:
+					continue
+				center_x = (cx + 0.5) * self.size
+				center_y = (cy + 0.5) * self.size
+				if navigation is not None and not navigation.walkable(center_x, center_y):
+					continue
+				best = danger
+				best_x = center_x
+				best_y = center_y
+		if best_x is None:
+			return None
+		return atan2(best_y - y, best_x - x)
+
+#-------------------------------------------------------------------------------
+class LevelSnapshot:
+	"""
+	Level Snapshot
+	==============
+		The parts of a level computer players need to decide what to do,
+		packed into a string so it is cheap to send to other processes and
+		can't be changed while they use it. For each player the x, y position
+		and hull radius are stored, followed by the triangles of the
+		navigation mesh that are blocked.
+		
+		Decisions made from a snapshot only depend on the snapshot, so they
+		are the same no matter which process makes them or in which order.
+	"""
+	def __init__(self, level):
+		players = array("d")
+		for player in level.players:
+			players.append(player.x)
+			players.append(player.y)
+			players.append(DataManager.meshes[player.mesh].hull.radius)
+		self.players = players.tostring()
+		if level.paths is not None:
+			self.blocked = tuple(sorted(level.paths.blocked))
+		else:
+			self.blocked = None
+	
+	def decide(self, index, paths = None):
+		"""
+		Decide what the player at index should do. Returns the angle to head
+		in (or None), whether to move and whether to drop a bomb. Paths is
+		the PathCache to find the way with, which must match the level's
+		blocked triangles, or None to head straight for the target.
+		"""
+		players = array("d", self.players)
+		base = index * SNAPSHOT_PLAYER_SIZE
+		x, y, radius = players[base:base + SNAPSHOT_PLAYER_SIZE]
+		
+		# Select our closest target and go after her!
+		closest = None
+		closest_distance = 1000
+		for other in xrange(0, len(players), SNAPSHOT_PLAYER_SIZE):
+			if other != base:
+				diffx = x - players[other]
+				diffy = y - players[other + 1]
+				distance = diffx * diffx + diffy * diffy
+				if distance < closest_distance:
+					closest = other
+					closest_distance = distance
+		if closest is None:
+			return (None, False, False)
+		
+		target_x = players[closest]
+		target_y = players[closest + 1]
+		min_radius = radius + players[closest + 2]
+		bomb = closest_distance < (min_radius * min_radius) + 0.1
+		
+		if paths is not None:
+			navigation = paths.navigation
+			start = navigation.find(x, y)
+			goal = navigation.find(target_x, target_y)
+			if start != -1 and goal != -1:
+				corridor = paths.corridor(start, goal)
+				if corridor is not None:
+					waypoints = navigation.funnel(corridor, x, y, target_x, target_y)
+					for waypoint in waypoints[:-1]:
+						dx = waypoint.x - x
+						dy = waypoint.y - y
+						if dx * dx + dy * dy > PATH_WAYPOINT_RADIUS * PATH_WAYPOINT_RADIUS:
+							target_x = waypoint.x
+							target_y = waypoint.y
+							break
+		return (atan2(target_y - y, target_x - x), True, bomb)
+
+# The navigation mesh and paths of a thinking process, see AIScheduler
+_thinking_paths = None
+
+def _start_thinking(data):
+	"""
+	Set up a thinking process with the level's compiled navigation mesh.
+	"""
+	global _thinking_paths
+	if data is None:
+		_thinking_paths = None
+	else:
+		navigation = NaviMesh()
+		navigation.load(StringIO(data))
+		_thinking_paths = PathCache(navigation)
+
+def _think(job):
+	"""
+	Make the decisions for a list of player indexes in a thinking process.
+	"""
+	snapshot, indexes = job
+	paths = _thinking_paths
+	if paths is not None and snapshot.blocked is not None and \
+	   tuple(sorted(paths.blocked)) != snapshot.blocked:
+		paths.blocked = dict.fromkeys(snapshot.blocked, 1)
+		paths.corridors.clear()
+	return [snapshot.decide(index, paths) for index in indexes]
+
+#-------------------------------------------------------------------------------
+class AIScheduler:
+	"""
+	AI Scheduler
+	============
+		Decides which computer players get to think during an update. Each
+		one waits at least its think_interval between thoughts and at most
+		budget of them think per update, taken in turn so none are starved.
+		This keeps the cost of thinking per update bounded no matter how many
+		computer players there are.
+		
+		If processes is more than zero the thinking is done by that many
+		processes instead, from a LevelSnapshot taken at the start of the
+		update. The decisions are handed back to the players in order before
+		any of them move, so the result doesn't depend on which process
+		finishes first. There is no budget then: every player whose
+		think_interval is up thinks, so players stay in step and think in
+		one batch, and a snapshot is only sent once per batch. Batches
+		smaller than AI_THINK_POOL_MIN think in this process, where they are
+		cheaper than the trip to the pool. This is meant for servers running
+		matches with dozens of computer players; Level.load starts the
+		processes and Level.close stops them.
+	"""
+	def __init__(self, budget = AI_THINK_BUDGET, processes = 0):
+		self.budget = budget
+		self.next = 0
+		self.processes = processes
+		self.pool = None
+	
+	def start(self, level):
+		"""
+		Start the thinking processes for a level.
+		"""
+		self.close()
+		data = None
+		if level.navigation is not None:
+			file = StringIO()
+			level.navigation.save(file)
+			data = file.getvalue()
+		self.pool = multiprocessing.Pool(self.processes, _start_thinking, (data,))
+	
+	def close(self):
+		"""
+		Stop the thinking processes, if any.
+		"""
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+	
+	def think(self, level):
+		"""
+		Make the decisions of the players scheduled to think this update in
+		the thinking processes. Does nothing if there aren't any processes.
+		"""
+		if self.processes <= 0:
+			return
+		indexes = []
+		for index, player in enumerate(level.players):
+			if isinstance(player, CPUPlayer) and player.planning and \
+			   not level.danger.at(player.x, player.y):
+				indexes.append(index)
+		if len(indexes) < AI_THINK_POOL_MIN:
+			return
+		if self.pool is None:
+			self.start(level)
+		
+		snapshot = LevelSnapshot(level)
+		chunk = (len(indexes) + self.processes - 1) // self.processes
+		jobs = [(snapshot, indexes[pos:pos + chunk]) for pos in xrange(0, len(indexes), chunk)]
+		pos = 0
+		for decisions in self.pool.map(_think, jobs):
+			for decision in decisions:
+				level.players[indexes[pos]].decision = decision
+				pos += 1
+	
+	def schedule(self, players):
+		"""
+		Set the planning flag of the computer players that should think this
+		update.
+		"""
+		count = len(players)
+		if not count:
+			return
+		budget = self.budget
+		if self.processes > 0:
+			budget = count
+		start = self.next % count
+		thinking = 0
+		for offset in xrange(count):
+			index = (start + offset) % count
+			player = players[index]
+			if not isinstance(player, CPUPlayer):
+				continue
+			if thinking < budget and player.thinks and player.think_wait <= 0:
+				player.planning = True
+				player.think_wait = player.think_interval
+				thinking += 1
+				self.next = index + 1
+			else:
+				player.planning = False
+
 #-------------------------------------------------------------------------------
 class Level:
-	def __init__(self, name = "No Name"):
+	def __init__(self, name = "No Name", processes = AI_THINK_PROCESSES):
 		self.name = name
 		self.description = ""
 		self.mesh = None
 		self.navimesh = None
+		self.navigation = None
+		self.paths = None
 		self.blockspawnmesh = None
 		self.blockmesh = None
 		self.blocktimer = 10.0
@@ -60,15 +503,18 @@ class Level:
 		self.players = []
 		self.player = None
 		self.items = []
+		self.danger = DangerMap()
+		self.thinking = AIScheduler(processes = processes)
 		self.timer = 180
 		self.explosion_last = 0.0
 		self.explosion_counter = 1
 		self.explosion_links = []
+		self.next_id = 1
 		if name is not "No Name":
 			self.load(name)
 	
 	def load(self, name):
-		Log.info("Loading level " + name)
+		Log.info("Loading level %s", name)
 		data = VirtualFS.open("Levels/" + name).readlines()
 		for line in data:
 			if line[:4] == "name":
@@ -80,9 +526,10 @@ class Level:
 			elif line[:8] == "navimesh":
 				self.navimesh = line[9:].strip() + ".obj"
 				try:
-					DataManager.meshes.load(self.navimesh)
+					self.load_navigation(line[9:].strip())
 				except:
 					self.navimesh = None
+					self.navigation = None
 					Log.warning("Couldn't load navigation mesh, level collision detection disabled...")
 			elif line[:14] == "blockspawnmesh":
 				self.blockspawnmesh = line[15:].strip() + ".obj"
@@ -104,6 +551,58 @@ class Level:
 				spawn = BlockSpawn(self.blockspawnmesh, self.blockmesh, self.blocktimer)
 				spawn.x, spawn.y = [float(x) for x in line[6:].split()]
 				self.blockspawns.append(spawn)
+		
+		if self.navigation:
+			self.paths = PathCache(self.navigation)
+			for spawn in self.blockspawns:
+				self.block_changed(spawn)
+		
+		if self.thinking.processes > 0:
+			self.thinking.start(self)
+	
+	def close(self):
+		"""
+		Free anything the level holds outside this process, i.e. its
+		thinking processes. Call when done with the level.
+		"""
+		self.thinking.close()
+	
+	def load_navigation(self, name):
+		"""
+		Load the level's navigation mesh. A compiled copy (name.bnav, written
+		with NaviMesh.save) is used if there is one, otherwise the mesh is
+		compiled from name.obj.
+		"""
+		compiled = "Meshes/" + name + ".bnav"
+		self.navigation = NaviMesh()
+		if VirtualFS.exists(compiled):
+			self.navigation.load(VirtualFS.open(compiled))
+		else:
+			DataManager.meshes.load(self.navimesh)
+			self.navigation.generate(DataManager.meshes[self.navimesh])
+	
+	def block_changed(self, spawn):
+		"""
+		Called when a block spawn's block appears or is destroyed so paths
+		can go around or through it.
+		"""
+		if self.paths is None:
+			return
+		hull = None
+		if spawn.blockmesh:
+			hull = DataManager.meshes[spawn.blockmesh].hull
+		if spawn.block:
+			self.paths.block(spawn.x, spawn.y, hull)
+		else:
+			self.paths.unblock(spawn.x, spawn.y, hull)
+	
+	def new_id(self):
+		"""
+		Return an id for a new object, used to refer to it over the network.
+		"""
+		id = self.next_id
+		self.next_id = (self.next_id % 0xFFFF) + 1
+		return id
 	
 	def add_player(self, name, x = 0, y = 0, control = False):
 		if control:
@@ -111,21 +610,27 @@ class Level:
 			self.player = player
 		else:
 			player = CPUPlayer()
+		player.id = self.new_id()
 		player.name = name
 		player.x = x
 		player.y = y
 		self.players.append(player)
+		return player
 	
 	def add_bomb(self, x = 0, y = 0):
 		bomb = Bomb()
+		bomb.id = self.new_id()
 		bomb.x = x
 		bomb.y = y
 		bomb.timer = 3
 		self.items.append(bomb)
+		self.danger.add(bomb)
 	
 	def update(self):
 		for spawn in self.blockspawns:
 			spawn.update(self)
+		self.thinking.schedule(self.players)
+		self.thinking.think(self)
 		for pos in range(len(self.players) - 1, -1, -1):
 			retval = self.players[pos].update(self)
 			if retval == False:
@@ -175,6 +680,20 @@ class Movement:
 		except:
 			return None, False
 
+#-------------------------------------------------------------------------------
+class Motion(PolarVector2d):
+	"""
+	Object Motion
+	=============
+		The direction and speed of a game object, plus whether it is currently
+		moving at all.
+	"""
+	__slots__ = ["moving"]
+	
+	def __init__(self, angle = None, radius = 1.0, moving = False):
+		PolarVector2d.__init__(self, angle, radius)
+		self.moving = moving
+
 #-------------------------------------------------------------------------------
 class GameObject:
 	def __init__(self, mesh = None, x = 0, y = 0):
@@ -182,64 +701,236 @@ class GameObject:
 		self.mesh = mesh
 		self.x = x
 		self.y = y
-		self.motion = PolarVector2d(None, 1.0)
-		self.motion.moving = False
+		self.motion = Motion(None, 1.0)
 		self.scale = 1.0
+		# World-space collision hull, see get_hull
+		self.hull = None
+		self.hull_mesh = None
+		# Direction out of the last object collided with
+		self.contact = Point2d()
+		self.sweep_normal = Point2d()
+		self.collision_mode = DEFAULT_COLLISION_MODE
 	
 	def update(self, level):
 		if self.motion.moving:
-			oldpos = Point2d(self.x, self.y)
-			self.x += cos(self.motion.angle) * self.motion.radius * Interface.tdiff
-			self.y += sin(self.motion.angle) * self.motion.radius * Interface.tdiff
-			if self.check_collisions(level, oldpos):
-				self.x, self.y = oldpos.x, oldpos.y
+			oldx = self.x
+			oldy = self.y
+			dx = cos(self.motion.angle) * self.motion.radius * Interface.tdiff
+			dy = sin(self.motion.angle) * self.motion.radius * Interface.tdiff
+			if self.collision_mode == COLLISION_SWEPT:
+				self.move_swept(level, dx, dy)
+			elif self.collision_mode == COLLISION_AUTO and self.is_fast(dx, dy):
+				self.move_swept(level, dx, dy)
+			else:
+				self.move_discrete(level, dx, dy)
+			self.keep_on_navimesh(level, oldx, oldy)
 		return True
 	
+	def keep_on_navimesh(self, level, oldx, oldy):
+		"""
+		Stop a move from oldx, oldy to the current position where it would
+		leave the level's walkable area, and slide along the border for the
+		rest of the move.
+		"""
+		navigation = level.navigation
+		if navigation is None or (self.x == oldx and self.y == oldy):
+			return
+		dx = self.x - oldx
+		dy = self.y - oldy
+		t = navigation.raycast(oldx, oldy, self.x, self.y, self.contact)
+		if t >= 1.0:
+			return
+		normal = self.contact
+		self.x = oldx + dx * t + normal.x * COLLISION_SKIN
+		self.y = oldy + dy * t + normal.y * COLLISION_SKIN
+		remaining = 1.0 - t
+		dot = dx * normal.x + dy * normal.y
+		dx = (dx - dot * normal.x) * remaining
+		dy = (dy - dot * normal.y) * remaining
+		if navigation.raycast(self.x, self.y, self.x + dx, self.y + dy) >= 1.0:
+			self.x += dx
+			self.y += dy
+	
+	def is_fast(self, dx, dy):
+		"""
+		Returns whether a move of dx, dy is far enough that it could skip
+		through something if it were only checked at its end point.
+		"""
+		hull = self.get_hull()
+		if hull is None:
+			return False
+		limit = hull.radius * COLLISION_SWEEP_DISTANCE
+		return dx * dx + dy * dy > limit * limit
+	
+	def move_discrete(self, level, dx, dy):
+		"""
+		Move by dx, dy and then push back out of anything that was run into.
+		"""
+		oldx = self.x
+		oldy = self.y
+		self.x += dx
+		self.y += dy
+		depth = self.check_collisions(level, oldx, oldy)
+		if depth:
+			# Push back out of what we ran into so we slide along it, and
+			# only give up on the move if that lands us in something else
+			self.x += self.contact.x * (depth + COLLISION_SKIN)
+			self.y += self.contact.y * (depth + COLLISION_SKIN)
+			if self.check_collisions(level, oldx, oldy):
+				self.x = oldx
+				self.y = oldy
+	
+	def move_swept(self, level, dx, dy):
+		"""
+		Move by dx, dy, stopping at the first thing hit along the way and
+		sliding along it for the rest of the move.
+		"""
+		for slide in xrange(COLLISION_SLIDES):
+			if dx == 0 and dy == 0:
+				return
+			toi = self.sweep(level, dx, dy)
+			if toi < 0:
+				self.x += dx
+				self.y += dy
+				return
+			# Move up to the point of contact, then keep only the part of the
+			# remaining move that runs along the surface that was hit
+			normal = self.contact
+			self.x += dx * toi + normal.x * COLLISION_SKIN
+			self.y += dy * toi + normal.y * COLLISION_SKIN
+			remaining = 1.0 - toi
+			dot = dx * normal.x + dy * normal.y
+			dx = (dx - dot * normal.x) * remaining
+			dy = (dy - dot * normal.y) * remaining
+	
+	def sweep(self, level, dx, dy):
+		"""
+		Returns the fraction of a move by dx, dy at which this object first
+		hits a player or item, or -1 if it doesn't hit anything. The normal
+		of the surface that was hit is left in self.contact.
+		"""
+		hull = self.get_hull()
+		if hull is None:
+			return -1
+		toi = -1
+		for player in level.players:
+			if player is not self:
+				toi = self.sweep_against(player, hull, dx, dy, toi)
+		for item in level.items:
+			if item is not self:
+				toi = self.sweep_against(item, hull, dx, dy, toi)
+		return toi
+	
+	def sweep_against(self, object, hull, dx, dy, toi):
+		"""
+		Sweep hull by dx, dy against object and return the earlier of the
+		time of impact and toi.
+		"""
+		# Moving away from an object never counts, same as for discrete moves
+		if dx * (object.x - self.x) + dy * (object.y - self.y) <= 0:
+			return toi
+		hull2 = object.get_hull()
+		if hull2 is None:
+			return toi
+		
+		# Broad phase: does the moving bounding circle pass near the other?
+		radius = hull.radius + hull2.radius
+		cx = hull2.center_x - hull.center_x
+		cy = hull2.center_y - hull.center_y
+		length = dx * dx + dy * dy
+		t = (cx * dx + cy * dy) / length
+		if t < 0:
+			t = 0
+		elif t > 1:
+			t = 1
+		ex = cx - dx * t
+		ey = cy - dy * t
+		if ex * ex + ey * ey > radius * radius:
+			return toi
+		
+		hit = sweep_collision2d(hull, dx, dy, hull2, self.sweep_normal)
+		if hit >= 0 and (toi < 0 or hit < toi):
+			self.contact.x = self.sweep_normal.x
+			self.contact.y = self.sweep_normal.y
+			return hit
+		return toi
+	
 	def draw(self):
 		pass
 	
-	def check_collisions(self, level, oldpos):
+	def get_hull(self):
+		"""
+		Return this object's collision hull moved to its current position, or
+		None if its mesh has no hull. The mesh lookup only happens again if
+		the mesh changes, and the hull's points are only recalculated when
+		the object has moved.
+		"""
+		if self.hull_mesh != self.mesh:
+			self.hull_mesh = self.mesh
+			self.hull = None
+			if self.mesh:
+				mesh = DataManager.meshes[self.mesh]
+				if mesh:
+					self.hull = WorldHull2d(mesh.hull, self.x, self.y)
+		if self.hull:
+			self.hull.move(self.x, self.y)
+		return self.hull
+	
+	def check_collisions(self, level, oldx, oldy):
+		"""
+		Returns how far this object overlaps the first player or item it ran
+		into moving here from oldx, oldy, or 0 if it didn't run into anything.
+		The direction to move to get back out is left in self.contact.
+		"""
 		for player in level.players:
-			if player != self:
-				d1 = (oldpos.x - player.x) * (oldpos.x - player.x) + \
-					 (oldpos.y - player.y) * (oldpos.y - player.y)
-				d2 = (self.x - player.x) * (self.x - player.x) + \
-					 (self.y - player.y) * (self.y - player.y)
-				if d2 < d1:
-					if self.hull_collision2d(player):
-						return True
-		
+			if player is not self:
+				depth = self.collides_with(player, oldx, oldy)
+				if depth:
+					return depth
 		for item in level.items:
-			if item != self:
-				d1 = (oldpos.x - item.x) * (oldpos.x - item.x) + \
-					 (oldpos.y - item.y) * (oldpos.y - item.y)
-				d2 = (self.x - item.x) * (self.x - item.x) + \
-					 (self.y - item.y) * (self.y - item.y)
-				if d2 < d1:
-					if self.hull_collision2d(item):
-						return True
-		return False
+			if item is not self:
+				depth = self.collides_with(item, oldx, oldy)
+				if depth:
+					return depth
+		return 0
+	
+	def collides_with(self, object, oldx, oldy):
+		"""
+		Returns how far moving here from oldx, oldy runs into object, or 0 if
+		it doesn't. Moving away from an object never counts, so objects can
+		walk off of things they already overlap (e.g. a bomb they just dropped).
+		"""
+		d1 = (oldx - object.x) * (oldx - object.x) + \
+			 (oldy - object.y) * (oldy - object.y)
+		d2 = (self.x - object.x) * (self.x - object.x) + \
+			 (self.y - object.y) * (self.y - object.y)
+		if d2 < d1:
+			return self.hull_penetration2d(object)
+		return 0
 	
 	def hull_collision2d(self, object):
-		mesh1 = DataManager.meshes[self.mesh]
-		mesh2 = DataManager.meshes[object.mesh]
-		xdiff = (self.x + mesh1.hull.center.x) - (object.x + mesh2.hull.center.x)
-		ydiff = (self.y + mesh1.hull.center.y) - (object.y + mesh2.hull.center.y)
-		
-		# Get out before length calc if at all possible (sqrt, ** are expensive)
-		if xdiff > (mesh1.hull.radius + mesh2.hull.radius) or ydiff > (mesh1.hull.radius + mesh2.hull.radius):
-			return False
+		return self.hull_penetration2d(object) > 0
 	
-		radius1 = mesh1.hull.radius * mesh1.hull.radius
-		radius2 = mesh2.hull.radius * mesh2.hull.radius
-		length = xdiff * xdiff + ydiff * ydiff
-		if length < radius1 + radius2:
-			if hull_collision2d(mesh1.hull, self, mesh2.hull, object):
-				return True
-			else:
-				return False
-		else:
-			return False
+	def hull_penetration2d(self, object):
+		"""
+		Returns how far this object's hull overlaps object's hull, or 0 if
+		they don't overlap. The direction to move this object to separate them
+		is left in self.contact.
+		"""
+		hull1 = self.get_hull()
+		hull2 = object.get_hull()
+		if hull1 is None or hull2 is None:
+			return 0
+		xdiff = hull1.center_x - hull2.center_x
+		ydiff = hull1.center_y - hull2.center_y
+		radius = hull1.radius + hull2.radius
+		
+		# Get out before length calc if at all possible
+		if xdiff > radius or xdiff < -radius or ydiff > radius or ydiff < -radius:
+			return 0
+		if xdiff * xdiff + ydiff * ydiff > radius * radius:
+			return 0
+		return sat_collision2d(hull1, hull2, self.contact)
 
 #-------------------------------------------------------------------------------
 class Player(GameObject):
@@ -266,44 +957,131 @@ class CPUPlayer(Player):
 		Player.__init__(self)
 		# Set whether this player thinks (enable/disable artificial intelligence)
 		self.thinks = True
+		# How often this player thinks, and whether it gets to this update;
+		# see AIScheduler
+		self.think_interval = AI_THINK_INTERVAL
+		self.think_wait = 0
+		self.planning = False
+		self.running = False
+		# A decision made by a thinking process, see AIScheduler.think
+		self.decision = None
+		# The path currently being followed, see steer
+		self.corridor = None
+		self.waypoints = None
+		self.path_generation = -1
 
 	def update(self, level):
-		# See if we need to run away from any bombs!
+		# See if we need to run away from any bombs! This is checked every
+		# update, everything else only when the scheduler lets us think.
+		self.think_wait -= Interface.tdiff
 		running = False
+		if level.danger.at(self.x, self.y):
+			angle = level.danger.escape(self.x, self.y, level.navigation)
+			if angle is not None:
+				self.motion.angle = angle
+				self.motion.moving = True
+				running = True
+		elif self.running:
+			# Just got clear, so decide what to do next as soon as possible
+			self.motion.moving = False
+			self.think_wait = 0
+		self.running = running
+		
+		if not running:
+			if not self.thinks:
+				self.motion.moving = False
+			elif self.planning:
+				if self.decision is not None:
+					self.decide(level, self.decision)
+				else:
+					self.think(level)
+		self.decision = None
+		
+		Player.update(self, level)
+	
+	def think(self, level):
+		"""
+		Select our closest target and go after her! The direction chosen is
+		kept until the next time this player thinks.
+		"""
 		self.motion.moving = False
-		bombs = []
-		for item in level.items:
-			if item.type == "Bomb":
-				diffx = self.x - item.x
-				diffy = self.y - item.y
+		closest = [None, 1000, 0, 0]
+		for player in level.players:
+			if player != self:
+				diffx = self.x - player.x
+				diffy = self.y - player.y
 				distance = diffx * diffx + diffy * diffy
-				if distance < (item.radius * item.radius) + 0.1:
-					bombs.append([item, distance])
-					self.motion.angle = atan2(diffy, diffx)
-					self.motion.moving = True
-					running = True
+				if distance < closest[1]:
+					closest = [player, distance, diffx, diffy]
+		player, distance, diffx, diffy = closest
+		if player:
+			self.motion.angle = self.steer(level, player.x, player.y)
+			self.motion.moving = True
+			min_radius = DataManager.meshes[self.mesh].hull.radius + DataManager.meshes[player.mesh].hull.radius
+			if distance < (min_radius * min_radius) + 0.1:
+				level.add_bomb(self.x, self.y)
+	
+	def decide(self, level, decision):
+		"""
+		Act on a decision from LevelSnapshot.decide.
+		"""
+		angle, moving, bomb = decision
+		if angle is not None:
+			self.motion.angle = angle
+		self.motion.moving = moving
+		if bomb:
+			level.add_bomb(self.x, self.y)
+	
+	def steer(self, level, x, y):
+		"""
+		Return the angle to head in to get to x, y. If the level has a
+		navigation mesh this follows a path around walls and blocks,
+		otherwise it just heads straight there.
+		"""
+		waypoint = self.next_waypoint(level, x, y)
+		if waypoint is not None:
+			x = waypoint.x
+			y = waypoint.y
+		return atan2(y - self.y, x - self.x)
+	
+	def next_waypoint(self, level, x, y):
+		"""
+		Return the next waypoint on the way to x, y, or None to head straight
+		for it. A new path is only looked up when the goal moves to another
+		triangle, this player strays from its corridor, or a block changes.
+		"""
+		paths = level.paths
+		if paths is None:
+			return None
+		navigation = level.navigation
+		start = navigation.find(self.x, self.y)
+		goal = navigation.find(x, y)
+		if start == -1 or goal == -1:
+			return None
 		
-		# Select our closest target and go after her!
-		if not running and self.thinks:
-			chasing = False
-			closest = [None, 1000]
-			for player in level.players:
-				if player != self:
-					diffx = self.x - player.x
-					diffy = self.y - player.y
-					distance = diffx * diffx + diffy * diffy
-					if distance < closest[1]:
-						closest = [player, distance, diffx, diffy]
-			player, distance, diffx, diffy = closest
-			if player:
-				chasing = True
-				self.motion.angle = atan2(-diffy, -diffx)
-				self.motion.moving = True
-				min_radius = DataManager.meshes[self.mesh].hull.radius + DataManager.meshes[player.mesh].hull.radius
-				if distance < (min_radius * min_radius) + 0.1:
-					level.add_bomb(self.x, self.y)
+		corridor = self.corridor
+		if corridor is None or self.path_generation != paths.generation or \
+		   corridor[-1] != goal or start not in corridor:
+			self.path_generation = paths.generation
+			self.corridor = paths.corridor(start, goal)
+			if self.corridor is None:
+				self.waypoints = None
+				return None
+			self.waypoints = navigation.funnel(self.corridor, self.x, self.y, x, y)
+		elif corridor[0] != start:
+			# Still on the same path, just further along it
+			self.corridor = corridor[corridor.index(start):]
 		
-		Player.update(self, level)
+		# Skip the waypoints we have reached. The last one is always the goal,
+		# which is handled by heading straight for it.
+		waypoints = self.waypoints
+		while len(waypoints) > 1:
+			dx = waypoints[0].x - self.x
+			dy = waypoints[0].y - self.y
+			if dx * dx + dy * dy > PATH_WAYPOINT_RADIUS * PATH_WAYPOINT_RADIUS:
+				return waypoints[0]
+			del waypoints[0]
+		return None
 
 #-------------------------------------------------------------------------------
 class Item(GameObject):
@@ -379,11 +1157,13 @@ class BlockSpawn(Item):
 	
 	def timeout(self, level):
 		self.block = True
+		level.block_changed(self)
 		return True
 	
 	def destroy_block(self, level):
 		self.block = False
 		self.timer = self.default_time
+		level.block_changed(self)
 		level.items.append(Pickup())
 
 #-------------------------------------------------------------------------------
@@ -437,6 +1217,7 @@ class Bomb(Item):
 			if self.current_size >= self.radius:
 				if not self.hit_bomb:
 					level.explosion_links[self.explosion_index] = 0
+				level.danger.remove(self)
 				return False
 				
 			for pos in range(len(level.players) - 1, -1, -1):
@@ -446,13 +1227,13 @@ class Bomb(Item):
 				if xdiff * xdiff + ydiff * ydiff <= self.current_size * self.current_size:
 					player.life -= 1
 					if player.life == 0:
-						Log.info("Killed " + player.name)
+						Log.info("Killed %s", player.name)
 						del level.players[pos]
 						if len(level.players) == 1:
-							Log.info(level.players[0].name + " wins the match!")
+							Log.info("%s wins the match!", level.players[0].name)
 							Event.post(Event.EVENT_MATCH_WON)
 					else:
-						Log.info("Damaged " + player.name)
+						Log.info("Damaged %s", player.name)
 			
 			for pos in range(len(level.items) - 1, -1, -1):
 				item = level.items[pos]
@@ -464,7 +1245,7 @@ class Bomb(Item):
 							self.hit_bomb = True
 							item.timeout(level, self.explosion_index)
 					else:
-						Log.info("Destroyed " + item.type)
+						Log.info("Destroyed %s", item.type)
 						del level.items[pos]
 			return True
 	
@@ -491,6 +1272,9 @@ class Bomb(Item):
 	
 	def timeout(self, level, linkindex = -1):
 		self.exploding = True
+		Log.trace.record(Log.TRACE_EXPLOSION, "explosion", Log.TRACE_INSTANT, self.id)
+		if BOMB_EXPLOSION_SOUND and Sound.manager:
+			Sound.play_at(BOMB_EXPLOSION_SOUND, self.x, self.y, 0.0, Sound.SOUND_PRIORITY_HIGH)
 		old_time = level.explosion_last
 		level.explosion_last = time()
 		if level.explosion_last - old_time <= .15:
@@ -524,4 +1308,5 @@ class Bomb(Item):
 			if level.explosion_links[self.explosion_index] > 4 and not self.hit_bomb:
 				Event.post(Event.EVENT_CAMERA_SHAKE)
 				self.radius *= 1.5
+				level.danger.add(self)
 		return True
@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+
+"""
+	Boom Server
+	===========
+		A headless game server. A server hosts any number of matches, each with
+		its own level, updates them all at a fixed tick rate and exchanges
+		input and snapshots with the clients playing in them over Boom.Network.
+		Matches can be spread over several processes with serve, each listening
+		on its own port.
+		
+		Nothing is drawn, so a server can run many more matches than there
+		are windows to show them in. The engine modules a server needs are
+		only imported when the first server or match is created. If
+		Boom.init() has not been called by then, it is called with the null
+		graphics and sound backends, so a server runs on hosts without
+		OpenGL, PIL or SDL. To run a server from the command line:
+		
+		python -m Boom.Server [--port=PORT] [--processes=N] [--bots=N]
+		                      [--ai-processes=N] level...
+	
+		License
+		-------
+		Copyright (C) 2006 Daniel G. Taylor, Jason F. Kotenko, Jens Taylor
+
+		This program is free software; you can redistribute it and/or modify
+		it under the terms of the GNU General Public License as published by
+		the Free Software Foundation; either version 2 of the License, or
+		(at your option) any later version.
+
+		This program is distributed in the hope that it will be useful,
+		but WITHOUT ANY WARRANTY; without even the implied warranty of
+		MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+		GNU General Public License for more details.
+
+		You should have received a copy of the GNU General Public License
+		along with this program; if not, write to the Free Software
+		Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307 USA
+"""
+
+import Log
+import Event
+import Backend
+
+import multiprocessing
+import sys
+
+from time import time, clock
+from collections import deque
+
+SERVER_PORT = 5150
+SERVER_TICK_RATE = 30
+
+# How many ticks a server can fall behind before it gives up catching up
+SERVER_MAX_LAG = 5
+
+# How many inputs to queue for each client before dropping the oldest
+SERVER_MAX_INPUTS = 8
+
+# Imported by load_modules, after the backends have been picked
+Interface = None
+Objects = None
+Network = None
+
+#-------------------------------------------------------------------------------
+def load_modules():
+	"""
+	Import the engine modules the server uses. Objects imports Graphics, so
+	unless Boom.init() has already loaded the engine, the null backends are
+	picked first.
+	"""
+	global Interface, Objects, Network
+	if Objects is not None:
+		return
+	import Boom
+	if Boom.Objects is None:
+		Boom.init(Backend.GRAPHICS_NULL, Backend.SOUND_NULL)
+	import Interface
+	import Objects
+	import Network
+
+#-------------------------------------------------------------------------------
+class Match:
+	"""
+	Match
+	=====
+		One level being played on a server. Clients join by address and get a
+		player whose motion follows their input, one input per tick in the
+		order they were sent so the client can predict the same moves;
+		computer players can be added with add_bot. The CPU time spent
+		updating the match is added up in cpu_time. Computer players think
+		in ai_processes processes if it is more than zero, see
+		Objects.AIScheduler.
+	"""
+	def __init__(self, id, level, ai_processes = 0):
+		load_modules()
+		self.id = id
+		self.level = Objects.Level(level, ai_processes)
+		self.clients = {}
+		self.inputs = {}
+		self.queued = {}
+		self.snapshots = Network.SnapshotServer()
+		self.ticks = 0
+		self.cpu_time = 0.0
+		self.started = False
+	
+	def add_bot(self, name, x = 0, y = 0):
+		"""
+		Add a computer player to the match.
+		"""
+		return self.level.add_player(name, x, y)
+	
+	def join(self, address, name, x = 0, y = 0):
+		"""
+		Add a player for the client at address and return it.
+		"""
+		player = self.clients.get(address)
+		if player is None:
+			player = Objects.Player()
+			player.id = self.level.new_id()
+			player.name = name
+			player.x = x
+			player.y = y
+			self.level.players.append(player)
+			self.clients[address] = player
+			self.inputs[address] = None
+			self.queued[address] = deque()
+			Log.info("%s joined match %d", name, self.id)
+		return player
+	
+	def leave(self, address):
+		"""
+		Remove the client at address and its player.
+		"""
+		player = self.clients.pop(address, None)
+		self.inputs.pop(address, None)
+		self.queued.pop(address, None)
+		self.snapshots.remove(address)
+		if player in self.level.players:
+			self.level.players.remove(player)
+	
+	def input(self, address, message):
+		"""
+		Queue an input message from the client at address for its player,
+		see apply_inputs. Inputs older than the last one queued are ignored.
+		"""
+		if address not in self.clients:
+			return
+		input = Network.read_input(message)
+		queued = self.queued[address]
+		if queued:
+			last = queued[-1][0]
+		else:
+			last = self.inputs[address]
+		if last is not None and not Network.sequence_newer(input[0], last):
+			return
+		queued.append(input)
+		if len(queued) > SERVER_MAX_INPUTS:
+			queued.popleft()
+	
+	def apply_inputs(self):
+		"""
+		Apply the oldest queued input of each client to its player. A client
+		sends one input per tick, so its player moves as it predicted; when
+		none has arrived the last one is kept.
+		"""
+		for address, queued in self.queued.iteritems():
+			if not queued:
+				continue
+			sequence, angle, moving, bomb = queued.popleft()
+			self.inputs[address] = sequence
+			player = self.clients[address]
+			player.motion.angle = angle
+			player.motion.moving = moving
+			if bomb and player.life and player in self.level.players:
+				self.level.add_bomb(player.x, player.y)
+	
+	def view(self, address, message):
+		"""
+		Only send the client at address what it can see from the view in
+		message, plus its own player.
+		"""
+		player = self.clients.get(address)
+		if player is None:
+			return
+		view = Network.View()
+		view.read(message)
+		self.snapshots.set_view(address, view, player)
+	
+	def update(self, tdiff):
+		"""
+		Run the match forward by tdiff seconds.
+		"""
+		start = clock()
+		# Objects use the time since the last update from the interface
+		Interface.tdiff = tdiff
+		self.apply_inputs()
+		self.level.update()
+		self.ticks += 1
+		if len(self.level.players) > 1:
+			self.started = True
+		self.cpu_time += clock() - start
+	
+	def finished(self):
+		"""
+		Return whether the match has been won.
+		"""
+		return self.started and len(self.level.players) <= 1
+	
+	def send_snapshots(self, network):
+		"""
+		Capture a snapshot and send it to every client.
+		"""
+		if not self.clients:
+			return
+		start = clock()
+		sequence = self.snapshots.capture(self.level)
+		for address in self.clients:
+			data = self.snapshots.encode(address)
+			# The snapshot also tells the client which of its inputs it
+			# includes so it can replay the rest, see Client
+			try:
+				network.send_batch(address, Network.snapshot_messages(sequence,
+								   data, self.inputs[address]))
+			except ValueError, e:
+				Log.error("Couldn't send snapshot %d to %s: %s", sequence, address, e)
+		self.cpu_time += clock() - start
+
+#-------------------------------------------------------------------------------
+class Server:
+	"""
+	Server
+	======
+		Hosts matches and runs them at tick_rate updates per second, reading
+		client messages between ticks. Each match gets the same fixed time
+		step, so a match runs the same no matter how busy the server is.
+	"""
+	def __init__(self, port = SERVER_PORT, tick_rate = SERVER_TICK_RATE, address = "", ai_processes = 0):
+		load_modules()
+		self.ai_processes = ai_processes
+		self.network = Network.Network(port, address, False)
+		self.tick_rate = tick_rate
+		self.tdiff = 1.0 / tick_rate
+		self.matches = {}
+		self.clients = {}
+		self.next_match = 0
+		self.running = False
+	
+	def add_match(self, level):
+		"""
+		Start a new match on level and return it.
+		"""
+		match = Match(self.next_match, level, self.ai_processes)
+		self.matches[match.id] = match
+		self.next_match += 1
+		Log.info("Started match %d on %s", match.id, level)
+		return match
+	
+	def remove_match(self, match):
+		"""
+		Stop a match and forget its clients.
+		"""
+		for address in match.clients.keys():
+			self.clients.pop(address, None)
+		del self.matches[match.id]
+		match.level.close()
+		Log.info("Match %d finished after %d ticks", match.id, match.ticks)
+	
+	def handle(self, message):
+		"""
+		Handle a message from a client.
+		"""
+		address = message.address
+		if message.mtype == Network.NETWORK_MESSAGE_JOIN:
+			match = self.matches.get(message.data[0])
+			if match is None:
+				return
+			old = self.clients.get(address)
+			if old is not None and old is not match:
+				old.leave(address)
+			player = match.join(address, "Player " + str(address))
+			self.clients[address] = match
+			self.network.send(address, Network.Message(time(), 0,
+							  Network.NETWORK_MESSAGE_WELCOME,
+							  Network.NETWORK_FLAG_RELIABLE,
+							  [match.id, player.id, self.tick_rate]))
+		elif message.mtype == Network.NETWORK_MESSAGE_LEAVE:
+			match = self.clients.pop(address, None)
+			if match is not None:
+				match.leave(address)
+			self.network.disconnect(address)
+		elif message.mtype == Network.NETWORK_MESSAGE_INPUT:
+			match = self.clients.get(address)
+			if match is not None:
+				match.input(address, message)
+		elif message.mtype == Network.NETWORK_MESSAGE_ACK:
+			match = self.clients.get(address)
+			if match is not None:
+				match.snapshots.ack(address, message.data[0])
+		elif message.mtype == Network.NETWORK_MESSAGE_VIEW:
+			match = self.clients.get(address)
+			if match is not None:
+				match.view(address, message)
+	
+	def tick(self):
+		"""
+		Update every match once and send out their snapshots.
+		"""
+		Log.trace.begin(Log.TRACE_FRAME, "tick")
+		for match in self.matches.values():
+			match.update(self.tdiff)
+			match.send_snapshots(self.network)
+			if match.finished():
+				self.remove_match(match)
+		# Nothing listens to the events objects post on a server
+		Event.handle_events()
+		Log.trace.end(Log.TRACE_FRAME, "tick")
+	
+	def run(self, ticks = None):
+		"""
+		Run the server until stop is called, or for a number of ticks.
+		"""
+		self.running = True
+		next_tick = time()
+		while self.running:
+			now = time()
+			if now < next_tick:
+				self.network.update(next_tick - now)
+			else:
+				self.network.update()
+			while True:
+				message = self.network.recv()
+				if message is None:
+					break
+				self.handle(message)
+			
+			now = time()
+			if now >= next_tick:
+				self.tick()
+				next_tick += self.tdiff
+				if now - next_tick > SERVER_MAX_LAG * self.tdiff:
+					Log.warning("Server is running behind, skipping ticks")
+					next_tick = now
+				if ticks is not None:
+					ticks -= 1
+					if ticks <= 0:
+						break
+		self.running = False
+	
+	def stop(self):
+		self.running = False
+	
+	def close(self):
+		"""
+		Stop every match and close the server's socket.
+		"""
+		for match in self.matches.values():
+			self.remove_match(match)
+		self.network.close()
+	
+	def stats(self):
+		"""
+		Return a list of (match id, ticks, CPU time, CPU time per tick) for
+		every match.
+		"""
+		stats = []
+		for id, match in sorted(self.matches.items()):
+			per_tick = 0.0
+			if match.ticks:
+				per_tick = match.cpu_time / match.ticks
+			stats.append((id, match.ticks, match.cpu_time, per_tick))
+		return stats
+
+#-------------------------------------------------------------------------------
+def _serve(port, tick_rate, levels, bots, ai_processes):
+	"""
+	Run a server with a match on each of levels in a worker process.
+	"""
+	server = Server(port, tick_rate, ai_processes = ai_processes)
+	try:
+		for level in levels:
+			match = server.add_match(level)
+			for bot in range(bots):
+				match.add_bot("CPU %d" % (bot + 1), bot * 2.0, 0)
+		server.run()
+	finally:
+		server.close()
+
+def serve(levels, port = SERVER_PORT, tick_rate = SERVER_TICK_RATE, processes = 1, bots = 0, ai_processes = 0):
+	"""
+	Host a match on each of levels, spread over a number of processes. The
+	process with index i listens on port + i and hosts every match whose
+	index modulo processes is i. Each match's computer players think in
+	ai_processes more processes if it is more than zero. Returns the list
+	of processes started, or runs the server in this process if processes
+	is 1.
+	"""
+	if processes <= 1:
+		_serve(port, tick_rate, levels, bots, ai_processes)
+		return []
+	workers = []
+	for index in range(processes):
+		worker = multiprocessing.Process(target = _serve,
+			args = (port + index, tick_rate, levels[index::processes], bots, ai_processes))
+		worker.start()
+		workers.append(worker)
+	return workers
+
+if __name__ == "__main__":
+	port = SERVER_PORT
+	processes = 1
+	bots = 0
+	ai_processes = 0
+	levels = []
+	for arg in sys.argv[1:]:
+		if arg.startswith("--port="):
+			port = int(arg[7:])
+		elif arg.startswith("--processes="):
+			processes = int(arg[12:])
+		elif arg.startswith("--bots="):
+			bots = int(arg[7:])
+		elif arg.startswith("--ai-processes="):
+			ai_processes = int(arg[15:])
+		else:
+			levels.append(arg)
+	if not levels:
+		print "Usage: " + sys.argv[0] + " [--port=PORT] [--processes=N] [--bots=N] [--ai-processes=N] level..."
+		sys.exit(1)
+	for worker in serve(levels, port, processes = processes, bots = bots,
+						ai_processes = ai_processes):
+		worker.join()
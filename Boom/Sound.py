@@ -10,6 +10,28 @@
 		This module provides two classes to make playing sounds easy. They are the
 		Sound and Music classes. Both have play and stop methods.
 		
+		Sound effects are decoded once, through the virtual filesystem, by
+		DataManager.sounds and then played from memory. The SDL manager plays
+		them on a fixed pool of mixer channels. When every channel is busy, a
+		new sound takes over the channel of the quietest, oldest sound with
+		the lowest priority, as long as that priority is lower than its own,
+		or the same and that sound is no louder. Each sound can only have a
+		limited number of copies playing at once; a new copy restarts the
+		oldest one instead of taking another channel.
+		
+		Sounds played with play_at come from a position in the world. Their
+		volume and left/right pan are worked out against the listener camera
+		(see set_listener). Sounds within half a screen of what the camera is
+		looking at play at full volume and get quieter the further away they
+		are; they are panned by where they are across the screen. Sounds too
+		quiet to hear are never played at all, so they don't take channels
+		away from the sounds that can be heard.
+		
+		Music is streamed from the virtual filesystem, so it can be kept in a
+		mounted archive. A background thread reads the file a chunk at a time,
+		a few chunks ahead of the mixer, so the mixer never waits on the disk
+		and the whole track is never in memory.
+		
 		License
 		-------
 		Copyright (C) 2006 Daniel G. Taylor
@@ -32,6 +54,40 @@
 import Log
 Log.info("Initializing sound subsystem...")
 
+import VirtualFS
+import Backend
+
+import threading
+import Queue
+import atexit
+import weakref
+from time import time
+from math import sqrt
+
+# Number of mixer channels sound effects are played on
+SOUND_CHANNELS = 16
+
+# Sound priorities, a sound can only take the channel of an equal or lower
+# priority sound
+SOUND_PRIORITY_LOW = 0
+SOUND_PRIORITY_NORMAL = 1
+SOUND_PRIORITY_HIGH = 2
+
+# Default number of copies of one sound that may play at the same time
+SOUND_MAX_INSTANCES = 4
+
+# Sounds further than this from what the camera looks at (in half screen
+# heights) start to get quieter, and how quickly they fade out
+SOUND_FULL_RADIUS = 1.0
+SOUND_ROLLOFF = 2.0
+
+# Sounds quieter than this are not played
+SOUND_MIN_VOLUME = 0.05
+
+# Size of the chunks music is read in, and how many are read ahead
+MUSIC_CHUNK_SIZE = 65536
+MUSIC_READ_AHEAD = 4
+
 #-------------------------------------------------------------------------------
 class Sound:
 	"""
@@ -39,14 +95,21 @@ class Sound:
 	============
 		Set and play/stop a sound file.
 	"""
-	def __init__(self, name):
+	def __init__(self, name, priority = None):
 		self.name = name
+		self.priority = priority
+		self.voice = None
 	
 	def play(self):
-		play(self.name)
+		self.voice = play(self.name, self.priority, self)
+	
+	def play_at(self, x, y, z = 0.0):
+		self.voice = play_at(self.name, x, y, z, self.priority, self)
 	
 	def stop(self):
-		pass
+		if self.voice and manager:
+			manager.stop(self.voice, self)
+		self.voice = None
 
 #-------------------------------------------------------------------------------
 class Music(Sound):
@@ -61,32 +124,370 @@ class Music(Sound):
 	def stop(self):
 		stop_music()
 
+#-------------------------------------------------------------------------------
+class MusicStream:
+	"""
+	Music Stream
+	============
+		A read only, seekable file-like object that reads another file
+		(e.g. one opened with VirtualFS.open) on a background thread, up to
+		read_ahead chunks ahead of the position. Seeking outside the chunk
+		being read restarts the read-ahead from the new position.
+	"""
+	def __init__(self, data, chunk_size = MUSIC_CHUNK_SIZE, read_ahead = MUSIC_READ_AHEAD):
+		self.data = data
+		self.chunk_size = chunk_size
+		self.read_ahead = read_ahead
+		data.seek(0, 2)
+		self.size = data.tell()
+		data.seek(0)
+		self.chunk = ""
+		self.chunk_start = 0
+		self.position = 0
+		self.queue = None
+		self.thread = None
+		self.stopping = False
+		self.closed = False
+		self.start(0)
+	
+	def start(self, position):
+		"""
+		Start reading ahead from position.
+		"""
+		self.stop()
+		self.data.seek(position)
+		self.chunk = ""
+		self.chunk_start = position
+		self.position = position
+		self.stopping = False
+		self.queue = Queue.Queue(self.read_ahead)
+		self.thread = threading.Thread(target = self.read_chunks, args = (self.queue,))
+		self.thread.setDaemon(True)
+		self.thread.start()
+		streams.add(self)
+	
+	def stop(self):
+		"""
+		Stop the read-ahead thread.
+		"""
+		if self.thread is None:
+			return
+		self.stopping = True
+		# Make room in case the thread is waiting to queue a chunk
+		while self.thread.isAlive():
+			try:
+				self.queue.get_nowait()
+			except Queue.Empty:
+				pass
+			self.thread.join(0.01)
+		self.thread = None
+	
+	def read_chunks(self, queue):
+		"""
+		Background thread: read chunks until the end of the file or until
+		stopped. An empty chunk marks the end of the file.
+		"""
+		# Keep a reference, module globals go away at interpreter shutdown
+		full = Queue.Full
+		while not self.stopping:
+			chunk = self.data.read(self.chunk_size)
+			while not self.stopping:
+				try:
+					queue.put(chunk, True, 0.1)
+					break
+				except full:
+					pass
+			if not chunk:
+				break
+	
+	def read(self, size = -1):
+		if self.closed:
+			return ""
+		if size < 0:
+			size = self.size - self.position
+		parts = []
+		while size > 0:
+			offset = self.position - self.chunk_start
+			if offset >= len(self.chunk):
+				if self.position >= self.size:
+					break
+				self.chunk_start += len(self.chunk)
+				self.chunk = self.queue.get()
+				if not self.chunk:
+					# The file was shorter than it said
+					self.size = self.position
+					break
+				continue
+			part = self.chunk[offset:offset + size]
+			parts.append(part)
+			self.position += len(part)
+			size -= len(part)
+		return "".join(parts)
+	
+	def seek(self, offset, whence = 0):
+		if whence == 1:
+			offset += self.position
+		elif whence == 2:
+			offset += self.size
+		offset = max(0, min(offset, self.size))
+		if self.chunk_start <= offset <= self.chunk_start + len(self.chunk):
+			self.position = offset
+		else:
+			self.start(offset)
+	
+	def tell(self):
+		return self.position
+	
+	def close(self):
+		if not self.closed:
+			self.stop()
+			self.data.close()
+			self.closed = True
+
+# Streams with a running read-ahead thread, stopped at exit before the
+# modules the threads use are torn down
+streams = weakref.WeakSet()
+
+def stop_streams():
+	for stream in list(streams):
+		stream.stop()
+
+atexit.register(stop_streams)
+
+#-------------------------------------------------------------------------------
+class Voice:
+	"""
+	Voice
+	=====
+		One mixer channel of the sound manager's pool and what is playing on
+		it.
+	"""
+	def __init__(self, channel):
+		self.channel = channel
+		self.name = None
+		self.priority = SOUND_PRIORITY_LOW
+		self.volume = 1.0
+		self.started = 0
+		self.owner = None
+
 #-------------------------------------------------------------------------------
 SDL = None
+DataManager = None
 class SDLSoundManager:
 	"""
 	SDL Sound Manager
 	=================
-		Manage and play sounds using SDL's mixer as the backend.
+		Manage and play sounds using SDL's mixer as the backend. Sounds are
+		played on a pool of SOUND_CHANNELS channels, see the module
+		documentation for how channels are shared out.
 	"""
-	def __init__(self):
-		global SDL
+	def __init__(self, channels = SOUND_CHANNELS):
+		global SDL, DataManager
 		import SDL
+		import DataManager
 		SDL.mixer.init()
+		SDL.mixer.set_num_channels(channels)
+		self.voices = [Voice(SDL.mixer.Channel(pos)) for pos in range(channels)]
+		self.priorities = {}
+		self.limits = {}
+		self.music = None
+		self.listener = None
 	
 	def load(self, name):
-		return SDL.mixer.Sound(name)
+		"""
+		Decode a sound file from the virtual filesystem into memory.
+		"""
+		data = VirtualFS.open(name)
+		if data is None:
+			return None
+		try:
+			return SDL.mixer.Sound(data)
+		finally:
+			data.close()
 	
-	def play(self, name):
-		pass
+	def preload(self, names):
+		"""
+		Load a list of sounds ahead of time so that playing them never
+		touches the disk.
+		"""
+		DataManager.sounds.preload(names)
+	
+	def configure(self, name, priority = SOUND_PRIORITY_NORMAL, limit = SOUND_MAX_INSTANCES):
+		"""
+		Set the default priority of a sound and how many copies of it may
+		play at the same time.
+		"""
+		self.priorities[name] = priority
+		self.limits[name] = limit
+	
+	def find_voice(self, name, priority, volume = 1.0):
+		"""
+		Return the voice a new copy of the sound name should play on, or
+		None if it should not be played. A voice of the same priority is
+		only taken over by a sound at least as loud.
+		"""
+		limit = self.limits.get(name, SOUND_MAX_INSTANCES)
+		instances = 0
+		oldest = None
+		free = None
+		victim = None
+		for voice in self.voices:
+			if voice.name is not None and not voice.channel.get_busy():
+				voice.name = None
+				voice.owner = None
+			if voice.name is None:
+				if free is None:
+					free = voice
+				continue
+			if voice.name == name:
+				instances += 1
+				if oldest is None or voice.started < oldest.started:
+					oldest = voice
+			if (voice.priority < priority or (voice.priority == priority and
+					voice.volume <= volume)) and (victim is None or
+					voice.priority < victim.priority or
+					(voice.priority == victim.priority and
+					 (voice.volume, voice.started) < (victim.volume, victim.started))):
+				victim = voice
+		if instances >= limit:
+			return oldest
+		if free is not None:
+			return free
+		return victim
+	
+	def spatialize(self, x, y, z):
+		"""
+		Return the volume and pan (-1 left to 1 right) of a sound at x, y, z
+		as heard by the listener camera.
+		"""
+		listener = self.listener
+		if listener is None:
+			return (1.0, 0.0)
+		sx, sy, depth = listener.to_screen(x, y, z)
+		if depth <= 0:
+			return (0.0, 0.0)
+		# How far the sound is from what the camera looks at, in half screen
+		# heights at that distance, so zooming out brings more into earshot
+		lookat = listener.lookat
+		focus = listener.to_screen(lookat.x, lookat.y, lookat.z)[2]
+		dx = x - lookat.x
+		dy = y - lookat.y
+		dz = z - lookat.z
+		offset = sqrt(dx * dx + dy * dy + dz * dz) * listener.focal / max(focus, 1.0)
+		if offset <= SOUND_FULL_RADIUS:
+			volume = 1.0
+		else:
+			volume = 1.0 / (1.0 + SOUND_ROLLOFF * (offset - SOUND_FULL_RADIUS))
+		return (volume, max(-1.0, min(1.0, sx)))
+	
+	def play_at(self, name, x, y, z = 0.0, priority = None, owner = None):
+		"""
+		Play a sound effect coming from a position in the world, unless it
+		would be too quiet to hear.
+		
+		@rtype: Voice
+		@return: The voice the sound is playing on, or None.
+		"""
+		volume, pan = self.spatialize(x, y, z)
+		if volume < SOUND_MIN_VOLUME:
+			return None
+		return self.play(name, priority, owner, volume, pan)
+	
+	def play(self, name, priority = None, owner = None, volume = 1.0, pan = 0.0):
+		"""
+		Play a sound effect on the channel pool.
+		
+		@rtype: Voice
+		@return: The voice the sound is playing on, or None.
+		"""
+		sound = DataManager.sounds[name]
+		if sound is None:
+			return None
+		if priority is None:
+			priority = self.priorities.get(name, SOUND_PRIORITY_NORMAL)
+		voice = self.find_voice(name, priority, volume)
+		if voice is None:
+			return None
+		voice.channel.play(sound)
+		voice.channel.set_volume(volume * min(1.0, 1.0 - pan), volume * min(1.0, 1.0 + pan))
+		voice.name = name
+		voice.priority = priority
+		voice.volume = volume
+		voice.started = time()
+		voice.owner = owner
+		return voice
+	
+	def stop(self, voice, owner = None):
+		"""
+		Stop a voice, unless it has since been taken over by another sound.
+		"""
+		if voice.owner is owner and voice.name is not None:
+			voice.channel.stop()
+			voice.name = None
+			voice.owner = None
 	
 	def play_music(self, name):
-		SDL.mixer.music.load(name)
+		"""
+		Stream and loop a music file from the virtual filesystem.
+		"""
+		data = VirtualFS.open(name, True)
+		if data is None:
+			return
+		stream = MusicStream(data)
+		SDL.mixer.music.load(stream)
 		SDL.mixer.music.play(-1)
+		# The mixer has let go of the old track now that it has a new one
+		if self.music is not None:
+			self.music.close()
+		self.music = stream
 	
 	def stop_music(self):
 		SDL.mixer.music.stop()
 
+#-------------------------------------------------------------------------------
+class NullSoundManager:
+	"""
+	Null Sound Manager
+	==================
+		A sound manager that plays nothing, for running without a sound card
+		or SDL.
+	"""
+	def __init__(self):
+		self.listener = None
+	
+	def load(self, name):
+		return None
+	
+	def preload(self, names):
+		pass
+	
+	def configure(self, name, priority = SOUND_PRIORITY_NORMAL, limit = SOUND_MAX_INSTANCES):
+		pass
+	
+	def play(self, name, priority = None, owner = None, volume = 1.0, pan = 0.0):
+		return None
+	
+	def play_at(self, name, x, y, z = 0.0, priority = None, owner = None):
+		return None
+	
+	def stop(self, voice, owner = None):
+		pass
+	
+	def play_music(self, name):
+		pass
+	
+	def stop_music(self):
+		pass
+
+#-------------------------------------------------------------------------------
+def create_manager():
+	"""
+	Create a sound manager for the sound backend in use, see Backend.
+	"""
+	if Backend.sound == Backend.SOUND_NULL:
+		return NullSoundManager()
+	return SDLSoundManager()
+
 #-------------------------------------------------------------------------------
 
 manager = None
@@ -99,12 +500,27 @@ def load(name):
 		Log.warning("No sound manager has been created...")
 
 #-------------------------------------------------------------------------------
-def play(name):
+def play(name, priority = None, owner = None):
 	if manager:
-		manager.play(name)
+		return manager.play(name, priority, owner)
 	else:
 		Log.warning("No sound manager has been created...")
 
+#-------------------------------------------------------------------------------
+def play_at(name, x, y, z = 0.0, priority = None, owner = None):
+	if manager:
+		return manager.play_at(name, x, y, z, priority, owner)
+	else:
+		Log.warning("No sound manager has been created...")
+
+#-------------------------------------------------------------------------------
+def set_listener(camera):
+	"""
+	Set the camera positional sounds are heard from.
+	"""
+	if manager:
+		manager.listener = camera
+
 #-------------------------------------------------------------------------------
 def play_music(name):
 	if manager:
@@ -51,6 +51,7 @@ import Interface
 import Camera
 import Keyboard
 import Event
+import Sound
 
 from Graphics import *
 
@@ -98,7 +99,10 @@ class PlayingState(GameState):
 		self.name = "Playing"
 		self.level = None
 		self.camera = Camera.CubeCamera(3, 35.0, 0.0, 0)
+		Sound.set_listener(self.camera)
 		self.keyboard_control = Objects.Movement()
+		# Set to a Client.Client when playing in a match on a server
+		self.client = None
 	
 	def key_pressed(self, key):
 		motion = self.level.player.motion
@@ -117,7 +121,9 @@ class PlayingState(GameState):
 			self.keyboard_control.right = True
 			motion.angle, motion.moving = self.keyboard_control.get_angle()
 		elif key == Keyboard.KEY_LAY_BOMB:
-			if self.level.player.life:
+			if self.client:
+				self.client.lay_bomb()
+			elif self.level.player.life:
 				self.level.add_bomb(self.level.player.x, self.level.player.y)
 		elif key == ord("]"):
 			Event.post(Event.EVENT_CAMERA_ZOOM, [self.camera.zooms[1] + 15])
@@ -130,10 +136,11 @@ class PlayingState(GameState):
 				self.level.add_bomb(x, y)
 
 		else:
-			try:
-				Log.info("Key pressed: " + chr(key))
-			except ValueError:
-				Log.info("Key pressed (keycode " + str(key) + ")")
+			if Log.info_enabled:
+				if 0 <= key < 256:
+					Log.info("Key pressed: %s", chr(key))
+				else:
+					Log.info("Key pressed (keycode %d)", key)
 	
 	def key_released(self, key):
 		motion = self.level.player.motion
@@ -160,16 +167,18 @@ class PlayingState(GameState):
 		
 	def update(self):
 		self.camera.update()
-		self.level.update()
+		if self.client:
+			self.client.update(self.level, self.camera)
+		else:
+			self.level.update()
 	
 	def draw(self):
-		cam = self.camera
-		gluLookAt(cam.pos.x,	cam.pos.y,		cam.pos.z,
-				  cam.lookat.x,	cam.lookat.y,	cam.lookat.z,
-				  cam.up.x,		cam.up.y,		cam.up.z)
+		self.camera.draw()
 		self.level.draw()
 	
 	def load_level(self, level):
+		if self.level is not None:
+			self.level.close()
 		self.level = Objects.Level(level)
 		DataManager.meshes.load("bomb.obj")
 
@@ -246,7 +255,8 @@ current = None
 #-------------------------------------------------------------------------------
 def push(state):
 	global current
-	Log.info("Changing game state to " + state.name)
+	Log.info("Changing game state to %s", state.name)
+	Log.trace.record(Log.TRACE_STATE, state.name)
 	states.append(state)
 	current = state
 	Event.post(Event.EVENT_STATE_CHANGED)
@@ -257,7 +267,8 @@ def replace(state):
 	if len(states) < 1:
 		Log.error("No game states present!")
 		return
-	Log.info("Changing game state to " + state.name)
+	Log.info("Changing game state to %s", state.name)
+	Log.trace.record(Log.TRACE_STATE, state.name)
 	states[-1] = state
 	current = state
 	Event.post(Event.EVENT_STATE_CHANGED)
@@ -275,7 +286,8 @@ def pop():
 		current = None
 	else:
 		current = states[-1]
-		Log.info("Changing game state to " + current.name)
+		Log.info("Changing game state to %s", current.name)
+		Log.trace.record(Log.TRACE_STATE, current.name)
 	Event.post(Event.EVENT_STATE_CHANGED)
 
 #-------------------------------------------------------------------------------
@@ -284,6 +296,7 @@ def clear():
 	states = []
 	current = None
 	Log.info("Clearing game state stack...")
+	Log.trace.record(Log.TRACE_STATE, "clear")
 	Event.post(Event.EVENT_STATE_CHANGED)
 
 #-------------------------------------------------------------------------------
@@ -35,7 +35,7 @@
 		Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307 USA
 """
 
-import os, os.path, tarfile
+import os, os.path, tarfile, threading
 
 import Log
 Log.info("Initializing virtual filesystem...")
@@ -48,6 +48,9 @@ class MountPoint:
 	def __init__(self, path = "", type = TYPE_DIRECTORY):
 		self.path = path
 		self.type = type
+		# Files opened from an archive share its file object, so only one
+		# thread may use it at a time
+		self.lock = threading.Lock()
 	
 	def __repr__(self):
 		"""
@@ -59,6 +62,61 @@ class MountPoint:
 			type = "Bzipped Tar Archive"
 		return "[" + self.path + ", " + type + "]"
 
+#-------------------------------------------------------------------------------
+class ArchiveFile:
+	"""
+	Archive File
+	============
+		A file in a mounted archive. Every call holds the mount point's lock,
+		since all files opened from the archive read through the same
+		underlying file object and would otherwise mix up each other's reads
+		and seeks.
+	"""
+	def __init__(self, data, lock, archive = None):
+		self.data = data
+		self.lock = lock
+		# An archive opened just for this file, closed along with it
+		self.archive = archive
+	
+	def read(self, size = -1):
+		self.lock.acquire()
+		try:
+			return self.data.read(size)
+		finally:
+			self.lock.release()
+	
+	def readline(self, size = -1):
+		self.lock.acquire()
+		try:
+			return self.data.readline(size)
+		finally:
+			self.lock.release()
+	
+	def readlines(self):
+		self.lock.acquire()
+		try:
+			return self.data.readlines()
+		finally:
+			self.lock.release()
+	
+	def seek(self, offset, whence = 0):
+		self.lock.acquire()
+		try:
+			self.data.seek(offset, whence)
+		finally:
+			self.lock.release()
+	
+	def tell(self):
+		return self.data.tell()
+	
+	def close(self):
+		self.data.close()
+		if self.archive is not None:
+			self.archive.close()
+	
+	def __iter__(self):
+		return iter(self.readlines())
+
 #-------------------------------------------------------------------------------
 def mount(location):
 	"""
@@ -66,13 +124,13 @@ def mount(location):
 	"""
 	if location[-1] == "/":
 		location = location[:-1]
-	Log.info("Mounting " + location)
+	Log.info("Mounting %s", location)
 	if os.path.isdir(location):
 		mtab.append(MountPoint(location))
 	elif os.path.isfile(location):
 		mpoint = MountPoint(location, TYPE_BZIP_TAR)
 		mpoint.data = tarfile.open(location, "r:bz2")
-		mtab.append(MountPoint(location, TYPE_BZIP_TAR))
+		mtab.append(mpoint)
 
 #-------------------------------------------------------------------------------
 def umount(location):
@@ -82,7 +140,7 @@ def umount(location):
 	found = False
 	for pos in range(len(mtab)):
 		if mtab[pos].path == location:
-			Log.info("Unmounting " + location)
+			Log.info("Unmounting %s", location)
 			del mtab[pos]
 			found = True
 			break
@@ -91,10 +149,15 @@ def umount(location):
 	return found
 
 #-------------------------------------------------------------------------------
-def open(filename):
+def open(filename, stream = False):
 	"""
 	Open and return a file-like object from the path given, relative to the
 	mount root.
+	
+	Set stream for files that will be read a little at a time over a long
+	period, such as music. A file from an archive then gets its own handle
+	on the archive, so it doesn't have to wait for, or make the archive
+	seek back and forth between, other files being loaded from it.
 	"""
 	for location in mtab:
 		if location.type == TYPE_DIRECTORY:
@@ -102,8 +165,19 @@ def open(filename):
 			if os.path.exists(path):
 				return file(path)
 		elif location.type == TYPE_BZIP_TAR:
-			return location.data.extractfile(filename)
-	Log.error("Unable to find file " + filename)
+			location.lock.acquire()
+			try:
+				try:
+					member = location.data.getmember(filename)
+				except KeyError:
+					continue
+				if not stream:
+					return ArchiveFile(location.data.extractfile(member), location.lock)
+			finally:
+				location.lock.release()
+			archive = tarfile.open(location.path, "r:bz2")
+			return ArchiveFile(archive.extractfile(member), threading.Lock(), archive)
+	Log.error("Unable to find file %s", filename)
 	return None
 
 #-------------------------------------------------------------------------------
@@ -135,7 +209,14 @@ def exists(filename):
 			if os.path.exists(os.path.join(location.path, filename)):
 				return True
 		elif location.type == TYPE_BZIP_TAR:
-			pass
+			location.lock.acquire()
+			try:
+				location.data.getmember(filename)
+				return True
+			except KeyError:
+				pass
+			finally:
+				location.lock.release()
 	return False
 
 #-------------------------------------------------------------------------------
@@ -8,11 +8,13 @@
 		Modules
 		-------
 		Log			 - Generic logging facility
+		Backend		 - Graphics and sound backend selection
 		Event		 - Event handling and dispatching
 		VirtualFS	 - Virtual filesystem used within the engine
 		DataManager	 - Loads and stores game data such as images and meshes
 		Graphics	 - 2d/3d game object classes (e.g. Point2d, Mesh, Material)
 					   and OpenGL/SDL functions
+		NullGL		 - Do-nothing OpenGL functions for running headless
 		Objects		 - Game object classes (e.g. Level, Player, Bomb)
 		StateManager - Game state manager
 		Keyboard	 - Defined key constants and keyboard functions
@@ -20,7 +22,8 @@
 		Sound		 - Manage sound playback
 		
 		Make sure to call Boom.init() after importing Boom or the modules above
-		will not be loaded for use!
+		will not be loaded for use! To run without OpenGL, PIL or SDL, pass
+		the null backends to Boom.init() and use Interface.NullInterface.
 		
 		A Simple Example
 		----------------
@@ -51,6 +54,7 @@
 """
 
 import Log
+import Backend
 
 Event = None
 VirtualFS = None
@@ -64,7 +68,17 @@ Camera = None
 
 version = 0.1
 
-def init():
+def init(graphics = None, sound = None):
+	"""
+	Load the engine modules.
+	
+	@type graphics: string
+	@param graphics: The graphics backend, e.g. Backend.GRAPHICS_NULL.
+	                 Defaults to Backend.graphics.
+	@type sound: string
+	@param sound: The sound backend, e.g. Backend.SOUND_NULL. Defaults to
+	              Backend.sound.
+	"""
 	global Event
 	global VirtualFS
 	global DataManager
@@ -75,6 +89,11 @@ def init():
 	global Sound
 	global Camera
 	
+	if graphics is not None:
+		Backend.graphics = graphics
+	if sound is not None:
+		Backend.sound = sound
+	
 	import Event
 	import VirtualFS
 	import DataManager
@@ -100,3 +119,16 @@ def load_level(level):
 	StateManager.current.load_level(level)
 	
 	return StateManager.current.level
+
+def join_match(server, level, match = 0):
+	"""
+	A convienience function that will change the game state to playing, load
+	a level and join a match on it hosted by server (a host, port pair).
+	
+	@return: The level that was loaded.
+	"""
+	import Client
+	level = load_level(level)
+	level.player = Objects.Player()
+	StateManager.current.client = Client.Client(server, match)
+	return level